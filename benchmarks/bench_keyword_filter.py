@@ -0,0 +1,71 @@
+"""
+Benchmark of the keyword matching in 2_keyword_filter.py
+
+Checks that KeywordMatcher flags the same texts as the original check of every keyword
+against every text, and times both as the keyword lists grow.
+
+Run from the repository root, so config.ini is found:
+    python benchmarks/bench_keyword_filter.py --texts 20000 --keywords 10 100 1000 5000
+"""
+import os
+import sys
+import time
+import argparse
+import importlib
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+keyword_filter = importlib.import_module('2_keyword_filter')
+
+def keyword_in_text(text, keywords, lowercase: bool=True):
+    """
+    Original keyword check of 2_keyword_filter.py, kept as the reference output
+    """
+    if type(text) != str: return False
+    use_text = text.lower() if lowercase else text
+    return any([keyword in use_text for keyword in keywords])
+
+def synthetic_texts(n_texts: int, rng) -> pd.Series:
+    """
+    Email-like texts of 20 to 200 words, with some missing values
+    """
+    vocabulary = np.array([''.join(rng.choice(list('abcdefghijklmnopqrstuvwxyz'), size=rng.integers(2, 10))) for _ in range(5000)])
+    texts = [' '.join(vocabulary[rng.integers(len(vocabulary), size=rng.integers(20, 200))]).capitalize() for _ in range(n_texts)]
+    texts = pd.Series(texts, dtype=object)
+    texts[rng.random(n_texts) < .02] = np.nan
+    return texts, vocabulary
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--texts', type=int, default=20000)
+    parser.add_argument('--keywords', type=int, nargs='+', default=[10, 100, 1000, 5000])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    texts, vocabulary = synthetic_texts(args.texts, rng)
+    arrow_texts = texts.astype('str')
+    print(f"Aho-Corasick automaton: {'yes' if keyword_filter.ahocorasick else 'no, pyahocorasick is not installed'}")
+
+    for n_keywords in args.keywords:
+        # Mostly two word phrases that rarely occur, plus a few single words
+        keywords = [' '.join(vocabulary[rng.integers(len(vocabulary), size=2)]) for _ in range(n_keywords)]
+        keywords[:n_keywords // 100] = vocabulary[rng.integers(len(vocabulary), size=n_keywords // 100)]
+
+        for lowercase in [True, False]:
+            matcher = keyword_filter.KeywordMatcher(keywords, lowercase=lowercase)
+            start = time.perf_counter()
+            flags = matcher.match(arrow_texts)
+            elapsed = time.perf_counter() - start
+            object_flags = matcher.match(texts)
+
+            start = time.perf_counter()
+            expected = texts.apply(lambda x: keyword_in_text(x, keywords, lowercase=lowercase))
+            legacy_elapsed = time.perf_counter() - start
+            assert (flags.values == expected.values).all() and (object_flags.values == expected.values).all()
+
+            print(f"{n_keywords} keywords, {'lowercased' if lowercase else 'case sensitive'}: {flags.sum()} of {len(texts)} texts matched, "
+                  f"{elapsed:.2f}s ({len(texts) / elapsed:,.0f} texts/sec), original check {legacy_elapsed:.2f}s")
+
+if __name__ == '__main__':
+    main()
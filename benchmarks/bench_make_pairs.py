@@ -0,0 +1,115 @@
+"""
+Benchmark of the question-answer pairing in 4_make_pairs.py
+
+Generates a synthetic corpus of conversations, checks that make_pairs writes exactly the same
+csv as the original loop over groupby, then times make_pairs on larger corpora.
+
+Run from the repository root, so config.ini is found:
+    python benchmarks/bench_make_pairs.py --sizes 10000 100000 1000000 5000000
+"""
+import io
+import os
+import sys
+import time
+import argparse
+import importlib
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+make_pairs = importlib.import_module('4_make_pairs')
+
+def legacy_pairs(emails_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Pairing loop of 4_make_pairs.py before it was vectorized, kept as the reference output
+    """
+    result = []
+    for conversation, group in emails_df.groupby('conversation'):
+        if group.iloc[0]['from'] not in [1,4]:
+            continue
+
+        i = 0
+        question = ''
+        answer = ''
+        for row in group.itertuples(index=False):
+            if type(row.body) != str or row.body == 'nan' or len(row.body.strip()) == 0: continue
+            if row._5 == 1:
+                if len(answer) > 0:
+                    if len(question) > 0 and len(answer) > 0:
+                        result.append({'conversation': conversation, 'turn': i, 'question': question, 'answer': answer})
+                    question = ''
+                    answer = ''
+                    i += 1
+                question = row.body
+            elif row._5 == 2:
+                answer = row.body
+
+        if len(question) > 0 and len(answer) > 0:
+            result.append({'conversation': conversation, 'turn': i, 'question': question, 'answer': answer})
+
+    return pd.DataFrame.from_dict(result)
+
+def synthetic_corpus(n_emails: int, seed: int=0) -> pd.DataFrame:
+    """
+    Creates emails with the columns of the extraction output, read back from csv like the real file
+    Conversations have 1 to 12 emails from any sender, some with missing, blank or 'nan' bodies,
+    and their rows are shuffled in the file
+    """
+    rng = np.random.default_rng(seed)
+    lengths = rng.integers(1, 13, size=n_emails // 6 + 1)
+    conversation = np.repeat(np.arange(len(lengths)), lengths)[:n_emails]
+    turn = np.arange(len(conversation)) - np.repeat(np.cumsum(lengths) - lengths, lengths)[:n_emails]
+    sender = rng.choice([1, 2, 3, 4], p=[.45, .45, .05, .05], size=len(conversation))
+
+    words = np.array(['course', 'register', 'deadline', 'thanks', 'exam', 'credit', 'please', 'advisor'])
+    body = pd.Series(words[rng.integers(len(words), size=len(conversation))]).str.cat(
+        pd.Series(rng.integers(1000, size=len(conversation)).astype(str)), sep=' ').astype(object)
+    odd = rng.random(len(conversation))
+    body[odd < .03] = np.nan
+    body[(odd >= .03) & (odd < .05)] = '   '
+    body[(odd >= .05) & (odd < .06)] = 'nan'
+
+    df = pd.DataFrame({'conversation': conversation, 'turn': turn, 'body': body, 'header': 'Subject',
+                       'date': '01-01-2023 10:00:00', 'from': sender, 'to': np.where(sender == 2, 1, 2),
+                       'folder_path': 'Sent Items'})
+    df = df.iloc[rng.permutation(len(df))]
+    buffer = io.StringIO()
+    df.reset_index(drop=True).to_csv(buffer)
+    buffer.seek(0)
+    return pd.read_csv(buffer, index_col=0)
+
+def to_csv(df: pd.DataFrame) -> str:
+    return df.to_csv(encoding=make_pairs.ENCODING)
+
+def check_equal(n_emails: int, seed: int):
+    emails_df = synthetic_corpus(n_emails, seed)
+    expected, actual = to_csv(legacy_pairs(emails_df)), to_csv(make_pairs.make_pairs(emails_df))
+    assert expected == actual, f"Output differs from the original loop on {n_emails} emails (seed {seed})"
+    print(f"Same output as the original loop on {n_emails} emails, seed {seed}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--legacy-max', type=int, default=100000, help="Largest corpus to also time the original loop on")
+    args = parser.parse_args()
+
+    for seed in range(5):
+        check_equal(5000, seed)
+
+    for n_emails in args.sizes:
+        emails_df = synthetic_corpus(n_emails)
+        start = time.perf_counter()
+        pairs = make_pairs.make_pairs(emails_df)
+        elapsed = time.perf_counter() - start
+        line = f"{n_emails} emails, {pairs.shape[0]} pairs: {elapsed:.2f}s ({n_emails / elapsed:,.0f} emails/sec)"
+
+        if n_emails <= args.legacy_max:
+            start = time.perf_counter()
+            legacy = legacy_pairs(emails_df)
+            legacy_elapsed = time.perf_counter() - start
+            assert to_csv(legacy) == to_csv(pairs)
+            line += f", original loop {legacy_elapsed:.2f}s ({legacy_elapsed / elapsed:.0f}x slower)"
+        print(line)
+
+if __name__ == '__main__':
+    main()
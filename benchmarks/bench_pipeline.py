@@ -0,0 +1,234 @@
+"""
+End-to-end benchmark of the steps on a synthetic corpus, see synthetic_corpus.py
+
+Each step runs in its own process on a corpus of each size, and the time, throughput and peak
+resident memory of the step are reported. The corpus is generated before the timing starts.
+The steps are:
+    parse           handle_sent_message on the sent emails of a fake Outlook folder
+    save            Messages.save_to_file of the parsed emails
+    keyword_filter  simple_filter of 2_keyword_filter.py, with the keyword lists of DATA_DIR
+    make_pairs      from_csv of 4_make_pairs.py
+    extraction      from_csv of extraction.py
+    classification  classify_pairs of classification.py
+    clustering      create_embeddings and cluster_pairs of clustering.py
+The steps with models only run on the first --model-rows emails or pairs. Parsing doesn't scrub
+the emails unless --scrub is given, since the name detector would take most of the time. Steps
+whose dependencies are not installed are reported as skipped.
+
+With --breakdown, the time of the sub-steps of each step is shown, from its run report (see
+scripts/instrumentation.py). With --baseline, the throughput is compared with the results saved by a previous run with --output,
+and the benchmark fails if a step got slower than --tolerance times the baseline.
+
+Run from the repository root, so config.ini is found:
+    python benchmarks/bench_pipeline.py --sizes 1000 10000 100000 --steps parse save keyword_filter make_pairs
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import importlib
+import subprocess
+import configparser
+from typing import Callable, Dict, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic_corpus
+import instrumentation
+from shared_defns import get_filepath
+from storage import write_table
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+RESULT_PREFIX = 'BENCH_RESULT '
+MEMORY_INTERVAL = .005 # seconds between memory samples, shorter than in the run reports as some steps are short
+
+class UnscrubbedPool:
+    """
+    Scrub pool that leaves the messages as they are, to time the parsing alone
+    """
+    def submit(self, messages): pass
+    def flush(self): pass
+    def close(self): pass
+
+def parsed_messages(n_emails: int, scrub: bool, work_dir: str):
+    """
+    The download step module, and a function that parses the sent emails of a fake folder into its Messages
+    """
+    download = importlib.import_module('1_download_emails')
+    download.read_internal_domains(get_filepath(config, 'download_emails', 'INTERNAL_DOMAINS_FILE'))
+    folder = synthetic_corpus.FakeFolder(synthetic_corpus.sent_messages(n_emails))
+    if scrub:
+        from scrubbing import ScrubPool, ScrubCache
+        pool = ScrubPool(download.SCRUB_WORKERS, download.SCRUB_BATCH_SIZE, ScrubCache(os.path.join(work_dir, 'scrub_cache.sqlite'), download.SCRUB_CACHE_SIZE))
+    else:
+        pool = UnscrubbedPool()
+    messages = download.Messages(pool)
+
+    def parse():
+        raw_messages, total = download.get_outlook_messages(folder, messages)
+        download.parse_emails(None, raw_messages, total, messages)
+        messages.finish_scrubbing()
+        pool.close()
+    return download, messages, parse
+
+# Each step prepares its input, and returns the function to time, the number of items and their unit
+def step_parse(n_emails: int, work_dir: str, args) -> Tuple[Callable, int, str]:
+    _, _, parse = parsed_messages(n_emails, args.scrub, work_dir)
+    return parse, n_emails, 'emails'
+
+def step_save(n_emails: int, work_dir: str, args) -> Tuple[Callable, int, str]:
+    _, messages, parse = parsed_messages(n_emails, False, work_dir)
+    parse()
+    rows = sum(len(conversation) for conversation in messages.conversations.values())
+    return lambda: messages.save_to_file(os.path.join(work_dir, '1_download_emails.csv')), rows, 'messages'
+
+def step_keyword_filter(n_emails: int, work_dir: str, args) -> Tuple[Callable, int, str]:
+    keyword_filter = importlib.import_module('2_keyword_filter')
+    predicates = keyword_filter.make_predicates(
+        keyword_filter.read_keywords(get_filepath(config, 'keyword_filter', 'HEADER_KW_FILE')),
+        keyword_filter.read_keywords(get_filepath(config, 'keyword_filter', 'BODY_KW_FILE')))
+    df = synthetic_corpus.emails_table(n_emails)
+    return lambda: keyword_filter.simple_filter(df, predicates), df.shape[0], 'messages'
+
+def step_make_pairs(n_emails: int, work_dir: str, args) -> Tuple[Callable, int, str]:
+    make_pairs = importlib.import_module('4_make_pairs')
+    in_path = os.path.join(work_dir, '3_extract_contents.csv')
+    df = synthetic_corpus.emails_table(n_emails)
+    write_table(df, in_path)
+    return lambda: make_pairs.from_csv(in_path, os.path.join(work_dir, '4_make_pairs.csv')), df.shape[0], 'messages'
+
+def step_extraction(n_emails: int, work_dir: str, args) -> Tuple[Callable, int, str]:
+    import extraction
+    in_path = os.path.join(work_dir, '2_keyword_filter.csv')
+    df = synthetic_corpus.emails_table(n_emails).head(args.model_rows)
+    write_table(df, in_path)
+    return lambda: extraction.from_csv(in_path, os.path.join(work_dir, '3_extract_contents.csv')), df.shape[0], 'messages'
+
+def synthetic_pairs(n_emails: int, rows: int):
+    make_pairs = importlib.import_module('4_make_pairs')
+    return make_pairs.make_pairs(synthetic_corpus.emails_table(n_emails)).head(rows)
+
+def step_classification(n_emails: int, work_dir: str, args) -> Tuple[Callable, int, str]:
+    import classification
+    pairs = synthetic_pairs(n_emails, args.model_rows)
+    return lambda: classification.classify_pairs(pairs), pairs.shape[0], 'pairs'
+
+def step_clustering(n_emails: int, work_dir: str, args) -> Tuple[Callable, int, str]:
+    import clustering
+    texts = clustering.pair_texts(synthetic_pairs(n_emails, args.model_rows))
+
+    def cluster():
+        embeddings = clustering.create_embeddings(texts, 'cpu', os.path.join(work_dir, 'embeddings'))
+        clustering.cluster_pairs(texts, embeddings, os.path.join(work_dir, 'models'), os.path.join(work_dir, 'reduced'))
+    return cluster, len(texts['questions']), 'pairs'
+
+STEPS: Dict[str, Callable] = {'parse': step_parse, 'save': step_save, 'keyword_filter': step_keyword_filter,
+                              'make_pairs': step_make_pairs, 'extraction': step_extraction,
+                              'classification': step_classification, 'clustering': step_clustering}
+
+def run_step(step: str, n_emails: int, work_dir: str, args) -> Dict:
+    """
+    Runs one step in this process, returning its measurements
+    """
+    try:
+        run, items, unit = STEPS[step](n_emails, work_dir, args)
+    except ImportError as e:
+        return {'skipped': f"missing module {e.name}"}
+
+    # The step runs as a run of instrumentation.py, which samples the memory and times its sub-steps
+    start_memory = instrumentation.resident_memory()
+    with instrumentation.run(step, report_dir=work_dir, memory_interval=MEMORY_INTERVAL) as metrics:
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+    return {'seconds': elapsed, 'items': items, 'unit': unit, 'per_second': items / elapsed if elapsed else None,
+            'peak_rss_mb': metrics.peak_memory / 2**20, 'start_rss_mb': start_memory / 2**20, 'timers': metrics.report()['timers']}
+
+def run_in_process(step: str, n_emails: int, args) -> Dict:
+    """
+    Runs one step in a new process, in its own folder
+    """
+    work_dir = tempfile.mkdtemp(prefix=f'bench_{step}_', dir=args.work_dir)
+    command = [sys.executable, os.path.abspath(__file__), '--run-step', step, '--sizes', str(n_emails),
+               '--work-dir', work_dir, '--model-rows', str(args.model_rows)] + (['--scrub'] if args.scrub else [])
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if args.verbose:
+        print(completed.stdout, completed.stderr)
+
+    results = [line[len(RESULT_PREFIX):] for line in completed.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+    if completed.returncode != 0 or not results:
+        error = completed.stderr.strip().splitlines()
+        return {'error': error[-1] if error else f"exit code {completed.returncode}"}
+    return json.loads(results[-1])
+
+def report(step: str, n_emails: int, result: Dict, baseline: Dict, tolerance: float, breakdown: bool=False) -> bool:
+    """
+    Prints the result of a step, and the time of its sub-steps with breakdown
+    Returns False if it is slower than the baseline
+    """
+    if 'skipped' in result or 'error' in result:
+        print(f"{step:<15}{n_emails:>9}  {result.get('skipped') or 'failed: ' + result['error']}")
+        return True
+
+    line = (f"{step:<15}{n_emails:>9}  {result['items']:>9} {result['unit']:<9}{result['seconds']:>9.2f}s"
+            f"{result['per_second']:>12,.0f}/s{result['peak_rss_mb']:>9.0f} MB peak ({result['peak_rss_mb'] - result['start_rss_mb']:+.0f} MB)")
+    passed = True
+    previous = baseline.get(f'{step}/{n_emails}')
+    if previous and previous.get('per_second'):
+        ratio = previous['per_second'] / result['per_second']
+        line += f"  {ratio:.2f}x baseline time"
+        if ratio > tolerance:
+            line += "  SLOWER"
+            passed = False
+    print(line)
+
+    if breakdown:
+        for timer in sorted(result.get('timers', []), key=lambda timer: -timer['seconds']):
+            print(f"    {timer['name']:<40}{timer['calls']:>9} calls{timer['seconds']:>9.2f}s")
+    return passed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="Numbers of sent emails")
+    parser.add_argument('--steps', nargs='+', choices=list(STEPS), default=list(STEPS))
+    parser.add_argument('--model-rows', type=int, default=1000, help="Rows given to the steps with models")
+    parser.add_argument('--scrub', action='store_true', help="Scrub the emails while parsing")
+    parser.add_argument('--work-dir', help="Folder for the files written by the steps, a temporary folder by default")
+    parser.add_argument('--output', help="Saves the results as JSON, to use as a baseline")
+    parser.add_argument('--baseline', help="Results of a previous run to compare with")
+    parser.add_argument('--tolerance', type=float, default=1.25, help="Largest slowdown from the baseline that passes")
+    parser.add_argument('--breakdown', action='store_true', help="Shows the time of the sub-steps of each step")
+    parser.add_argument('--verbose', action='store_true', help="Shows the output of the steps")
+    parser.add_argument('--run-step', choices=list(STEPS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_step:
+        print(RESULT_PREFIX + json.dumps(run_step(args.run_step, args.sizes[0], args.work_dir, args)))
+        return
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    results, passed = {}, True
+    for n_emails in args.sizes:
+        for step in args.steps:
+            results[f'{step}/{n_emails}'] = result = run_in_process(step, n_emails, args)
+            passed = report(step, n_emails, result, baseline, args.tolerance, args.breakdown) and passed
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=1)
+    if not passed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
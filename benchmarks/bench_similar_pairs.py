@@ -0,0 +1,75 @@
+"""
+Benchmark of the similar pairs search in similar_pairs.py
+
+Compares the HNSW index with the exact search over all questions, on synthetic embeddings
+grouped around topic centres like the question embeddings. Reports the recall of the HNSW
+results (the share of the exact top k that it finds) and the latency of single queries.
+Without hnswlib installed, only the exact search is timed.
+
+Run from the repository root, so config.ini is found:
+    python benchmarks/bench_similar_pairs.py --sizes 10000 100000 --queries 200 -k 5
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+import similar_pairs
+
+def synthetic_embeddings(n: int, dims: int, rng, n_topics: int=200) -> np.ndarray:
+    """
+    Normalized vectors around n_topics random centres
+    """
+    centres = rng.normal(size=(n_topics, dims))
+    vectors = centres[rng.integers(n_topics, size=n)] + rng.normal(scale=.8, size=(n, dims))
+    return similar_pairs.normalize(vectors)
+
+def latencies(search, queries: np.ndarray) -> np.ndarray:
+    """
+    Time of each single query search, in milliseconds
+    """
+    times = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query[None, :])
+        times.append((time.perf_counter() - start) * 1000)
+    return np.array(times)
+
+def report(name: str, times: np.ndarray):
+    print(f"  {name}: p50 {np.percentile(times, 50):.2f} ms, p95 {np.percentile(times, 95):.2f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--dims', type=int, default=768)
+    parser.add_argument('-k', type=int, default=similar_pairs.TOP_K)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"hnswlib: {'yes' if similar_pairs.hnswlib else 'no, only the exact search is timed'}")
+
+    for n in args.sizes:
+        vectors = synthetic_embeddings(n, args.dims, rng)
+        queries = synthetic_embeddings(args.queries, args.dims, rng)
+        print(f"{n} pairs, {args.queries} queries, k={args.k}")
+
+        exact, _ = similar_pairs.brute_force_search(vectors, queries, args.k)
+        report('exact', latencies(lambda q: similar_pairs.brute_force_search(vectors, q, args.k), queries))
+
+        if similar_pairs.hnswlib:
+            start = time.perf_counter()
+            index = similar_pairs.hnsw_index(args.dims, n)
+            similar_pairs.hnsw_add(index, vectors, np.arange(n))
+            print(f"  hnsw built in {time.perf_counter() - start:.1f}s")
+
+            for ef in sorted({max(ef, args.k) for ef in [args.k, 50, similar_pairs.HNSW_EF_SEARCH, 200]}):
+                index.set_ef(ef)
+                found, _ = index.knn_query(queries, k=args.k)
+                recall = np.mean([len(np.intersect1d(f, e)) / args.k for f, e in zip(found, exact)])
+                report(f'hnsw ef={ef}, recall {recall:.3f}', latencies(lambda q: index.knn_query(q, k=args.k), queries))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Checks that an incremental email download gives the same conversations as downloading everything
+
+The sent emails of a synthetic corpus (see synthetic_corpus.py) are split at a date. The emails
+before it are saved as in get_emails, and the emails after it are added as in get_new_emails.
+Threads with emails on both sides of the date make a longer copy of a saved conversation, which
+must replace it, even though the saved messages were scrubbed. The messages are "scrubbed" by
+masking the names and numbers in them, so the saved bodies differ from the downloaded ones, as
+with the real scrubber. The result is compared with a download of all the emails at once, and
+the check fails if it has more conversations, i.e. saved conversations were kept next to their
+longer copy. A few extended threads are not replaced in either download, when the quotes of their
+emails are not split into the same messages.
+
+Run from the repository root, so config.ini is found:
+    python benchmarks/check_incremental_download.py --emails 2000
+"""
+import os
+import re
+import sys
+import shutil
+import argparse
+import tempfile
+import importlib
+import configparser
+from typing import Dict, List
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic_corpus
+from mail_snapshot import RawMessage
+from shared_defns import get_filepath
+from storage import read_table
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+class MaskingPool:
+    """
+    Scrub pool that masks the names and numbers of the synthetic corpus, in place of the real scrubber
+    """
+    pattern = re.compile(r'\d+|\b(?:' + '|'.join(synthetic_corpus.FIRST_NAMES + synthetic_corpus.LAST_NAMES) + r')\b')
+
+    def submit(self, messages: List[Dict]):
+        for message in messages:
+            if message['body']: message['body'] = self.pattern.sub('{{MASKED}}', message['body'])
+    def flush(self): pass
+    def close(self): pass
+
+def download(module, sent: List[RawMessage], filepath: str, previous_dump: bool=False):
+    """
+    Parses the sent emails, and saves their conversations as get_emails, or adds them to the dump as get_new_emails
+    Returns the number of saved conversations that were replaced
+    """
+    messages = module.Messages(MaskingPool())
+    if previous_dump: messages.read_previous_dump(filepath)
+    raw_messages, total = module.get_outlook_messages(synthetic_corpus.FakeFolder(sent), messages)
+    module.parse_emails(None, raw_messages, total, messages)
+    replaced = len(messages.removed_ids)
+    if previous_dump:
+        messages.append_to_file(filepath)
+    else:
+        messages.save_to_file(filepath)
+    return replaced
+
+def conversation_sizes(filepath: str) -> List[int]:
+    return sorted(read_table(filepath).groupby('conversation').size().tolist())
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--emails', type=int, default=2000, help="Number of sent emails")
+    args = parser.parse_args()
+
+    module = importlib.import_module('1_download_emails')
+    module.read_internal_domains(get_filepath(config, 'download_emails', 'INTERNAL_DOMAINS_FILE'))
+    sent = synthetic_corpus.sent_messages(args.emails)
+    split = sorted(message.sent_on for message in sent)[len(sent) // 2]
+    before = [message for message in sent if message.sent_on < split]
+    after = [message for message in sent if message.sent_on >= split]
+
+    # Sent emails are named after their thread, see synthetic_corpus.sent_messages
+    thread = lambda message: message.entry_id.split('-')[0]
+    extended = len({thread(message) for message in before} & {thread(message) for message in after})
+
+    work_dir = tempfile.mkdtemp(prefix='check_incremental_')
+    try:
+        full_path, incremental_path = os.path.join(work_dir, 'full.csv'), os.path.join(work_dir, 'incremental.csv')
+        download(module, sent, full_path)
+        download(module, before, incremental_path)
+        replaced = download(module, after, incremental_path, previous_dump=True)
+        full, incremental = conversation_sizes(full_path), conversation_sizes(incremental_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"{extended} saved threads were extended by the new emails, {replaced} saved conversations were replaced")
+    print(f"Full download: {len(full)} conversations, {sum(full)} messages")
+    print(f"Incremental download: {len(incremental)} conversations, {sum(incremental)} messages")
+    if incremental != full:
+        print("FAILED: the incremental download kept saved conversations next to their longer copy")
+        sys.exit(1)
+    print("OK")
+
+if __name__ == '__main__':
+    main()
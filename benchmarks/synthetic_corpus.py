@@ -0,0 +1,303 @@
+"""
+Synthetic advising emails, to run and benchmark the steps without the real mailbox
+
+Threads alternate between a student question and an advising answer. The sent folder has one
+email per answer, with the earlier messages of the thread quoted below it, as Outlook ("From:",
+"Sent:" headers) or Gmail ("On <date>, <name> wrote:") replies. Messages have signatures, student
+numbers and names, so the scrubbing and deduplication have work to do. The same threads are
+also available as a table in the format of the download step output, for the later steps.
+
+FakeFolder stands in for an Outlook COM folder (Items, Sort, Restrict, GetFirst, GetNext), so
+get_outlook_messages of 1_download_emails.py can read the synthetic emails on any platform.
+
+Run from the repository root to write a corpus, e.g. for the pipeline or the notebooks:
+    python benchmarks/synthetic_corpus.py --emails 100000 --out /tmp/corpus
+"""
+import os
+import re
+import sys
+import random
+import argparse
+import operator
+import pandas as pd
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List, NamedTuple, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+from shared_defns import EmailAddress
+from mail_snapshot import MailSnapshot, RawMessage
+from storage import write_table
+
+ADVISING_NAME = 'Science Advising'
+ADVISING_ADDRESS = 'advising@science.ubc.ca'
+MAIL_ITEM_CLASS = 43
+
+FIRST_NAMES = ['Emma', 'Liam', 'Olivia', 'Noah', 'Ava', 'Ethan', 'Sophia', 'Lucas', 'Mia', 'Mason', 'Chloe', 'Aiden',
+               'Priya', 'Arjun', 'Mei', 'Wei', 'Hana', 'Kenji', 'Fatima', 'Omar', 'Sofia', 'Mateo', 'Amara', 'Kwame']
+LAST_NAMES = ['Smith', 'Chen', 'Patel', 'Nguyen', 'Wong', 'Singh', 'Kim', 'Garcia', 'Martin', 'Brown', 'Li', 'Tremblay',
+              'Roy', 'Wilson', 'Khan', 'Ali', 'Lee', 'Taylor', 'Sato', 'Okafor', 'Rossi', 'Dubois', 'Silva', 'Cohen']
+ADVISORS = ['Jordan', 'Alex', 'Sam', 'Taylor', 'Morgan', 'Casey']
+COURSES = ['BIOL 112', 'CHEM 121', 'MATH 100', 'PHYS 117', 'CPSC 110', 'STAT 200', 'MICB 202', 'EOSC 114', 'ASTR 102']
+PROGRAMS = ['Biology', 'Chemistry', 'Computer Science', 'Physics', 'Mathematics', 'Microbiology', 'Statistics']
+TERMS = ['Winter Term 1', 'Winter Term 2', 'the summer session']
+
+# Subject, question and answer templates of each topic
+TOPICS = [
+    ('Dropping {course}',
+     ["Hi, I'd like to drop {course} but the deadline passed yesterday. Is there any way to withdraw without a W on my transcript?",
+      "Hello, I missed the drop deadline for {course} in {term}. Can I still drop it?"],
+     ["Hi {student}, after the drop deadline you can only withdraw with a W standing. You can do this on Workday until the withdrawal deadline.",
+      "Hello {student}, the deadline to drop without a W has passed, but you can still withdraw from {course} with a W before the withdrawal deadline."]),
+    ('Change of specialization',
+     ["Hello, I want to switch my major to {program}. What are the requirements and when can I apply?",
+      "Hi, how do I change my specialization to {program}? My student number is {student_id}."],
+     ["Hi {student}, applications to change your specialization to {program} open in the spring. You need to have completed the first year requirements.",
+      "Hello {student}, you can apply to {program} through the specialization application. Admission is competitive and based on your grades."]),
+    ('Academic concession',
+     ["Hi, I was sick during my {course} final exam. How do I apply for academic concession?",
+      "Hello, I had a family emergency and missed my {course} midterm. What should I do?"],
+     ["Hi {student}, please submit the academic concession form with a short statement, and let your {course} instructor know.",
+      "Hello {student}, I'm sorry to hear that. You can request an in-term concession from your instructor, or submit the form to us for the final exam."]),
+    ('Transfer credit',
+     ["Hi, I took a course at another university over the summer. How do I get transfer credit for it?",
+      "Hello, will my courses from college transfer as {course}? Student number {student_id}."],
+     ["Hi {student}, transfer credit is assessed by Enrolment Services once your official transcript is received. You can check the transfer credit database.",
+      "Hello {student}, please send your official transcript to Enrolment Services, and the credit will show on your record once it is assessed."]),
+    ('Registration problem - {course}',
+     ["Hi, I can't register for {course} because it says I'm missing a prerequisite. I took the equivalent course last year.",
+      "Hello, Workday won't let me register in {course} for {term}. Can you help?"],
+     ["Hi {student}, you'll need to contact the department offering {course} for a prerequisite waiver. We can't override registration restrictions.",
+      "Hello {student}, registration restrictions are set by the department, so please email them with your transcript to request an override."]),
+    ('Academic standing',
+     ["Hello, I'm on academic probation. How many credits can I take in {term}?",
+      "Hi, my standing changed to failed. What does that mean for next year?"],
+     ["Hi {student}, students on academic probation can register in up to 30 credits in the winter session. Please come to drop-in advising to make a plan.",
+      "Hello {student}, with a failed standing you need to take a year off before you can return. We recommend meeting with an advisor."]),
+]
+
+# Personal details added to the questions and answers, so threads are mostly distinct as in the real mailbox
+QUESTION_EXTRAS = ["I'm in section {section} of {course}, my student number is {student_id}.",
+                   "I'm a {year} year student in {program} (student number {student_id}).",
+                   "My student number is {student_id}.",
+                   "I emailed my instructor on {deadline} but haven't heard back. My student number is {student_id}.",
+                   "This is {full_name}, a {year} year {program} student, student number {student_id}."]
+ANSWER_EXTRAS = ["The deadline for this in {term} is {deadline}, and I've noted it on your file (reference {note_id}).",
+                 "I've added a note to your file (reference {note_id}).",
+                 "You can also drop in to advising on {weekday}, just mention reference {note_id} at the front desk.",
+                 "Please include your student number, {student_id}, in any future emails.",
+                 "Your record under student number {student_id} shows you are in {program}."]
+WEEKDAYS = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday']
+YEARS = ['first', 'second', 'third', 'fourth']
+
+class Thread(NamedTuple):
+    student: str
+    student_address: str
+    advisor: str
+    subject: str
+    dates: List[datetime]     # of each message, oldest first
+    bodies: List[str]         # question, answer, question, ...
+    outlook_quotes: bool      # Outlook headers if set, Gmail otherwise
+
+def student_signature(student: str, student_id: str, rng: random.Random) -> str:
+    return rng.choice([f"\n\nThanks,\n{student}", f"\n\nThank you,\n{student}\nStudent number: {student_id}",
+                       f"\n\nBest,\n{student}\n{student_id}", f"\n\n{student.split()[0]} ({student_id})"])
+
+def advisor_signature(advisor: str) -> str:
+    return f"\n\nBest regards,\n{advisor}\n{ADVISING_NAME}\nThe University of British Columbia\n{ADVISING_ADDRESS}"
+
+def make_thread(rng: random.Random, start: datetime, internal_domain: str) -> Thread:
+    """
+    A thread of 1 to 4 question-answer turns on one topic
+    """
+    student = f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}"
+    student_id = f"{rng.randrange(10000000, 99999999)}"
+    domain = internal_domain if rng.random() < .05 else rng.choice(['student.ubc.ca', 'gmail.com', 'hotmail.com'])
+    address = f"{student.lower().replace(' ', '.')}{rng.randrange(100)}@{domain}"
+    advisor = rng.choice(ADVISORS)
+    subject, questions, answers = rng.choice(TOPICS)
+    fields = {'course': rng.choice(COURSES), 'program': rng.choice(PROGRAMS), 'term': rng.choice(TERMS),
+              'student': student.split()[0], 'full_name': student, 'student_id': student_id, 'section': f"{rng.randrange(1, 120):03d}",
+              'year': rng.choice(YEARS), 'weekday': rng.choice(WEEKDAYS), 'note_id': rng.randrange(100000, 999999),
+              'deadline': (start + timedelta(days=rng.randrange(1, 60))).strftime('%B %d').replace(' 0', ' ')}
+
+    # Each turn has a different extra sentence, so no message is repeated in a thread
+    turns = rng.choice([1, 1, 2, 2, 3, 4])
+    question_extras, answer_extras = rng.sample(QUESTION_EXTRAS, turns), rng.sample(ANSWER_EXTRAS, turns)
+    bodies, dates, date = [], [], start
+    for turn in range(turns):
+        question = f"{rng.choice(questions)} {question_extras[turn]}".format(**fields)
+        answer = f"{rng.choice(answers)} {answer_extras[turn]}".format(**fields)
+        bodies.append(question + student_signature(student, student_id, rng))
+        bodies.append(answer + advisor_signature(advisor))
+        dates.append(date)
+        date += timedelta(hours=rng.uniform(1, 72))
+        dates.append(date)
+        date += timedelta(hours=rng.uniform(1, 72))
+    return Thread(student, address, advisor, subject.format(**fields), dates, bodies, rng.random() < .6)
+
+def quote_header(thread: Thread, i: int, rng: random.Random) -> str:
+    """
+    Reply header of message i of the thread, in the quoting style of the thread
+    A few dates are in formats only dateparser reads, as in the real mailbox
+    """
+    sender, address = (thread.student, thread.student_address) if i % 2 == 0 else (ADVISING_NAME, ADVISING_ADDRESS)
+    date = thread.dates[i]
+    if thread.outlook_quotes:
+        sent = date.strftime('%A, %B %d, %Y %I:%M %p') if rng.random() < .9 else date.strftime('%d %b. %Y %H:%M')
+        recipient = f"{ADVISING_NAME} <{ADVISING_ADDRESS}>" if i % 2 == 0 else f"{thread.student} <{thread.student_address}>"
+        return f"From: {sender} <{address}>\nSent: {sent}\nTo: {recipient}\nSubject: RE: {thread.subject}\n\n"
+    return f"On {date.strftime('%a, %b %d, %Y at %I:%M %p')} {sender} <{address}> wrote:\n"
+
+def sent_body(thread: Thread, answer: int, rng: random.Random) -> str:
+    """
+    Body of the sent email of an answer, with the earlier messages quoted below it
+    """
+    if thread.outlook_quotes:
+        # Earlier messages one after the other, below a separator line
+        parts = [thread.bodies[answer]] + [quote_header(thread, i, rng) + thread.bodies[i] for i in range(answer - 1, -1, -1)]
+        return '\n\n________________________________\n'.join(parts)
+
+    # Gmail quotes each message with its own quote nested in it
+    quoted = ''
+    for i in range(answer):
+        text = thread.bodies[i] + (f"\n\n{quoted}" if quoted else '')
+        quoted = quote_header(thread, i, rng) + '\n'.join('> ' + line if line else '>' for line in text.split('\n'))
+    return f"{thread.bodies[answer]}\n\n{quoted}"
+
+def synthetic_threads(n_emails: int, seed: int=0, internal_domain: str='science.ubc.ca') -> Iterator[Thread]:
+    """
+    Threads with n_emails answers in total, starting over two years
+    """
+    rng = random.Random(seed)
+    start = datetime(2022, 9, 1, 8, tzinfo=timezone.utc)
+    emails = 0
+    while emails < n_emails:
+        thread = make_thread(rng, start + timedelta(minutes=rng.uniform(0, 2 * 365 * 24 * 60)), internal_domain)
+        emails += len(thread.bodies) // 2
+        yield thread
+
+def sent_messages(n_emails: int, seed: int=0) -> List[RawMessage]:
+    """
+    Sent emails of the advising mailbox, one for each answer of the threads, in no particular order
+    """
+    rng = random.Random(seed + 1)
+    messages = []
+    for t, thread in enumerate(synthetic_threads(n_emails, seed)):
+        for answer in range(1, len(thread.bodies), 2):
+            messages.append(RawMessage(f'{t:08d}-{answer:02d}', thread.dates[answer], thread.subject if answer == 1 else f"RE: {thread.subject}",
+                                       sent_body(thread, answer, rng), thread.student_address))
+    return messages[:n_emails]
+
+def emails_table(n_emails: int, seed: int=0) -> pd.DataFrame:
+    """
+    The messages of the threads in the format of the download step output, one row for each message
+    n_emails counts the answers, as for sent_messages
+    """
+    rows = {'conversation': [], 'turn': [], 'body': [], 'header': [], 'date': [], 'from': [], 'to': [], 'folder_path': []}
+    for conversation, thread in enumerate(synthetic_threads(n_emails, seed)):
+        for turn, (body, date) in enumerate(zip(thread.bodies, thread.dates)):
+            from_student = turn % 2 == 0
+            rows['conversation'].append(conversation)
+            rows['turn'].append(turn)
+            rows['body'].append(body)
+            rows['header'].append(thread.subject if turn == 0 else f"RE: {thread.subject}")
+            rows['date'].append(date.replace(tzinfo=None))
+            rows['from'].append(int(EmailAddress.STUDENT if from_student else EmailAddress.ADVISING))
+            rows['to'].append(int(EmailAddress.ADVISING if from_student else EmailAddress.STUDENT))
+            rows['folder_path'].append('Sent Items')
+    return pd.DataFrame(rows)
+
+# Stand-ins for the Outlook COM objects read by 1_download_emails.py
+class FakeAddressEntry(NamedTuple):
+    Address: str
+    Type: str = 'SMTP'
+
+class FakeRecipient(NamedTuple):
+    AddressEntry: FakeAddressEntry
+
+class FakeRecipients:
+    def __init__(self, addresses: List[str]) -> None:
+        self.recipients = [FakeRecipient(FakeAddressEntry(address)) for address in addresses]
+        self.Count = len(self.recipients)
+
+    def __getitem__(self, i: int) -> FakeRecipient:
+        return self.recipients[i]
+
+class FakeMailItem:
+    Class = MAIL_ITEM_CLASS
+
+    def __init__(self, message: RawMessage) -> None:
+        self.EntryID = message.entry_id
+        self.SentOn = message.sent_on
+        self.Subject = message.subject
+        self.Body = message.body
+        self.Recipients = FakeRecipients([message.recipient_address] if message.recipient_address else [])
+
+filter_regex = re.compile(r"\[SentOn\] (>=|<=|<|>) '([^']+)'")
+filter_operators = {'>=': operator.ge, '<=': operator.le, '<': operator.lt, '>': operator.gt}
+
+class FakeItems:
+    """
+    Items collection of a folder, supporting the calls used by get_outlook_messages
+    Restrict understands [SentOn] comparisons joined by Or or And
+    """
+    def __init__(self, items: list) -> None:
+        self.items = items
+        self.position = 0
+
+    @property
+    def Count(self) -> int:
+        return len(self.items)
+
+    def Sort(self, field: str, descending: bool=False):
+        if field != '[SentOn]': raise ValueError(f"Can only sort by [SentOn], not {field}")
+        self.items = sorted(self.items, key=lambda item: item.SentOn, reverse=descending)
+
+    def Restrict(self, filter: str) -> 'FakeItems':
+        conditions = [(filter_operators[op], datetime.strptime(date, '%m/%d/%y %H:%M %p')) for op, date in filter_regex.findall(filter)]
+        combine = all if ' And ' in filter else any
+        return FakeItems([item for item in self.items
+                          if combine(op(item.SentOn.replace(tzinfo=None), date) for op, date in conditions)])
+
+    def GetFirst(self) -> Optional[FakeMailItem]:
+        self.position = 0
+        return self.GetNext()
+
+    def GetNext(self) -> Optional[FakeMailItem]:
+        if self.position >= len(self.items): return None
+        self.position += 1
+        return self.items[self.position - 1]
+
+class FakeFolder:
+    """
+    Outlook folder with the given messages, each access to Items returns a new collection as in COM
+    """
+    def __init__(self, messages: List[RawMessage]) -> None:
+        self.mail_items = [FakeMailItem(message) for message in messages]
+
+    @property
+    def Items(self) -> FakeItems:
+        return FakeItems(list(self.mail_items))
+
+def write_corpus(n_emails: int, out_dir: str, seed: int=0):
+    """
+    Writes the sent emails as a mail snapshot, for MODE = process, and the emails table
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    snapshot = MailSnapshot(os.path.join(out_dir, '1_raw_snapshot.sqlite'))
+    for message in sent_messages(n_emails, seed):
+        snapshot.add(message)
+    snapshot.close()
+    write_table(emails_table(n_emails, seed), os.path.join(out_dir, '1_download_emails.csv'))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--emails', type=int, default=10000)
+    parser.add_argument('--out', required=True, help="Folder to write the snapshot and the emails table to")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    write_corpus(args.emails, args.out, args.seed)
+    print(f"Wrote {args.emails} sent emails to {args.out}")
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,33 @@
 """
 Collects emails between students and advisors, strips personal information,
-and saves to csv file. Doesn't perform any other preprocessing.
+and saves to a csv, Parquet or Arrow file (see storage.py). Doesn't perform any other preprocessing.
 
-Main method to use: get_emails
+The date of the most recent email read from each mailbox is kept in INGEST_STATE_FILE. With INCREMENTAL,
+only emails sent after that date are read, and their conversations are added to the previous dump.
+The digests of the unscrubbed message bodies are saved next to the dump, to find the saved conversations
+that a new email made longer.
+
+Main methods to use: get_emails, get_new_emails
 """
 import re as re
 import os
-import win32com.client as client
+import json
 import pandas as pd
-import scrubadub, scrubadub_spacy
 import warnings
 from tqdm.auto import tqdm
+from collections import deque
 from datetime import datetime
 from mailparser_reply import EmailReplyParser
-import dateparser
-from typing import List, Tuple, Dict, Any, Optional
+from typing import List, Tuple, Dict, Any, Optional, Iterator, Set
 from shared_defns import *
 import quotequail
 import configparser
+from scrubbing import ScrubPool, ScrubCache
+from mail_snapshot import MailSnapshot, RawMessage
+from reply_headers import ReplyHeaderParser
+from dedup import DedupIndex
+from storage import write_table, read_table, table_exists, stage_path, FORMAT
+from instrumentation import run, timer, count, add_counts
 
 ubc_internal_addresses = internal_address_regex = None
 
@@ -29,6 +39,15 @@ ADVISING_INBOX_NAME = config['download_emails']['ADVISING_INBOX_NAME']
 ADVISING_NAME = config['download_emails']['ADVISING_NAME']
 ADVISING_ADDRESS = config['download_emails']['ADVISING_ADDRESS']
 SAVE_INTERVAL = int(config['download_emails']['SAVE_INTERVAL'])
+SCRUB_WORKERS = int(config['download_emails']['SCRUB_WORKERS'])
+SCRUB_BATCH_SIZE = int(config['download_emails']['SCRUB_BATCH_SIZE'])
+SCRUB_CACHE_SIZE = int(config['download_emails']['SCRUB_CACHE_SIZE'])
+HEADER_CACHE_SIZE = int(config['download_emails']['HEADER_CACHE_SIZE'])
+DEDUP_MODE = config['download_emails']['DEDUP_MODE']
+NEAR_DUPLICATE_THRESHOLD = float(config['download_emails']['NEAR_DUPLICATE_THRESHOLD'])
+DEDUP_WINDOW = int(config['download_emails']['DEDUP_WINDOW'])
+MODE = config['download_emails']['MODE']
+INCREMENTAL = eval(config['download_emails']['INCREMENTAL'])
 MAIL_ITEM_CLASS = 43
 
 # Suppress PytzUsageWarning, caused by pywin32
@@ -37,46 +56,41 @@ warnings.filterwarnings(
     message="The localize method is no longer necessary, as this time zone supports the fold attribute",
 )
 
-# Initialize the data scrubber
-class StudentInfoFilth(scrubadub.filth.Filth):
-    type = 'student-info'
-
-@scrubadub.detectors.register_detector
-class StudentIDDetector(scrubadub.detectors.RegexDetector):
-    """
-    Filth detector for scrubadub, finds student ids
-    Likely to cause some false positives
-    """
-    autoload = True
-    name = 'student-id'
-    regex = re.compile("(\D|\A)(\d{8}|\d{4}-\d{4}|\d{4}\s\d{4})(\D|\Z)")
-    filth_cls = StudentInfoFilth
-    
-scrubber = scrubadub.Scrubber() # Includes all default detectors: email, phone, etc.
-scrubber.remove_detector('url') # Don't scrub urls, they may be useful
-scrubber._detectors["email"].at_matcher = "@" # Make the email scrubber more strict, otherwise we get false positives
-scrubber.add_detector(scrubadub.detectors.DateOfBirthDetector)
-person_name_detector = scrubadub_spacy.detectors.spacy.SpacyEntityDetector(named_entities=['PERSON'])
-scrubber.add_detector(person_name_detector)
+# Parsers of the message bodies, shared by all messages
+reply_parser = EmailReplyParser(languages=['en'])
+header_parser = ReplyHeaderParser(HEADER_CACHE_SIZE)
 
 # Repository for parsed messages
 class Messages:
     conversations: Dict[int, List[Dict]]
     conv_id: int
     prev_loaded_dates: Tuple[int,int]
-    first_msg_dict: Dict[str, Dict]
-
-    def __init__(self) -> None:
+    dedup_index: DedupIndex
+    scrub_pool: ScrubPool
+    scrubbed_idx: int
+    unscrubbed_ids: deque
+    checkpointed_idx: int
+    checkpointed_ids: Set[int]
+    removed_ids: List[int]
+
+    def __init__(self, scrub_pool: ScrubPool) -> None:
         self.conversations = {}
         self.conv_idx = -1
         self.prev_loaded_dates = None
-        self.first_msg_dict = {}
+        self.dedup_index = DedupIndex(DEDUP_MODE == 'minhash', NEAR_DUPLICATE_THRESHOLD)
+        self.scrub_pool = scrub_pool
+        self.scrubbed_idx = -1
+        self.unscrubbed_ids = deque()
+        self.checkpointed_idx = -1
+        self.checkpointed_ids = set()
+        self.removed_ids = []
 
     def new_conversation(self):
         """
         Start a new conversation
         Future calls to add_message will append messages to this conversation
         """
+        self.finish_conversation()
         self.conv_idx += 1
         self.conversations[self.conv_idx] = []
         
@@ -89,77 +103,232 @@ class Messages:
         if (not subject or subject.strip() == '') and (not body or body.strip() == ''):
             return # skip the empty message
 
-        conv_dict = self.first_msg_dict
-        if body in conv_dict:
+        # Duplicates are found by a digest of the unscrubbed body, see dedup.py
+        with timer('deduplicate'):
+            fingerprint = self.dedup_index.fingerprint(body or '')
+            seen = self.dedup_index.find(fingerprint)
+        length = len(self.conversations[self.conv_idx])
+        if seen is not None and self.dedup_index[seen].conversation != self.conv_idx:
             # This message has already been seen
-            if len(self.conversations[self.conv_idx]) > conv_dict[body]['len']:
+            if length > self.dedup_index[seen].length:
                 # This conversation is longer, keep it and discard the other
-                del self.conversations[conv_dict[body]['id']]
-                conv_dict[body] = {'id': self.conv_idx, 'len': len(self.conversations[self.conv_idx])}
+                self.remove_conversation(self.dedup_index[seen].conversation)
+                count('replaced_conversations')
+                self.dedup_index.replace(seen, self.conv_idx, length)
             else:
                 # The other conversation is longer, keep that one
                 if self.conv_idx in self.conversations:
-                    self.conversations.pop(self.conv_idx)
+                    self.remove_conversation(self.conv_idx)
+                count('duplicate_conversations')
                 return False
-        else:
-            # The first message of this conversation has never been seen
-            conv_dict[body] = {'id': self.conv_idx, 'len': len(self.conversations[self.conv_idx])}
+        self.dedup_index.add(fingerprint, self.conv_idx, length)
         
+        # Messages are scrubbed once the conversation is complete, see finish_conversation
         self.conversations[self.conv_idx].insert(0, {
-            'body': scrubber.clean(body.strip()) if body else None,
-            'header': scrubber.clean(subject.strip()) if subject else None,
+            'digest': fingerprint.digest,
+            'body': body.strip() if body else None,
+            'header': subject.strip() if subject else None,
             'date': date,
             'from': _from,
             'to': to,
             'folder_path': folder_path})
         
         return True
+
+    def remove_conversation(self, conv_id: int):
+        """
+        Discard a conversation, remembering to remove it from the checkpoint if it was already saved
+        The conversation may be one of a previous dump that was not loaded, see read_previous_dump
+        """
+        self.conversations.pop(conv_id, None)
+        if conv_id in self.checkpointed_ids:
+            self.checkpointed_ids.remove(conv_id)
+            self.removed_ids.append(conv_id)
+
+    def finish_conversation(self):
+        """
+        Queue the current conversation to be scrubbed
+        Conversations wait for the next DEDUP_WINDOW conversations before they are sent to be scrubbed,
+        so a conversation replaced by a longer copy shortly after is discarded before it is scrubbed
+        """
+        if self.conv_idx > self.scrubbed_idx and self.conv_idx in self.conversations:
+            self.unscrubbed_ids.append(self.conv_idx)
+        self.scrubbed_idx = self.conv_idx
+        while len(self.unscrubbed_ids) > DEDUP_WINDOW:
+            self.scrub_conversation(self.unscrubbed_ids.popleft())
+
+    def scrub_conversation(self, conv_id: int):
+        """
+        Send the messages of a conversation to be scrubbed
+        Duplicate conversations that were already discarded are never scrubbed
+        """
+        if conv_id in self.conversations:
+            with timer('scrub'):
+                self.scrub_pool.submit(self.conversations[conv_id])
+
+    def finish_scrubbing(self):
+        """
+        Wait until every message added so far has been scrubbed
+        """
+        self.finish_conversation()
+        while self.unscrubbed_ids:
+            self.scrub_conversation(self.unscrubbed_ids.popleft())
+        with timer('scrub'):
+            self.scrub_pool.flush()
         
     def get_loaded_date_range(self) -> Optional[Tuple[int,int]]:
         """
-        If a previous email csv was loaded, returns a tuple of the minimum
+        If a previous email dump was loaded, returns a tuple of the minimum
         and maximum date that was loaded
         """
         return self.prev_loaded_dates
     
     def read_from_file(self, filepath: str):
         """
-        Reads messages from a previously saved csv file
+        Reads messages from a previously saved file, in the configured format or as csv
         Useful for continuing an incomplete email dump
         """
-        df = pd.read_csv(filepath)
+        df = read_table(filepath, file_format=FORMAT if table_exists(filepath) else 'csv')
+        df = df.astype(object).where(df.notna(), None)
+        digests = read_digests(filepath)
+
+        for row in df.to_dict('records'):
+            self.conversations.setdefault(row['conversation'], []).append({
+                'digest': digests.get((row['conversation'], row['turn'])),
+                'body': row['body'],
+                'header': row['header'],
+                'date': row['date'].to_pydatetime() if row['date'] else None,
+                'from': EmailAddress(row['from']),
+                'to': EmailAddress(row['to']),
+                'folder_path': row['folder_path']
+            })
 
-        df['date'] = df[~df['date'].isna()]['date'].apply(lambda x: datetime.strptime(x, DATE_FORMAT))
+        self.conv_idx = self.scrubbed_idx = max(self.conversations, default=-1)
+        self.index_conversations()
+        self.update_loaded_date_range()
 
-        for row in df.itertuples():
-            if row.conversation >= len(self.conversations):
-                self.conversations.append([])
+    def read_previous_dump(self, filepath: str):
+        """
+        Prepares to add new conversations to a previously saved file, without loading its messages
+        Only the conversation ids and the message bodies are read, to find duplicates of the saved
+        conversations. New conversations are numbered after the saved ones.
+        The saved bodies are scrubbed, so the digests of the unscrubbed bodies saved with the file are
+        used to find them (see read_digests), and the scrubbed bodies only for files saved without them.
+        """
+        df = read_table(filepath, columns=['conversation','turn','body'], file_format=FORMAT if table_exists(filepath) else 'csv')
+        digests = read_digests(filepath)
 
-            self.conversations[row.conversation].append({
-                'body': row.body,
-                'header': row.header,
-                'date': row.date,
-                'from': row._7,
-                'to': row.to,
-                'folder_path': row.folder_path
-            })
+        # Messages of a conversation are added most recent first, as in add_message
+        added_before = df.groupby('conversation')['turn'].transform('size') - 1 - df['turn']
+        for conv_id, turn, body, length in zip(df['conversation'].tolist(), df['turn'].tolist(), df['body'].tolist(), added_before.tolist()):
+            digest = digests.get((conv_id, turn))
+            if digest or isinstance(body, str):
+                self.dedup_index.add(self.dedup_index.fingerprint(body if isinstance(body, str) else '', digest), conv_id, length)
 
-        dates = df[(~df['date'].isna()) & (df['turn'].isin([0]))]['date']
-        min_date = min(dates)
-        max_date = max(dates)
-        self.prev_loaded_dates = (min_date,max_date)
+        self.conv_idx = self.scrubbed_idx = self.checkpointed_idx = int(df['conversation'].max()) if df.shape[0] else -1
+        self.checkpointed_ids = set(df['conversation'].tolist())
 
-    def save_to_file(self, filepath: str):
+    def index_conversations(self):
+        """
+        Adds the messages of the loaded conversations to the dedup index
+        The digests of the unscrubbed bodies are used when known, the scrubbed bodies otherwise
+        """
+        for conv_id, conversation in self.conversations.items():
+            for i, message in enumerate(conversation):
+                fingerprint = self.dedup_index.fingerprint(message['body'] or '', message.get('digest'))
+                self.dedup_index.add(fingerprint, conv_id, len(conversation) - 1 - i)
+
+    def update_loaded_date_range(self):
+        """
+        Sets the range of dates the loaded conversations were sent on
+        The sent message is the last message of each conversation
+        """
+        dates = [conversation[-1]['date'].replace(tzinfo=None) for conversation in self.conversations.values()
+                 if conversation and conversation[-1]['date']]
+        if dates:
+            self.prev_loaded_dates = (min(dates),max(dates))
+
+    def checkpoint(self, filepath: str):
+        """
+        Appends the conversations added or removed since the last checkpoint to a checkpoint log
+        Only the changes are written, so the cost of each checkpoint doesn't grow with the size of the dump
+        Conversations still waiting in the dedup window (see finish_conversation) are written by a later
+        checkpoint, call finish_scrubbing first to write every conversation
+        """
+        # Only the conversations sent to be scrubbed are written, never unscrubbed text
+        ready_idx = self.unscrubbed_ids[0] - 1 if self.unscrubbed_ids else self.scrubbed_idx
+        ready_ids = [conv_id for conv_id in range(self.checkpointed_idx + 1, ready_idx + 1) if conv_id in self.conversations]
+        with timer('scrub'):
+            self.scrub_pool.wait_for([message for conv_id in ready_ids for message in self.conversations[conv_id]])
+
+        lines = [json.dumps({'removed': conv_id}) for conv_id in self.removed_ids]
+        for conv_id in ready_ids:
+            lines.append(json.dumps({
+                'conversation': conv_id,
+                'digests': [message['digest'].hex() if message.get('digest') else None for message in self.conversations[conv_id]],
+                'messages': [{
+                    'body': message['body'],
+                    'header': message['header'],
+                    'date': message['date'].isoformat() if message['date'] else None,
+                    'from': int(message['from']),
+                    'to': int(message['to']),
+                    'folder_path': message['folder_path']} for message in self.conversations[conv_id]]
+            }))
+
+        def writer():
+            with open(filepath, 'a', encoding='utf-8') as file:
+                file.writelines(line + '\n' for line in lines)
+                file.flush()
+                os.fsync(file.fileno())
+
+        write_file(writer)
+        self.checkpointed_ids.update(ready_ids)
+        self.checkpointed_idx = max(self.checkpointed_idx, ready_idx)
+        self.removed_ids = []
+
+    def read_checkpoint(self, filepath: str):
         """
-        Saves the conversations to a csv
+        Rebuilds the conversations from a checkpoint log
+        Useful for continuing an incomplete email dump
+        """
+        with open(filepath, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break # the last line may be incomplete if the previous run was interrupted
+
+                if 'removed' in entry:
+                    self.conversations.pop(entry['removed'], None)
+                    continue
+
+                digests = entry.get('digests') or [None] * len(entry['messages'])
+                self.conversations[entry['conversation']] = [{
+                    'digest': bytes.fromhex(digest) if digest else None,
+                    'body': message['body'],
+                    'header': message['header'],
+                    'date': datetime.fromisoformat(message['date']) if message['date'] else None,
+                    'from': EmailAddress(message['from']),
+                    'to': EmailAddress(message['to']),
+                    'folder_path': message['folder_path']} for message, digest in zip(entry['messages'], digests)]
+                self.conv_idx = max(self.conv_idx, entry['conversation'])
+
+        self.scrubbed_idx = self.checkpointed_idx = self.conv_idx
+        self.checkpointed_ids = set(self.conversations)
+        self.index_conversations()
+        self.update_loaded_date_range()
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        One row for each message of the conversations, with naive dates
         """
         df_list = []
+        self.finish_scrubbing() # never write unscrubbed text to disk
 
-        print("Saving to csv...")
         for (conversation_id,conversation) in tqdm(self.conversations.items()):
             turn_idx = 0
             for message in conversation:
-                date = message['date'].strftime(DATE_FORMAT) if message['date'] else None
+                date = message['date'].replace(tzinfo=None) if message['date'] else None
                 df_list.append({
                     'conversation': conversation_id,
                     'turn': turn_idx,
@@ -170,13 +339,57 @@ class Messages:
                     'to': int(message['to']),
                     'folder_path': message['folder_path']})
                 turn_idx += 1
-        
-        df = pd.DataFrame.from_dict(df_list)
+
+        return pd.DataFrame.from_dict(df_list)
+
+    def digests_dataframe(self) -> pd.DataFrame:
+        """
+        The digest of the unscrubbed body of each message of the conversations, see read_digests
+        """
+        return pd.DataFrame([{'conversation': conversation_id, 'turn': turn,
+                              'digest': message['digest'].hex() if message.get('digest') else None}
+                             for conversation_id, conversation in self.conversations.items()
+                             for turn, message in enumerate(conversation)], columns=['conversation', 'turn', 'digest'])
+
+    def save_to_file(self, filepath: str):
+        """
+        Saves all conversations to a file, in the format set in the config
+        This rewrites the whole file, use checkpoint to periodically save progress
+        The digests of the unscrubbed bodies are saved next to it, see read_digests
+        """
+        print(f"Saving to {stage_path(filepath)}...")
+        df = self.to_dataframe()
+        digests = self.digests_dataframe()
         def writer():
-            df.to_csv(filepath,encoding=ENCODING)
+            write_table(df, filepath)
+            write_table(digests, digests_path(filepath), export_csv=False)
 
         write_file(writer)
-        print(f"Finished, saved {len(df_list)} emails to csv.")
+        print(f"Finished, saved {df.shape[0]} emails.")
+
+    def append_to_file(self, filepath: str):
+        """
+        Adds the conversations to a previously saved file, see read_previous_dump
+        Saved conversations that were replaced by a longer copy are removed from the file
+        """
+        new_df = self.to_dataframe()
+        df = read_table(filepath, file_format=FORMAT if table_exists(filepath) else 'csv')
+        df = df[~df['conversation'].isin(self.removed_ids)]
+        if new_df.shape[0]:
+            df = pd.concat([df, new_df], ignore_index=True)
+
+        digests = self.digests_dataframe()
+        if table_exists(digests_path(filepath)):
+            saved = read_table(digests_path(filepath))
+            digests = pd.concat([saved[~saved['conversation'].isin(self.removed_ids)], digests], ignore_index=True)
+
+        print(f"Saving to {stage_path(filepath)}...")
+        def writer():
+            write_table(df, filepath)
+            write_table(digests, digests_path(filepath), export_csv=False)
+
+        write_file(writer)
+        print(f"Finished, added {new_df.shape[0]} emails and removed {len(self.removed_ids)} replaced conversations.")
         
     def remove_duplicate_conversations(self):
         """
@@ -184,33 +397,51 @@ class Messages:
         
         Since one conversation is created for every sent email, there may be duplicates if advisors
         send more one one message in the chain.
-        If any pair of conversations has the first initial message, the shorter conversation chain
-        will be discarded.
+        If any pair of conversations has the same first message (or a near duplicate, see DEDUP_MODE),
+        the shorter conversation chain will be discarded.
         """
-        ids_to_discard = []
-        conv_dict = {}
+        ids_to_discard = set()
+        index = DedupIndex(DEDUP_MODE == 'minhash', NEAR_DUPLICATE_THRESHOLD)
         
         print(f"Removing duplicate conversations")
-        for id, conversation in enumerate(self.conversations):
-            first_msg = conversation[0]['body']
+        for conv_id, conversation in self.conversations.items():
+            if not conversation: continue
+            first_msg = conversation[0]
+            fingerprint = index.fingerprint(first_msg['body'] or '', first_msg.get('digest'))
+            seen = index.find(fingerprint)
             
-            if first_msg in conv_dict:
+            if seen is not None:
                 # The first message of this conversation has already been seen
-                if len(conversation) > conv_dict[first_msg]['len']:
+                if len(conversation) > index[seen].length:
                     # This conversation is longer, keep it and discard the other
-                    ids_to_discard.append(conv_dict[first_msg]['id'])
-                    conv_dict[first_msg] = {'id': id, 'len': len(conversation)}
+                    ids_to_discard.add(index[seen].conversation)
+                    index.replace(seen, conv_id, len(conversation))
                 else:
                     # The other conversation is longer, keep this one
-                    ids_to_discard.append(id)
-            else:
-                # The first message of this conversation has never been seen
-                conv_dict[first_msg] = {'id': id, 'len': len(conversation)}
+                    ids_to_discard.add(conv_id)
+                    continue
+            index.add(fingerprint, conv_id, len(conversation))
                 
-        self.conversations = [j for i,j in enumerate(self.conversations) if i not in ids_to_discard]
-            
-        print(f"Removed {len(ids_to_discard)} duplicate conversations")
-            
+        for conv_id in ids_to_discard:
+            self.remove_conversation(conv_id)
+
+def digests_path(filepath: str) -> str:
+    """
+    Path of the file with the digests of the unscrubbed bodies of the dump at filepath
+    """
+    name, extension = os.path.splitext(filepath)
+    return name + '_digests' + extension
+
+def read_digests(filepath: str) -> Dict[Tuple[int,int], bytes]:
+    """
+    The digest of the unscrubbed body of each (conversation, turn) of the dump at filepath
+    Duplicates of saved messages are found by these digests, as the saved bodies are scrubbed.
+    Empty for dumps saved before the digests were kept.
+    """
+    if not table_exists(digests_path(filepath)): return {}
+    df = read_table(digests_path(filepath)).dropna(subset=['digest'])
+    return {(conv_id, turn): bytes.fromhex(digest)
+            for conv_id, turn, digest in zip(df['conversation'].tolist(), df['turn'].tolist(), df['digest'].tolist())}
 
 def get_email_type(email_line: str) -> EmailAddress:
     """
@@ -258,21 +489,38 @@ def create_domain_set(message_list):
     for domain in domain_set:
         print(domain)
 
-def handle_sent_message(message: Any, messages: Messages):
+def read_raw_message(message: Any) -> RawMessage:
     """
-    Add the relevant information for an Outlook COM message to the repository
-    Creates separate messages in the same conversation for any replies in this message body
+    Read the fields needed for processing from an Outlook COM message
     """
-    if message.Class != MAIL_ITEM_CLASS: return # skip a non-mail item
+    with timer('read_message'):
+        return RawMessage(message.EntryID, message.SentOn, message.Subject, message.Body, get_recipient_address(message))
 
+def iter_outlook_messages(message_list: Any) -> Iterator[RawMessage]:
+    """
+    Iterate over the mail items of an Outlook COM item list
+    """
+    current_message = message_list.GetFirst()
+    while current_message:
+        if current_message.Class == MAIL_ITEM_CLASS: # skip a non-mail item
+            yield read_raw_message(current_message)
+        else:
+            yield None
+        current_message = message_list.GetNext()
+
+def handle_sent_message(message: RawMessage, messages: Messages):
+    """
+    Add the relevant information for a sent message to the repository
+    Creates separate messages in the same conversation for any replies in this message body
+    """
     # Split the email into replies
     messages.new_conversation()
-    parsed_email = EmailReplyParser(languages=['en']).read(message.Body)
+    with timer('split_replies'):
+        parsed_email = reply_parser.read(message.body)
 
     # Add the most recent message
-    recipient_addr = get_recipient_address(message)
-    add_msg_result = messages.add_message(message.SentOn, EmailAddress.ADVISING, 
-                         get_email_type(recipient_addr), message.Subject, parsed_email.replies[0].body, 'Sent Items')
+    add_msg_result = messages.add_message(message.sent_on, EmailAddress.ADVISING, 
+                         get_email_type(message.recipient_address), message.subject, parsed_email.replies[0].body, 'Sent Items')
     
     if not add_msg_result:
         # This is a duplicate converation, we can skip replies
@@ -284,7 +532,8 @@ def handle_sent_message(message: Any, messages: Messages):
         try:
             # Check if there are any quotes to remove from the text
             body = ""
-            quote_unwrapped = quotequail.unwrap(reply.body)
+            with timer('unwrap_quotes'):
+                quote_unwrapped = quotequail.unwrap(reply.body)
             if quote_unwrapped and quote_unwrapped["type"] == "quote":
                 if "text_top" in quote_unwrapped:
                     body = quote_unwrapped["text_top"]
@@ -297,80 +546,257 @@ def handle_sent_message(message: Any, messages: Messages):
             # Attempt to extract information from headers
             reply.headers = reply.headers.encode('ascii', 'ignore').decode('ascii') # remove unicode characters
             
-            if 'wrote:' in reply.headers:
-                (date_text, date) = dateparser.search.search_dates(reply.headers, settings={'RETURN_AS_TIMEZONE_AWARE': True})[0]
-                from_text = re.search(f'(?<={re.escape(date_text)})(.|\n)*(?=wrote:)',reply.headers).group()
-                add_msg_result = messages.add_message(date, get_email_type(from_text), get_email_type(None), '', body, 'Sent Items')
-            else:
-                from_line = to_line = date = subject = None
-                if match := re.search('From:?.*',reply.headers): from_line = match.group()
-                if match := re.search('(To|Cc):?.*',reply.headers): to_line = match.group()
-                if match := re.search('((?<=Sent: )|(?<=Sent )|(?<=Date: )|(?<=Date )).*',reply.headers):
-                    date = dateparser.parse(match.group(), settings={'RETURN_AS_TIMEZONE_AWARE': True})
-                elif dates := dateparser.search.search_dates(reply.headers, settings={'RETURN_AS_TIMEZONE_AWARE': True}):
-                    (_, date) = dates[0]
-                if match := re.search('((?<=Subject: )|(?<=Subject ))(.|\n)*',reply.headers): subject = match.group()
-                add_msg_result = messages.add_message(date, get_email_type(from_line), get_email_type(to_line), subject, body, 'Sent Items')
+            with timer('parse_reply_headers'):
+                header = header_parser.parse(reply.headers)
+            add_msg_result = messages.add_message(header.date, get_email_type(header.from_text), get_email_type(header.to_text),
+                                                  header.subject, body, 'Sent Items')
             if not add_msg_result:
                 # This is a duplicate converation, we can skip replies
                 return
         except:
-            print(f'Could not parse email reply headers for "{message.Subject}"')
+            print(f'Could not parse email reply headers for "{message.subject}"')
 
-def parse_emails(output_path: str, outlook_folder: Any, messages: Messages):
+def get_outlook_folder(advising_inbox_name: str, send_folder: str) -> Any:
     """
-    For every email in the given outlook folder, add all messages to the Messages repository
-    Will split out replies in all messages, so best to use just the sent folder.
+    Find the given folder of the mailbox in the local Outlook application
+    """
+    import win32com.client as client # only available on Windows, not needed to process a snapshot
+
+    outlook = client.Dispatch("Outlook.Application").GetNamespace("MAPI")
+    try:
+        return outlook.Folders[advising_inbox_name].Folders[send_folder]
+    except:
+        print(f"Couldn't find the folder named {send_folder}, cancelling operation")
+        return None
+
+def get_outlook_messages(outlook_folder: Any, messages: Messages, after: Optional[datetime]=None) -> Tuple[Iterator[RawMessage], int]:
+    """
+    Get the messages from the outlook folder, most recent first, and the number of messages
+    Skips the date range that was already loaded, if continuing a previous dump
+    If after is given, only gets the messages sent after that (naive) date
     """
     message_list = outlook_folder.Items
     message_list.Sort('[SentOn]',True)
 
-    if dates := messages.get_loaded_date_range():
+    if after:
+        # The filter only has minute precision, messages of the same minute are skipped in messages_after
+        message_list = message_list.Restrict(f"[SentOn] >= '{after.strftime(FILTER_DATE_FORMAT)}'")
+        return messages_after(iter_outlook_messages(message_list), after), message_list.Count
+    elif dates := messages.get_loaded_date_range():
         filter = f"[SentOn] < '{dates[0].strftime(FILTER_DATE_FORMAT)}' Or [SentOn] > '{dates[1].strftime(FILTER_DATE_FORMAT)}'"
         message_list = message_list.Restrict(filter) 
 
-    current_message = message_list.GetFirst()
+    return iter_outlook_messages(message_list), message_list.Count
+
+def messages_after(raw_messages: Iterator[RawMessage], after: datetime) -> Iterator[RawMessage]:
+    """
+    Skips the messages sent on or before the given (naive) date
+    """
+    for raw_message in raw_messages:
+        if raw_message and raw_message.sent_on and raw_message.sent_on.replace(tzinfo=None) <= after:
+            continue
+        yield raw_message
+
+def parse_emails(checkpoint_path: Optional[str], raw_messages: Iterator[RawMessage], total: int, messages: Messages) -> Optional[datetime]:
+    """
+    For every given email, add all messages to the Messages repository
+    Will split out replies in all messages, so best to use just the sent folder.
+    Progress is periodically appended to the checkpoint log at checkpoint_path, if given
+    Returns the (naive) date of the most recently sent email
+    """
     counter = 0
-    with tqdm(total=message_list.Count) as pbar:
-        while current_message:
-            handle_sent_message(current_message, messages)
-            current_message = message_list.GetNext()
+    latest = None
+    with timer('parse_emails') as parse_timer, tqdm(total=total) as pbar:
+        for raw_message in raw_messages:
+            if raw_message:
+                handle_sent_message(raw_message, messages)
+                if raw_message.sent_on and (latest is None or raw_message.sent_on.replace(tzinfo=None) > latest):
+                    latest = raw_message.sent_on.replace(tzinfo=None)
             pbar.update(1)
             counter += 1
-            if counter % SAVE_INTERVAL == 0:
-                messages.save_to_file(output_path) # periodically save progress
+            parse_timer.items = counter
+            if checkpoint_path and counter % SAVE_INTERVAL == 0:
+                with timer('checkpoint'):
+                    messages.checkpoint(checkpoint_path) # periodically save progress
+    print(header_parser.report())
+    add_counts(header_parser.counts, 'reply_headers_')
+    return latest
+
+def mailbox_name(advising_inbox_name: str, send_folder: str) -> str:
+    return f"{advising_inbox_name}/{send_folder}"
+
+def read_ingest_state(filepath: str) -> Dict[str, datetime]:
+    """
+    Reads the date of the most recent email read from each mailbox
+    """
+    if not os.path.exists(filepath): return {}
+    with open(filepath) as file:
+        return {mailbox: datetime.fromisoformat(date) for mailbox, date in json.load(file)['mailboxes'].items()}
 
-def get_emails(output_path, advising_inbox_name=ADVISING_INBOX_NAME, send_folder='Sent Items'):
+def last_saved_date(output_path: str, checkpoint_path: str) -> datetime:
+    """
+    Date of the most recent email of a dump saved before INGEST_STATE_FILE was used
+    The dates of csv files have no AM/PM (see DATE_FORMAT), so the dates of the checkpoint log are used
+    instead if there is one. Otherwise the date may be up to 12 hours early, and those emails are read again.
+    """
+    if FORMAT != 'csv' and table_exists(output_path):
+        return read_table(output_path, columns=['date'])['date'].max().to_pydatetime()
+
+    latest = None
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break # the last line may be incomplete if the previous run was interrupted
+                for message in entry.get('messages', []):
+                    if message['date']:
+                        date = datetime.fromisoformat(message['date']).replace(tzinfo=None)
+                        latest = max(latest, date) if latest else date
+    if latest: return latest
+
+    print("Reading the date of the most recent email from the csv dump, which has no AM/PM, so up to 12 hours of emails may be read again")
+    return read_table(output_path, columns=['date'], file_format=FORMAT if table_exists(output_path) else 'csv')['date'].max().to_pydatetime()
+
+def write_ingest_state(filepath: str, mailbox: str, latest: Optional[datetime]):
+    """
+    Saves the date of the most recent email read from a mailbox, keeping the dates of the other mailboxes
+    """
+    if latest is None: return
+    state = read_ingest_state(filepath)
+    state[mailbox] = max(latest, state.get(mailbox, latest))
+
+    # Write to a temporary file first, so an interruption can't leave a partial state file
+    with open(filepath + '.tmp', 'w') as file:
+        json.dump({'mailboxes': {name: date.isoformat() for name, date in state.items()}}, file, indent=1)
+    os.replace(filepath + '.tmp', filepath)
+
+@run('download_emails')
+def get_emails(output_path, checkpoint_path, snapshot_path, cache_path, state_path, advising_inbox_name=ADVISING_INBOX_NAME, send_folder='Sent Items', from_snapshot=False):
     """
     Gets and cleans all emails from the sent folder
+    If from_snapshot is set, the emails are read from a previously saved snapshot instead of Outlook
+    Scrubbed texts are cached in the file at cache_path, so texts seen in previous runs are not scrubbed again
+    Progress is saved to the checkpoint log while running, and the output file is written once at the end
+    The date of the most recent email is saved to the file at state_path, see get_new_emails
     """
-    outlook = client.Dispatch("Outlook.Application").GetNamespace("MAPI")
-    messages = Messages()
-
-    if os.path.exists(output_path):
-        print(f"The file {output_path} already exists")
-        response = input(f"Do you want to overwrite it (o), or continue an incomplete email dump (c)? (q to quit) <o/c> ")
-        if response.lower() == 'o':
-            pass
-        elif response.lower() == 'c':
-            messages.read_from_file(output_path)
-        else: return
-
-    print("Getting messages..")
-    folder = None
-    try:
-        folder = outlook.Folders[advising_inbox_name].Folders[send_folder]
-    except:
-        print(f"Couldn't find the folder named {send_folder}, cancelling operation")
+    with ScrubPool(SCRUB_WORKERS, SCRUB_BATCH_SIZE, ScrubCache(cache_path, SCRUB_CACHE_SIZE)) as scrub_pool:
+        messages = Messages(scrub_pool)
+
+        previous_output = table_exists(output_path) or table_exists(output_path, 'csv')
+        if os.path.exists(checkpoint_path) or previous_output:
+            print(f"A previous email dump already exists at {checkpoint_path if os.path.exists(checkpoint_path) else output_path}")
+            response = input(f"Do you want to overwrite it (o), or continue an incomplete email dump (c)? (q to quit) <o/c> ")
+            if response.lower() == 'o':
+                if os.path.exists(checkpoint_path): os.remove(checkpoint_path)
+            elif response.lower() == 'c':
+                if os.path.exists(checkpoint_path):
+                    messages.read_checkpoint(checkpoint_path)
+                else:
+                    messages.read_from_file(output_path) # dump saved before checkpoint logs were used
+                    messages.checkpoint(checkpoint_path)
+            else: return
+
+        print("Getting messages..")
+        snapshot = None
+        if from_snapshot:
+            print(f"Getting messages from snapshot {snapshot_path}")
+            snapshot = MailSnapshot(snapshot_path)
+            raw_messages, total = snapshot.messages(messages.get_loaded_date_range()), len(snapshot)
+        else:
+            folder = get_outlook_folder(advising_inbox_name, send_folder)
+            if not folder: return
+            print(f"Getting messages from folder {send_folder}")
+            raw_messages, total = get_outlook_messages(folder, messages)
+
+        print(f"Scrubbing with {SCRUB_WORKERS} worker processes")
+        latest = parse_emails(checkpoint_path,raw_messages,total,messages)
+        if snapshot: snapshot.close()
+        
+        # print(f"Removing duplicate conversations")
+        # messages.remove_duplicate_conversations()
+
+        messages.finish_scrubbing() # the last conversations are only scrubbed now, see finish_conversation
+        messages.checkpoint(checkpoint_path)
+        messages.save_to_file(output_path)
+
+        # A continued dump already has the emails of the loaded date range
+        if dates := messages.get_loaded_date_range():
+            latest = max(dates[1], latest) if latest else dates[1]
+        write_ingest_state(state_path, mailbox_name(advising_inbox_name, send_folder), latest)
+
+@run('download_emails')
+def get_new_emails(output_path, checkpoint_path, snapshot_path, cache_path, state_path, advising_inbox_name=ADVISING_INBOX_NAME, send_folder='Sent Items', from_snapshot=False):
+    """
+    Gets and cleans the emails sent since the previous run, and adds their conversations to the output file
+    Only the emails sent after the date saved in the file at state_path are read. For a dump saved before the
+    state file was used, the state file is created from the most recent email of the dump, see last_saved_date.
+    A new email in an existing conversation makes a longer copy of the conversation, which replaces the saved one.
+    The checkpoint log of a previous dump is kept up to date if it exists.
+    """
+    if not (table_exists(output_path) or table_exists(output_path, 'csv')):
+        print(f"No previous email dump at {output_path}, get all emails with INCREMENTAL = False first")
         return
 
-    print(f"Getting messages from folder {send_folder}")
-    parse_emails(output_path,folder,messages)
-    
-    # print(f"Removing duplicate conversations")
-    # messages.remove_duplicate_conversations()
+    mailbox = mailbox_name(advising_inbox_name, send_folder)
+    after = read_ingest_state(state_path).get(mailbox)
+    if after is None:
+        # Dump saved before the state file was used, the state file is created so this is only done once
+        after = last_saved_date(output_path, checkpoint_path)
+        write_ingest_state(state_path, mailbox, after)
+    print(f"Getting messages sent after {after}")
+
+    with ScrubPool(SCRUB_WORKERS, SCRUB_BATCH_SIZE, ScrubCache(cache_path, SCRUB_CACHE_SIZE)) as scrub_pool:
+        messages = Messages(scrub_pool)
+        messages.read_previous_dump(output_path)
+
+        snapshot = None
+        if from_snapshot:
+            print(f"Getting messages from snapshot {snapshot_path}")
+            snapshot = MailSnapshot(snapshot_path)
+            raw_messages, total = snapshot.messages(after=after), snapshot.count(after)
+        else:
+            folder = get_outlook_folder(advising_inbox_name, send_folder)
+            if not folder: return
+            print(f"Getting messages from folder {send_folder}")
+            raw_messages, total = get_outlook_messages(folder, messages, after)
+
+        print(f"Scrubbing with {SCRUB_WORKERS} worker processes")
+        latest = parse_emails(None,raw_messages,total,messages)
+        if snapshot: snapshot.close()
+
+        messages.append_to_file(output_path)
+        if os.path.exists(checkpoint_path): messages.checkpoint(checkpoint_path)
+        write_ingest_state(state_path, mailbox, latest)
 
-    messages.save_to_file(output_path)
+@run('snapshot_emails')
+def snapshot_emails(snapshot_path, advising_inbox_name=ADVISING_INBOX_NAME, send_folder='Sent Items'):
+    """
+    Saves the raw contents of all emails in the sent folder to a local snapshot, without processing them
+    Messages already in the snapshot are skipped, so this can be run again to add new emails
+    """
+    folder = get_outlook_folder(advising_inbox_name, send_folder)
+    if not folder: return
+
+    snapshot = MailSnapshot(snapshot_path)
+    message_list = folder.Items
+    current_message = message_list.GetFirst()
+    added = 0
+
+    print(f"Saving messages from folder {send_folder} to {snapshot_path}")
+    with tqdm(total=message_list.Count) as pbar:
+        while current_message:
+            if current_message.Class == MAIL_ITEM_CLASS and current_message.EntryID not in snapshot:
+                snapshot.add(read_raw_message(current_message))
+                added += 1
+                if added % SAVE_INTERVAL == 0:
+                    snapshot.commit() # periodically save progress
+            current_message = message_list.GetNext()
+            pbar.update(1)
+
+    snapshot.close()
+    print(f"Finished, added {added} emails to the snapshot.")
 
 def read_internal_domains(filename):
     """
@@ -384,8 +810,16 @@ def read_internal_domains(filename):
     internal_address_regex = re.compile(f'.*({"|".join(ubc_internal_addresses)})')
         
 def main():
+    snapshot_path = get_filepath(config, 'download_emails', 'SNAPSHOT_FILE')
+    if MODE == 'snapshot':
+        snapshot_emails(snapshot_path)
+        return
+
     read_internal_domains(get_filepath(config, 'download_emails', 'INTERNAL_DOMAINS_FILE'))
-    get_emails(get_filepath(config, 'download_emails', 'OUT_FILE'))
+    get = get_new_emails if INCREMENTAL else get_emails
+    get(get_filepath(config, 'download_emails', 'OUT_FILE'), get_filepath(config, 'download_emails', 'CHECKPOINT_FILE'), snapshot_path,
+        get_filepath(config, 'download_emails', 'SCRUB_CACHE_FILE'), get_filepath(config, 'download_emails', 'INGEST_STATE_FILE'),
+        from_snapshot=(MODE == 'process'))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
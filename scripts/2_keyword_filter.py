@@ -1,72 +1,135 @@
 """
-Basic script to remove irrelevant emails from the emails csv
+Basic script to remove irrelevant emails from the emails file
 Removes emails about forms, applications, etc. that are out of scope
 for the academic calendar question answering system
 """
 
+import re as re
 import pandas as pd
 import configparser
+from typing import List, Callable
 from shared_defns import *
+from storage import read_table, write_table
+from instrumentation import run, timer
+
+try:
+    import ahocorasick # optional, pip install pyahocorasick
+except ImportError:
+    ahocorasick = None
 
 # Constants
 config = configparser.ConfigParser()
 config.read('config.ini')
 ENCODING = config['global']['ENCODING']
-        
-# Load keywords to remove
-body_remove_keywords = header_remove_keywords = []
 
-with open(get_filepath(config, 'keyword_filter', 'BODY_KW_FILE')) as file:
-    body_remove_keywords = [line.rstrip() for line in file]
-    
-with open(get_filepath(config, 'keyword_filter', 'HEADER_KW_FILE')) as file:
-    header_remove_keywords = [line.rstrip() for line in file]
+def read_keywords(filepath: str) -> List[str]:
+    """
+    Reads a keyword file with one keyword per line, skipping blank lines
+    """
+    with open(filepath) as file:
+        return [line.rstrip() for line in file if line.strip()]
+
+def trie_regex(keywords: List[str]) -> str:
+    """
+    Builds a regex matching any of the keywords, with shared prefixes merged as in a trie
+    so the regex engine does not try every keyword at each position of the text
+    """
+    trie = {}
+    for keyword in keywords:
+        node = trie
+        for char in keyword:
+            node = node.setdefault(char, {})
+        node[''] = {}
 
-# Predicates that match emails to remove
-def keyword_in_text(text: str, keywords, lowercase:bool=True):
-    if type(text) != str: return False
-    use_text = text.lower() if lowercase else text
-    return any([keyword in use_text for keyword in keywords])
+    def pattern(node):
+        if '' in node: return '' # a keyword ends here, longer keywords don't change whether the text matches
+        branches = [re.escape(char) + pattern(child) for char, child in sorted(node.items())]
+        return branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
 
-# Matches emails containing header keywords   
-def header_kw(conv_df): return any(conv_df['header'].apply(lambda x: keyword_in_text(x,header_remove_keywords)))
+    return pattern(trie)
 
-# Matches emails containing body keywords
-def body_kw(conv_df): return any(conv_df['body'].apply(lambda x: keyword_in_text(x,body_remove_keywords,lowercase=False)))
+class KeywordMatcher:
+    """
+    Finds the texts that contain any of a list of keywords, scanning each text once
+    Uses an Aho-Corasick automaton if pyahocorasick is installed, otherwise one combined regex
+    """
+    def __init__(self, keywords: List[str], lowercase: bool=True) -> None:
+        self.keywords = keywords
+        self.lowercase = lowercase
+        self.automaton = None
+        if ahocorasick and keywords:
+            self.automaton = ahocorasick.Automaton()
+            for keyword in keywords:
+                self.automaton.add_word(keyword, keyword)
+            self.automaton.make_automaton()
+        self.regex = trie_regex(keywords)
 
-# Matches email conversations that do not include a student
-def no_student_in_convo(conv_df): return not (1 in conv_df['from'].values)
+    def match(self, texts: pd.Series) -> pd.Series:
+        """
+        Returns whether each text contains a keyword, False for missing or non-text values
+        """
+        if not self.keywords or texts.dtype.kind in 'biuf':
+            return pd.Series(False, index=texts.index)
 
-# Matches email conversations that include some sender that is not a student or advisor
-def outside_ubc_in_convo(conv_df): return (3 in conv_df['from'].values)
+        if self.lowercase: texts = texts.str.lower()
+        if self.automaton is not None:
+            return texts.map(lambda text: isinstance(text, str) and next(self.automaton.iter(text), None) is not None).astype(bool)
+        return texts.str.contains(self.regex, regex=True, na=False).astype(bool)
 
-predicates = [header_kw,body_kw,no_student_in_convo,outside_ubc_in_convo]
-    
-def simple_filter(df):
+def make_predicates(header_keywords: List[str], body_keywords: List[str]) -> List[Callable[[pd.DataFrame], pd.Series]]:
+    """
+    Predicates that match conversations to remove
+    Each one takes all emails and returns a flag for every conversation, computed with groupby aggregates
+    """
+    header_matcher = KeywordMatcher(header_keywords)
+    body_matcher = KeywordMatcher(body_keywords, lowercase=False)
+
+    # Matches emails containing header keywords
+    def header_kw(df): return header_matcher.match(df['header']).groupby(df['conversation']).any()
+
+    # Matches emails containing body keywords
+    def body_kw(df): return body_matcher.match(df['body']).groupby(df['conversation']).any()
+
+    # Matches email conversations that do not include a student
+    def no_student_in_convo(df): return ~(df['from'] == EmailAddress.STUDENT).groupby(df['conversation']).any()
+
+    # Matches email conversations that include some sender that is not a student or advisor
+    def outside_ubc_in_convo(df): return (df['from'] == EmailAddress.INTERNAL).groupby(df['conversation']).any()
+
+    return [header_kw,body_kw,no_student_in_convo,outside_ubc_in_convo]
+
+def simple_filter(df, predicates):
     """
     Performs a simple filter function to remove unwanted conversations from the dataset
+    Prints how many conversations each predicate removed, counting each conversation for the first predicate that matched it
     """
-    remove_convo_ids = []
-    
-    for conversation,conv_df in df.groupby('conversation'):
-        for predicate in predicates:
-            if predicate(conv_df):
-                remove_convo_ids.append(conversation)
-                break
-            
-    filtered_df = df[~df['conversation'].isin(remove_convo_ids)]
+    flags = {}
+    for predicate in predicates:
+        with timer(predicate.__name__, items=df.shape[0]):
+            flags[predicate.__name__] = predicate(df)
+    flags = pd.DataFrame(flags)
+    remove = flags.any(axis=1)
+    first_match = flags.values.argmax(axis=1)
+
+    for i, name in enumerate(flags.columns):
+        print(f"{name}: removed {int((remove.values & (first_match == i)).sum())} conversations")
+
+    filtered_df = df[~df['conversation'].isin(flags.index[remove])]
     return filtered_df
-     
+
+@run('keyword_filter')
 def main():
     if eval(config['keyword_filter']['ENABLED']):
         in_path = get_filepath(config, 'download_emails', 'OUT_FILE')
         out_path = get_filepath(config, 'keyword_filter', 'OUT_FILE')
-        df = pd.read_csv(in_path,index_col=0,encoding=ENCODING)
-        df_filtered = simple_filter(df)
-        df_filtered.to_csv(out_path,encoding=ENCODING)
+        predicates = make_predicates(read_keywords(get_filepath(config, 'keyword_filter', 'HEADER_KW_FILE')),
+                                     read_keywords(get_filepath(config, 'keyword_filter', 'BODY_KW_FILE')))
+        df = read_table(in_path)
+        df_filtered = simple_filter(df, predicates)
+        write_table(df_filtered, out_path)
         print(f"Done removing emails by kw, removed {df.shape[0] - df_filtered.shape[0]} entries")
     else:
         print("Removing emails by kw is disabled")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,50 +1,71 @@
+import numpy as np
 import pandas as pd
 import configparser
-from tqdm import tqdm 
 from shared_defns import *
+from storage import read_table, write_table
+from instrumentation import run, timer
 
 # Constants
 config = configparser.ConfigParser()
 config.read('config.ini')
 ENCODING = config['global']['ENCODING']
         
+def make_pairs(emails_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Convert conversations to question-answer pairs
+    Only conversations started by a student are used, and only student and advising emails with a body.
+    A new turn starts at each student email that follows an advising email, and each turn is paired
+    as its last student email and its last advising email.
+    """
+    emails_df = emails_df[emails_df['conversation'].notna()]
+    emails_df = emails_df.iloc[np.argsort(emails_df['conversation'].values, kind='stable')]
+    conversation = emails_df['conversation'].values
+    sender = emails_df['from'].values
+    body = emails_df['body'].astype(object)
+
+    # Skip conversations not started by a student
+    conv_start = np.r_[True, conversation[1:] != conversation[:-1]][:len(conversation)]
+    started_by_student = np.isin(sender[conv_start], [EmailAddress.STUDENT, EmailAddress.NONE])[np.cumsum(conv_start) - 1]
+
+    has_body = (body.str.strip().str.len() > 0).fillna(False).values & (body != 'nan').values
+    keep = started_by_student & has_body & np.isin(sender, [EmailAddress.STUDENT, EmailAddress.ADVISING])
+    conversation, sender, body = conversation[keep], sender[keep], body.values[keep]
+    n = len(conversation)
+
+    # Turn boundaries: a student email right after an advising email of the same conversation
+    is_question = sender == EmailAddress.STUDENT
+    conv_start = np.r_[True, conversation[1:] != conversation[:-1]][:n]
+    boundary = is_question & ~np.r_[True, is_question[:-1]][:n] & ~conv_start
+    turn_start = conv_start | boundary
+    boundaries_before = np.cumsum(boundary)
+    turn = boundaries_before - boundaries_before[np.flatnonzero(conv_start)][np.cumsum(conv_start) - 1]
+
+    # The last advising email of a turn is paired with the last student email before it in the same turn
+    positions = np.arange(n)
+    turn_end = np.r_[turn_start[1:], True][:n]
+    last_question = np.maximum.accumulate(np.where(is_question, positions, -1))
+    first_of_turn = np.maximum.accumulate(np.where(turn_start, positions, 0))
+    answers = np.flatnonzero(turn_end & ~is_question)
+    answers = answers[last_question[answers] >= first_of_turn[answers]]
+
+    return pd.DataFrame({
+        'conversation': conversation[answers],
+        'turn': turn[answers],
+        'question': body[last_question[answers]],
+        'answer': body[answers]})
+
+@run('make_pairs')
 def from_csv(in_path,out_path):
     """
     Convert conversations to question-answer pairs
     """
-    emails_df = pd.read_csv(in_path,index_col=0,encoding=ENCODING)
+    emails_df = read_table(in_path, columns=['conversation','from','body'])
     print(f"Loaded {emails_df.shape[0]} emails")
-    result = []
-    
-    print(f"Processing {len(emails_df.groupby('conversation'))} conversations")
-    for conversation, group in tqdm(emails_df.groupby('conversation')):
-        if group.iloc[0]['from'] not in [1,4]:
-            # Skipping conversation not started by student
-            continue
-        
-        i = 0
-        question = ''
-        answer = ''
-        for row in group.itertuples(index=False):
-            if type(row.body) != str or row.body == 'nan' or len(row.body.strip()) == 0: continue
-            if row._5 == 1:
-                # message from student
-                if len(answer) > 0:
-                    if len(question) > 0 and len(answer) > 0:
-                        result.append({'conversation': conversation, 'turn': i, 'question': question, 'answer': answer})
-                    question = ''
-                    answer = ''
-                    i += 1
-                question = row.body
-            elif row._5 == 2:
-                # message from advising
-                answer = row.body
-        
-        if len(question) > 0 and len(answer) > 0:
-            result.append({'conversation': conversation, 'turn': i, 'question': question, 'answer': answer})
-    
-    result_df = pd.DataFrame.from_dict(result)
-    result_df.to_csv(out_path,encoding=ENCODING)
+    print(f"Processing {emails_df['conversation'].nunique()} conversations")
+
+    with timer('make_pairs', items=emails_df.shape[0]):
+        result_df = make_pairs(emails_df)
+    write_table(result_df, out_path)
     print(f"Saved file with {result_df.shape[0]} pairs")
 
 def main():
@@ -0,0 +1,104 @@
+"""
+Applies the email classifier to the question/answer pairs.
+Used by 5_classify_emails.ipynb
+
+The model runs with the inference backend chosen in config.ini, see inference.py
+
+Main methods to use: from_csv, classify_pairs
+"""
+import configparser
+import numpy as np
+import pandas as pd
+from tqdm.auto import tqdm
+from transformers import AutoTokenizer
+from typing import List, Iterator, Tuple
+from inference import load_backend, compare_backends, BACKEND, device
+from storage import read_table, write_table
+from instrumentation import run, timer
+
+# Constants
+config = configparser.ConfigParser()
+config.read('config.ini')
+ENCODING = config['global']['ENCODING']
+checkpoint = config['classify_emails']['HF_CLASSIFIER_NAME']
+annotation_path = config['classify_emails']['TRAINING_ANNOTATION_FILE']
+annotation_cols = {'answer': 4, 'question': 9} # Columns of the Label Studio export, as in 5_train_classifier.ipynb
+
+max_length = 512
+batch_size = 32  # Number of examples in a forward pass
+
+def classifier_inputs(questions, answers) -> List[str]:
+    """
+    Formats question/answer pairs the same way as the training data
+    """
+    return [f">>> Question:\n{q}\n\n>>> Answer:\n{ans}" for q, ans in zip(questions, answers)]
+
+class Classifier:
+    """
+    Email classification model with its tokenizer
+    """
+    def __init__(self, checkpoint: str=checkpoint, backend: str=BACKEND, model_device: str=device) -> None:
+        self.tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+        self.model = load_backend(checkpoint, 'text-classification', backend, model_device)
+
+    def batches(self, texts: List[str], sort: bool=True) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Tokenizes the texts and batches them for the model, from longest to shortest if sort is set
+        Each batch is only padded to its longest text
+        Yields the rows of the batch, the input ids and the attention mask
+        """
+        input_ids = self.tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]
+        lengths = np.array([len(ids) for ids in input_ids])
+        order = np.argsort(lengths, kind="stable")[::-1] if sort else np.arange(len(texts))
+
+        for batch_start in range(0, len(order), batch_size):
+            rows = order[batch_start:batch_start + batch_size]
+            mask = np.arange(lengths[rows].max()) < lengths[rows][:, None]
+            batch_ids = np.full(mask.shape, self.tokenizer.pad_token_id, dtype=np.int64)
+            batch_ids[mask] = np.concatenate([input_ids[row] for row in rows])
+            yield rows, batch_ids, mask.astype(np.int64)
+
+    def classify(self, texts: List[str], sort: bool=True) -> List[str]:
+        """
+        Returns the predicted label of each text, in the original order
+        """
+        predictions = np.zeros(len(texts), dtype=np.int64)
+        for rows, input_ids, attention_mask in tqdm(self.batches(texts, sort), total=-(-len(texts) // batch_size)):
+            predictions[rows] = self.model(input_ids, attention_mask).argmax(axis=-1)
+        return [self.model.id2label[p] for p in predictions]
+
+def classify_pairs(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds the predicted label of each email pair
+    """
+    with timer('load_model'):
+        classifier = Classifier()
+    with timer('classify', items=df.shape[0]):
+        return df.assign(label=classifier.classify(classifier_inputs(df['question'], df['answer'])))
+
+@run('classify_emails')
+def from_csv(in_path: str, out_path: str):
+    """
+    Classify email pairs with a transformers classifier
+    """
+    df = classify_pairs(read_table(in_path))
+
+    # Save file
+    write_table(df, out_path)
+
+def check_parity(valid_size: float=.15, seed: int=42):
+    """
+    Compares the ONNX backend against PyTorch on a validation split of the annotated training data
+    Prints the largest difference in logits and the fraction of pairs with the same label
+    """
+    df = pd.read_csv(annotation_path, encoding=ENCODING, dtype=str, keep_default_na=False)
+    df = df.sample(frac=valid_size, random_state=seed)
+    texts = classifier_inputs(df.iloc[:, annotation_cols['question']], df.iloc[:, annotation_cols['answer']])
+
+    reference = Classifier(checkpoint, 'torch', 'cpu')
+    candidate = Classifier(checkpoint, 'onnx')
+    batches = [(input_ids, mask) for _, input_ids, mask in reference.batches(texts)]
+    results = compare_backends(reference.model, candidate.model, batches)
+
+    print(f"{checkpoint} on {len(texts)} pairs: max logit difference {results['max_logit_diff']:.4f}, "
+          f"label agreement {results['label_agreement']:.2%}")
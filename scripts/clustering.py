@@ -0,0 +1,342 @@
+"""
+Clusters the question-answer pairs into topics with BERTopic.
+Used by 6_cluster_emails.ipynb and run_pipeline.py
+
+Topics found by BERTopic are then merged and labelled by hand. The merges are
+listed in the JSON file TOPIC_MERGES_FILE, as a list of steps for each of the
+questions, answers and combined models. Each step has the groups of topics to
+merge, and the labels of the topics after the merge:
+    {"questions": [{"merge": [[49, 46], [94, 18]], "labels": {"0": "registration"}}], "answers": [], "combined": []}
+
+Before BERTopic, the embeddings are reduced with UMAP (or PCA) and clustered with HDBSCAN (or
+MiniBatchKMeans for large corpora, see CLUSTER_BACKEND). Reduced embeddings are cached, keyed by a
+hash of the embeddings and the reduction settings, so clustering again with other settings skips
+the reduction. The time of each step of the clustering is printed, and saved in the run report (see instrumentation.py).
+
+New pairs can be added to the topics of saved models without fitting them again, see add_pairs
+
+Main methods to use: cluster_pairs, apply_topic_merges, add_pairs
+"""
+import os
+import json
+import time
+import hashlib
+import contextlib
+import configparser
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Tuple
+from bertopic import BERTopic
+from bertopic.vectorizers import ClassTfidfTransformer
+from sklearn.feature_extraction.text import CountVectorizer
+from embedding_store import EmbeddingStore
+from topic_curation import TopicCuration
+from instrumentation import run, timer, count
+from shared_defns import get_filepath
+
+# Constants
+config = configparser.ConfigParser()
+config.read('config.ini')
+out_path_model = get_filepath(config, 'cluster_emails', 'OUT_PATH_MODEL')
+out_path_embeddings = get_filepath(config, 'cluster_emails', 'OUT_PATH_EMBEDDINGS')
+model_name = config['cluster_emails']['EMBEDDING_MODEL']
+embedding_dtype = config['cluster_emails']['EMBEDDING_DTYPE']
+encode_batch_size = int(config['cluster_emails']['ENCODE_BATCH_SIZE'])
+encode_workers = int(config['cluster_emails']['ENCODE_WORKERS'])
+encode_checkpoint_size = int(config['cluster_emails']['ENCODE_CHECKPOINT_SIZE'])
+out_path_reduced = os.path.join(out_path_embeddings, 'reduced')
+REDUCTION = config['cluster_emails']['REDUCTION']
+N_COMPONENTS = int(config['cluster_emails']['N_COMPONENTS'])
+UMAP_N_NEIGHBORS = int(config['cluster_emails']['UMAP_N_NEIGHBORS'])
+CLUSTER_BACKEND = config['cluster_emails']['CLUSTER_BACKEND']
+HDBSCAN_MIN_CLUSTER_SIZE = int(config['cluster_emails']['HDBSCAN_MIN_CLUSTER_SIZE'])
+KMEANS_N_CLUSTERS = int(config['cluster_emails']['KMEANS_N_CLUSTERS'])
+KMEANS_BATCH_SIZE = int(config['cluster_emails']['KMEANS_BATCH_SIZE'])
+NR_TOPICS = int(config['cluster_emails']['NR_TOPICS'])
+merges_path = get_filepath(config, 'merge_topics', 'TOPIC_MERGES_FILE')
+
+embedding_names = ['questions', 'answers', 'combined']
+model_prefixes = {'questions': 'q', 'answers': 'a', 'combined': 'c'}
+
+def pair_texts(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """
+    Texts to cluster for each model: the questions, the answers, and both combined
+    """
+    questions = np.array(df['question'].tolist())
+    answers = np.array(df['answer'].tolist())
+    combined = np.array([f'Question: {q}\n\nAnswer: {a}' for q, a in zip(questions, answers)])
+    return {'questions': questions, 'answers': answers, 'combined': combined}
+
+@run('create_embeddings')
+def create_embeddings(texts: Dict[str, np.ndarray], device: str, out_dir: str=out_path_embeddings) -> Dict[str, np.ndarray]:
+    """
+    For each text type, get the embeddings of the texts from the embedding store in out_dir
+    Only the texts that are not in the store yet are encoded, once even if they are used by several text types
+    On the CPU, texts are encoded by a pool of ENCODE_WORKERS processes
+    """
+    embedding_model = pool = None
+    encoded, encode_time = 0, 0.
+
+    def encode(new_texts: List[str]) -> np.ndarray:
+        nonlocal embedding_model, pool, encoded, encode_time
+        if embedding_model is None:
+            from sentence_transformers import SentenceTransformer # only needed to make new embeddings
+
+            # Load the base sentence embedding model
+            embedding_model = SentenceTransformer(model_name, device=device)
+            if device == 'cpu' and encode_workers > 1:
+                pool = embedding_model.start_multi_process_pool(['cpu'] * encode_workers)
+
+        start = time.perf_counter()
+        with timer('encode', items=len(new_texts)):
+            if pool is not None:
+                vectors = embedding_model.encode_multi_process(new_texts, pool, batch_size=encode_batch_size)
+            else:
+                vectors = embedding_model.encode(new_texts, batch_size=encode_batch_size)
+        encoded += len(new_texts)
+        encode_time += time.perf_counter() - start
+        return vectors
+
+    store = EmbeddingStore(out_dir, model_name, embedding_dtype)
+    all_texts = np.concatenate([texts[name] for name in embedding_names])
+    try:
+        print(f'Getting embeddings of {len(all_texts)} texts')
+        vectors = store.embed(all_texts, encode, encode_checkpoint_size).astype(np.float32, copy=False)
+    finally:
+        if pool is not None: embedding_model.stop_multi_process_pool(pool)
+
+    if encoded:
+        print(f'Encoded {encoded} texts in {encode_time:.1f}s on {device} ({encoded / encode_time:.1f} texts/sec, '
+              f'{encode_workers if pool is not None else 1} process(es), batch size {encode_batch_size})')
+
+    ends = np.cumsum([len(texts[name]) for name in embedding_names])
+    return dict(zip(embedding_names, np.split(vectors, ends[:-1])))
+
+def load_embeddings(texts: Dict[str, np.ndarray], out_dir: str=out_path_embeddings) -> Dict[str, np.ndarray]:
+    """
+    For each text type, get the embeddings of the texts from the embedding store in out_dir, in the order of the texts
+    Raises KeyError if some texts were never encoded, use create_embeddings to encode them
+    """
+    store = EmbeddingStore(out_dir, model_name, embedding_dtype)
+    embeddings = {}
+    for name in embedding_names:
+        embeddings[name] = store.get(texts[name]).astype(np.float32, copy=False)
+        print(f'Loaded embeddings {name}')
+
+    return embeddings
+
+@contextlib.contextmanager
+def timed(step: str):
+    start = time.perf_counter()
+    with timer(step):
+        yield
+    print(f'  {step}: {time.perf_counter() - start:.1f}s')
+
+class PrecomputedReduction:
+    """
+    Dimensionality reduction step of BERTopic that returns embeddings reduced beforehand, see reduce_embeddings
+    """
+    def __init__(self, reduced: np.ndarray) -> None:
+        self.reduced = reduced
+
+    def fit(self, X, y=None):
+        return self
+
+    def transform(self, X) -> np.ndarray:
+        if len(X) != len(self.reduced):
+            raise ValueError("Only the documents of the clustering can be reduced, use a saved model to add documents")
+        return self.reduced
+
+class PrecomputedClusters:
+    """
+    Clustering step of BERTopic that returns the clusters of a model fitted beforehand
+    """
+    def __init__(self, model) -> None:
+        self.labels_ = model.labels_
+        if hasattr(model, 'probabilities_'):
+            self.probabilities_ = model.probabilities_
+
+    def fit(self, X, y=None):
+        return self
+
+def reduction_model():
+    if REDUCTION == 'pca':
+        from sklearn.decomposition import PCA
+        return PCA(n_components=N_COMPONENTS, random_state=42)
+
+    # Same settings as the default of BERTopic
+    from umap import UMAP
+    return UMAP(n_neighbors=UMAP_N_NEIGHBORS, n_components=N_COMPONENTS, min_dist=0.0, metric='cosine', low_memory=False)
+
+def cluster_model():
+    if CLUSTER_BACKEND == 'kmeans':
+        from sklearn.cluster import MiniBatchKMeans
+        return MiniBatchKMeans(n_clusters=KMEANS_N_CLUSTERS, batch_size=KMEANS_BATCH_SIZE, random_state=42, n_init=3)
+
+    # Same settings as the default of BERTopic
+    from hdbscan import HDBSCAN
+    return HDBSCAN(min_cluster_size=HDBSCAN_MIN_CLUSTER_SIZE, metric='euclidean', cluster_selection_method='eom', prediction_data=True)
+
+def reduce_embeddings(embeds: np.ndarray, cache_dir: str=out_path_reduced) -> np.ndarray:
+    """
+    Reduces the dimensions of the embeddings, or loads them from the cache if they were already reduced with the same settings
+    """
+    settings = json.dumps({'reduction': REDUCTION, 'n_components': N_COMPONENTS, 'n_neighbors': UMAP_N_NEIGHBORS}, sort_keys=True)
+    sha = hashlib.sha256(settings.encode('utf-8'))
+    for start in range(0, len(embeds), 65536):
+        # Hashed in blocks of rows, so the embeddings aren't copied (only a block if they aren't contiguous)
+        sha.update(memoryview(np.ascontiguousarray(embeds[start:start + 65536])))
+    path = os.path.join(cache_dir, f'{sha.hexdigest()}.npy')
+    if os.path.exists(path):
+        print(f'  using reduced embeddings from {path}')
+        count('reduced_cache_hits')
+        return np.load(path)
+    count('reduced_cache_misses')
+
+    reduced = reduction_model().fit_transform(embeds)
+    os.makedirs(cache_dir, exist_ok=True)
+    np.save(path + '.tmp.npy', reduced)
+    os.replace(path + '.tmp.npy', path)
+    return reduced
+
+def cluster_bertopic(texts, embeds, cache_dir: str=out_path_reduced) -> Tuple[pd.DataFrame, BERTopic]:
+    with timed('reduce dimensions'):
+        reduced = reduce_embeddings(embeds, cache_dir)
+    with timed(f'cluster with {CLUSTER_BACKEND}'):
+        clusters = cluster_model().fit(reduced)
+
+    # Use vectorizer for topic representations that ignores stop words and includes 2-grams
+    vectorizer_model = CountVectorizer(stop_words="english", min_df=2, ngram_range=(1, 2))
+    ctfidf_model = ClassTfidfTransformer(reduce_frequent_words=True)
+
+    topic_model = BERTopic(umap_model=PrecomputedReduction(reduced), hdbscan_model=PrecomputedClusters(clusters),
+                           vectorizer_model=vectorizer_model, ctfidf_model=ctfidf_model)
+    with timed('fit topics'):
+        topics, probs = topic_model.fit_transform(texts, embeds)
+
+    # Reduce the number of topics to at most NR_TOPICS
+    # reduce_topics already updates the topic representations for the reduced topics
+    with timed('reduce topics'):
+        topic_model.reduce_topics(texts, nr_topics=NR_TOPICS)
+    topics = list(topic_model.topics_)
+
+    # Reduce outliers from HDBSCAN, MiniBatchKMeans has none
+    if -1 in topics:
+        with timed('reduce outliers'):
+            topics = topic_model.reduce_outliers(texts, topics, strategy="embeddings", embeddings=embeds)
+    topic_model.outliers_ = 0
+
+    # Update topics after reduction
+    with timed('update topics'):
+        topic_model.update_topics(texts, topics=topics)
+
+    df = pd.DataFrame(texts, columns =['text'])
+    df["label"] = topics
+    return df, topic_model
+
+cluster = cluster_bertopic
+
+def save_bertopic_model(model: BERTopic, suffix: str, out_dir: str=out_path_model):
+    embedding_model = f"sentence-transformers/{model_name}"
+    model.save(os.path.join(out_dir,suffix), serialization="safetensors", save_ctfidf=True, save_embedding_model=embedding_model)
+
+def load_bertopic_model(suffix: str, out_dir: str=out_path_model) -> BERTopic:
+    model = BERTopic.load(os.path.join(out_dir, suffix))
+    model._outliers = 0
+    return model
+
+@run('cluster_emails')
+def cluster_pairs(texts: Dict[str, np.ndarray], embeddings: Dict[str, np.ndarray], out_dir: str=out_path_model,
+                  cache_dir: str=out_path_reduced) -> Tuple[pd.DataFrame, Dict[str, BERTopic]]:
+    """
+    Clusters the questions, answers and combined texts, and saves the models as the base models
+    Returns the texts with their topic labels, and the models
+    """
+    print("Clustering questions")
+    with timer('questions', items=len(texts['questions'])):
+        q_clusters, q_model = cluster(texts['questions'], embeddings["questions"], cache_dir)
+    print("Clustering answers")
+    with timer('answers', items=len(texts['answers'])):
+        a_clusters, a_model = cluster(texts['answers'], embeddings["answers"], cache_dir)
+    print("Clustering combined")
+    with timer('combined', items=len(texts['combined'])):
+        c_clusters, c_model = cluster(texts['combined'], embeddings["combined"], cache_dir)
+    combine_clusters = pd.merge(q_clusters, a_clusters, left_index=True, right_index=True, suffixes=('_q', '_a'))
+    combine_clusters["label_c"] = c_clusters["label"]
+
+    # Save the models
+    models = {'questions': q_model, 'answers': a_model, 'combined': c_model}
+    save_models(models, 'base', out_dir)
+
+    return combine_clusters, models
+
+def save_models(models: Dict[str, BERTopic], kind: str, out_dir: str=out_path_model):
+    """
+    Saves the models of each text type, kind is base for the models found by cluster_pairs and merged after the merges
+    """
+    for name, model in models.items():
+        save_bertopic_model(model, f"{model_prefixes[name]}_model_{kind}", out_dir)
+
+def load_models(kind: str, out_dir: str=out_path_model) -> Dict[str, BERTopic]:
+    return {name: load_bertopic_model(f"{model_prefixes[name]}_model_{kind}", out_dir) for name in embedding_names}
+
+def load_base_models(out_dir: str=out_path_model) -> Dict[str, BERTopic]:
+    return load_models('base', out_dir)
+
+def read_topic_merges(filepath: str=merges_path) -> Dict[str, List[Dict]]:
+    """
+    Reads the merge steps for each model, with the topic ids of the labels as ints
+    """
+    with open(filepath) as file:
+        merges = json.load(file)
+
+    return {name: [{'merge': step.get('merge', []), 'labels': {int(topic): label for topic, label in step.get('labels', {}).items()}}
+                   for step in merges.get(name, [])]
+            for name in embedding_names}
+
+def apply_topic_merges(models: Dict[str, BERTopic], texts: Dict[str, np.ndarray], merges: Dict[str, List[Dict]]) -> pd.DataFrame:
+    """
+    Applies every merge step to the models, see topic_curation.py
+    Returns the topic of each pair for each model, and the topic label if one was set
+    """
+    df = pd.DataFrame(index=range(len(texts['questions'])))
+    for name, model in models.items():
+        if merges[name]:
+            with timer(f'merge_{name}', items=len(texts[name])):
+                curation = TopicCuration(model, texts[name])
+                for step in merges[name]:
+                    curation.merge(step['merge'])
+                    curation.set_labels(step['labels'])
+                curation.commit()
+
+        add_topic_columns(df, model, model_prefixes[name], model.topics_)
+
+    return df
+
+def add_topic_columns(df: pd.DataFrame, model: BERTopic, suffix: str, topics):
+    """
+    Adds the topic of each pair for a model, and the topic label if one was set
+    """
+    df[f'label_{suffix}'] = topics
+    if model.custom_labels_ is not None:
+        topic_info = model.get_topic_info()
+        df[f'name_{suffix}'] = df[f'label_{suffix}'].map(dict(zip(topic_info["Topic"], topic_info["CustomName"])))
+
+def add_pairs(models: Dict[str, BERTopic], texts: Dict[str, np.ndarray], embeddings: Dict[str, np.ndarray], keep: np.ndarray) -> pd.DataFrame:
+    """
+    Assigns new pairs to the existing topics of the models, without fitting them again
+    The new pairs are added to the documents of each model, after the previous documents in keep,
+    so the topics can still be merged with all pairs. Save the models to keep the new documents.
+    Returns the topic of each new pair for each model, and the topic label if one was set
+    """
+    df = pd.DataFrame(index=range(len(texts['questions'])))
+    for name, model in models.items():
+        topics = []
+        if df.shape[0]:
+            # Models loaded from safetensors assign the topic with the most similar topic embedding
+            with timer(f'assign_{name}', items=df.shape[0]):
+                topics, _ = model.transform(list(texts[name]), embeddings[name])
+        model.topics_ = np.asarray(model.topics_)[keep].tolist() + [int(topic) for topic in topics]
+        add_topic_columns(df, model, model_prefixes[name], [int(topic) for topic in topics])
+
+    return df
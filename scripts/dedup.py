@@ -0,0 +1,112 @@
+"""
+Index of the messages already seen, to find duplicate conversations.
+
+Messages are keyed by a fixed-size digest of their normalized text (lowercase, with whitespace
+collapsed), so the index doesn't keep the message bodies in memory. In minhash mode, messages that
+differ slightly, e.g. by a signature or a few words, are also found: the MinHash signature of the
+word shingles of each message is split into bands, and messages sharing a band are compared by
+their signatures. Both lookups take constant time, so deduplicating n messages takes linear time.
+
+Main class to use: DedupIndex
+"""
+import re as re
+import zlib
+import hashlib
+import numpy as np
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+DIGEST_SIZE = 16
+SHINGLE_SIZE = 3   # words in each shingle
+NUM_PERM = 64      # hash functions of a MinHash signature
+BANDS = 16         # LSH bands, of NUM_PERM / BANDS rows each
+MERSENNE_PRIME = (1 << 61) - 1
+
+whitespace_regex = re.compile(r'\s+')
+
+def normalize_text(text: str) -> str:
+    return whitespace_regex.sub(' ', text).strip().lower()
+
+def text_digest(text: str) -> bytes:
+    return hashlib.blake2b(normalize_text(text).encode('utf-8'), digest_size=DIGEST_SIZE).digest()
+
+class Entry(NamedTuple):
+    conversation: int
+    length: int # messages in the conversation when the message was added
+
+class Fingerprint(NamedTuple):
+    digest: bytes
+    signature: Optional[np.ndarray]
+
+class DedupIndex:
+    """
+    Conversation of each message digest, with an optional MinHash LSH index of near duplicates
+    """
+    entries: Dict[bytes, Entry]
+    near_duplicates: bool
+    threshold: float
+    signatures: Dict[bytes, np.ndarray]
+    buckets: Dict[Tuple[int, bytes], List[bytes]]
+
+    def __init__(self, near_duplicates: bool=False, threshold: float=0.9) -> None:
+        self.entries = {}
+        self.near_duplicates = near_duplicates
+        self.threshold = threshold
+        self.signatures = {}
+        self.buckets = {}
+        rng = np.random.default_rng(0) # same permutations in every run
+        self.a = rng.integers(1, 1 << 32, size=NUM_PERM, dtype=np.uint64) # a * hash fits in 64 bits
+        self.b = rng.integers(0, MERSENNE_PRIME, size=NUM_PERM, dtype=np.uint64)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __getitem__(self, digest: bytes) -> Entry:
+        return self.entries[digest]
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """
+        MinHash signature of the word shingles of the text, None if it is too short to have shingles
+        """
+        words = normalize_text(text).split(' ')
+        if len(words) < SHINGLE_SIZE: return None
+        shingles = {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+        hashes = np.array([zlib.crc32(shingle.encode('utf-8')) for shingle in shingles], dtype=np.uint64)
+
+        products = (self.a[:, None] * hashes[None, :]) % np.uint64(MERSENNE_PRIME)
+        return ((products + self.b[:, None]) % np.uint64(MERSENNE_PRIME)).min(axis=1)
+
+    def fingerprint(self, text: str, digest: Optional[bytes]=None) -> Fingerprint:
+        return Fingerprint(digest or text_digest(text), self.signature(text) if self.near_duplicates else None)
+
+    def bands(self, signature: np.ndarray):
+        rows = NUM_PERM // BANDS
+        return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(BANDS)]
+
+    def find(self, fingerprint: Fingerprint) -> Optional[bytes]:
+        """
+        Digest of an indexed message with the same text, or with a similar text in minhash mode
+        """
+        if fingerprint.digest in self.entries:
+            return fingerprint.digest
+        if fingerprint.signature is None: return None
+
+        candidates = {digest for band in self.bands(fingerprint.signature) for digest in self.buckets.get(band, [])}
+        best, best_similarity = None, self.threshold
+        for digest in candidates:
+            similarity = float(np.mean(self.signatures[digest] == fingerprint.signature))
+            if similarity >= best_similarity:
+                best, best_similarity = digest, similarity
+        return best
+
+    def add(self, fingerprint: Fingerprint, conversation: int, length: int):
+        """
+        Indexes a message of a conversation, replacing the conversation of the same message if indexed
+        """
+        if fingerprint.digest not in self.entries and fingerprint.signature is not None:
+            self.signatures[fingerprint.digest] = fingerprint.signature
+            for band in self.bands(fingerprint.signature):
+                self.buckets.setdefault(band, []).append(fingerprint.digest)
+        self.entries[fingerprint.digest] = Entry(conversation, length)
+
+    def replace(self, digest: bytes, conversation: int, length: int):
+        self.entries[digest] = Entry(conversation, length)
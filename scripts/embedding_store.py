@@ -0,0 +1,172 @@
+"""
+Store of sentence embeddings, keyed by a hash of the embedding model name and the text.
+Only texts that are not in the store yet need to be encoded, and embeddings are always
+returned in the order of the given texts.
+
+Embeddings are saved in segments of .npy files, each with a file of the keys of its rows.
+Each call to add writes a new segment, and segments are memory-mapped when loaded, so
+opening the store doesn't read the vectors. Use compact to join the segments into one.
+New texts are encoded in chunks that are each saved as a segment, so an interrupted
+encoding continues with the texts of the chunks that weren't saved.
+
+Main class to use: EmbeddingStore
+"""
+import os
+import time
+import hashlib
+import numpy as np
+from typing import Callable, List, Optional
+from instrumentation import count
+
+KEY_TYPE = 'S32' # sha256 digest
+MAX_SEGMENTS = 32 # segments are joined when there are more than this after encoding
+
+class EmbeddingStore:
+    """
+    Embeddings of texts for one embedding model, saved in a folder
+    """
+    directory: str
+    model_name: str
+    dtype: np.dtype
+    segments: List[np.ndarray]
+    numbers: List[int]        # number of each segment, in the file names
+    keys: np.ndarray          # keys of all rows, sorted
+    segment_ids: np.ndarray   # segment of each key
+    rows: np.ndarray          # row of each key in its segment
+
+    def __init__(self, directory: str, model_name: str, dtype: str='float32') -> None:
+        self.directory = os.path.join(directory, model_name.replace('/', '_'))
+        self.model_name = model_name
+        self.dtype = np.dtype(dtype)
+        os.makedirs(self.directory, exist_ok=True)
+        self.load()
+
+    def segment_path(self, i: int, suffix: str='') -> str:
+        return os.path.join(self.directory, f'{i:06d}{suffix}.npy')
+
+    def segment_numbers(self) -> List[int]:
+        """
+        Numbers of the complete segments, a segment is only complete once its keys file is written, see add
+        """
+        suffix = '.keys.npy'
+        return sorted(int(name[:-len(suffix)]) for name in os.listdir(self.directory)
+                      if name.endswith(suffix) and name[:-len(suffix)].isdigit())
+
+    def load(self):
+        """
+        Memory-maps the saved segments and indexes their keys
+        """
+        self.segments = []
+        self.numbers = self.segment_numbers()
+        keys, segment_ids, rows = [], [], []
+        for position, i in enumerate(self.numbers):
+            self.segments.append(np.load(self.segment_path(i), mmap_mode='r'))
+            keys.append(np.load(self.segment_path(i, '.keys')))
+            segment_ids.append(np.full(len(keys[-1]), position))
+            rows.append(np.arange(len(keys[-1])))
+
+        keys = np.concatenate(keys) if keys else np.array([], dtype=KEY_TYPE)
+        self.keys, first = np.unique(keys, return_index=True)
+        self.segment_ids = np.concatenate(segment_ids)[first] if segment_ids else np.array([], dtype=int)
+        self.rows = np.concatenate(rows)[first] if rows else np.array([], dtype=int)
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def key(self, text: str) -> bytes:
+        return hashlib.sha256(f'{self.model_name}\0{text}'.encode('utf-8')).digest()
+
+    def text_keys(self, texts: List[str]) -> np.ndarray:
+        return np.array([self.key(text) for text in texts], dtype=KEY_TYPE)
+
+    def find(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Position of each key in the sorted keys of the store, or -1 if it isn't saved
+        """
+        positions = np.searchsorted(self.keys, keys)
+        found = positions < len(self.keys)
+        found[found] = self.keys[positions[found]] == keys[found]
+        return np.where(found, positions, -1)
+
+    def add(self, keys: np.ndarray, vectors: np.ndarray):
+        """
+        Saves the embeddings of the given keys as a new segment
+        """
+        if len(keys) == 0: return
+        self.write_segment(self.numbers[-1] + 1 if self.numbers else 0, keys, vectors)
+        self.load()
+
+    def write_segment(self, i: int, keys: np.ndarray, vectors: np.ndarray):
+        # The keys file is written last, so an interruption can't leave a segment without its vectors
+        np.save(self.segment_path(i, '.tmp'), np.asarray(vectors, dtype=self.dtype))
+        os.replace(self.segment_path(i, '.tmp'), self.segment_path(i))
+        np.save(self.segment_path(i, '.keys.tmp'), keys.astype(KEY_TYPE))
+        os.replace(self.segment_path(i, '.keys.tmp'), self.segment_path(i, '.keys'))
+
+    def get(self, texts: List[str], keys: Optional[np.ndarray]=None) -> np.ndarray:
+        """
+        Embeddings of the texts, in the same order
+        Raises KeyError if a text is not in the store
+        """
+        keys = self.text_keys(texts) if keys is None else keys
+        positions = self.find(keys)
+        if (positions < 0).any():
+            raise KeyError(f"{int((positions < 0).sum())} texts are not in the embedding store {self.directory}")
+
+        dims = self.segments[0].shape[1] if self.segments else 0
+        result = np.empty((len(keys), dims), dtype=self.dtype)
+        segment_ids, rows = self.segment_ids[positions], self.rows[positions]
+        for i in np.unique(segment_ids):
+            in_segment = segment_ids == i
+            result[in_segment] = self.segments[i][rows[in_segment]]
+        return result
+
+    def embed(self, texts: List[str], encode: Callable[[List[str]], np.ndarray], checkpoint_size: int=10000) -> np.ndarray:
+        """
+        Embeddings of the texts, in the same order
+        Texts not in the store are encoded once each with encode, and saved
+        The texts to encode are sorted by length, so batches of similar lengths need less padding,
+        and saved every checkpoint_size texts
+        """
+        keys = self.text_keys(texts)
+        _, first = np.unique(keys, return_index=True)
+        missing = first[self.find(keys[first]) < 0]
+        count('embedding_store_hits', len(first) - len(missing))
+        count('embedding_store_misses', len(missing))
+        if len(missing):
+            print(f"Encoding {len(missing)} of {len(texts)} texts, the others are already in the store")
+            missing = missing[np.argsort([-len(texts[i]) for i in missing], kind='stable')]
+            start = time.perf_counter()
+            for i in range(0, len(missing), checkpoint_size):
+                chunk = missing[i:i + checkpoint_size]
+                self.add(keys[chunk], encode([texts[j] for j in chunk]))
+                elapsed = time.perf_counter() - start
+                print(f"Saved {i + len(chunk)}/{len(missing)} embeddings, {(i + len(chunk)) / elapsed:.1f} texts/sec")
+
+            if len(self.segments) > MAX_SEGMENTS: self.compact()
+        return self.get(texts, keys)
+
+    def compact(self):
+        """
+        Joins all segments into one
+        """
+        if len(self.segments) <= 1: return
+        vectors = self.get([], self.keys)
+        keys = self.keys.copy()
+        old_numbers = self.numbers
+        self.segments = [] # release the memory maps before removing their files
+
+        # The joined segment is saved after the others, as by add, before they are removed. If this is
+        # interrupted, the store has the old segments, the joined one, or both with the same vectors.
+        joined = old_numbers[-1] + 1
+        self.write_segment(joined, keys, vectors)
+        for i in old_numbers:
+            os.remove(self.segment_path(i, '.keys'))
+            os.remove(self.segment_path(i))
+
+        # Files left by interrupted writes or compactions are not part of any segment
+        kept = {os.path.basename(self.segment_path(joined)), os.path.basename(self.segment_path(joined, '.keys'))}
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name not in kept and os.path.isfile(path): os.remove(path)
+        self.load()
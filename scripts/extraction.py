@@ -0,0 +1,415 @@
+"""
+Applies the question and answer extraction models to the email bodies.
+Used by 3_extract_contents.ipynb
+
+Both models are token classifiers with the same RoBERTa tokenizer, so each
+chunk of emails is tokenized once into overlapping windows. The windows are
+cached to disk as Arrow files, and both models run their forward passes from
+that cache.
+
+The models run with the inference backend chosen in config.ini, see inference.py
+
+Main methods to use: from_csv, from_dataframe
+"""
+import os
+import json
+import shutil
+import time
+import hashlib
+import configparser
+import numpy as np
+import pandas as pd
+import torch
+from tqdm.auto import tqdm
+from datasets import Dataset
+from transformers import AutoTokenizer
+from typing import List, Dict, Tuple, Iterator, Iterable
+from inference import load_backend, compare_backends, BACKEND, device
+from storage import read_table, write_table, iter_table, table_exists, stage_path, TableWriter
+from shared_defns import EmailAddress, get_filepath
+from instrumentation import run, timer, count
+
+# Constants
+config = configparser.ConfigParser()
+config.read('config.ini')
+ENCODING = config['global']['ENCODING']
+q_checkpoint = config['extract_contents']['HF_QUESTION_MODEL_NAME']
+a_checkpoint = config['extract_contents']['HF_ANSWER_MODEL_NAME']
+token_cache_dir = get_filepath(config, 'extract_contents', 'TOKEN_CACHE_DIR')
+annotation_path = config['extract_contents']['TRAINING_ANNOTATION_FILE']
+used_cache_files = set() # Token cache files read or written by this run, see remove_unused_cache
+annotation_cols = {'from': 9, 'body': 4} # Columns of the Label Studio export, as in 3_train_extractor.ipynb
+
+max_length = 512
+stride = 128     # Number of tokens shared by consecutive windows of a long email
+chunk_size = 512 # Number of rows to read from csv at once
+batch_size = 32  # Number of windows in a forward pass
+min_score = .9   # Minimum average score of an extracted span
+
+class Windows:
+    """
+    Overlapping windows of tokens for a list of texts, flattened into arrays
+    The tokens of window w are at positions offsets[w] to offsets[w + 1] of the token arrays
+    """
+    sample: np.ndarray    # Index of the text each window belongs to
+    offsets: np.ndarray   # Start of each window in the token arrays, followed by the total number of tokens
+    input_ids: np.ndarray
+    starts: np.ndarray    # Character offsets of each token in its text, both 0 for special tokens
+    ends: np.ndarray
+
+    def __init__(self, dataset: Dataset) -> None:
+        table = dataset.with_format("arrow")[:]
+        input_ids = table.column("input_ids").combine_chunks()
+        offset_mapping = table.column("offset_mapping").combine_chunks()
+
+        self.sample = table.column("sample").to_numpy()
+        self.offsets = input_ids.offsets.to_numpy() - input_ids.offsets[0].as_py()
+        self.input_ids = input_ids.flatten().to_numpy()
+        token_offsets = offset_mapping.flatten().flatten().to_numpy().reshape(-1, 2)
+        self.starts = token_offsets[:, 0]
+        self.ends = token_offsets[:, 1]
+
+    def __len__(self) -> int:
+        return len(self.sample)
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def token_window(self) -> np.ndarray:
+        """
+        Index of the window each token belongs to
+        """
+        return np.repeat(np.arange(len(self)), self.lengths())
+
+def tokenizer_fingerprint(tokenizer) -> str:
+    """
+    Identifies a tokenizer by its vocabulary and windowing settings
+    Models whose tokenizers have the same fingerprint can share the tokenized windows
+    """
+    settings = json.dumps([type(tokenizer).__name__, tokenizer.get_vocab(), max_length, stride], sort_keys=True)
+    return hashlib.sha256(settings.encode('utf-8')).hexdigest()
+
+def tokenize(texts: List[str], tokenizer) -> Windows:
+    """
+    Splits the texts into overlapping windows of tokens, with the character offsets of every token
+    The windows are saved in token_cache_dir, keyed by the texts and tokenizer, and
+    memory-mapped from there if the same texts are tokenized again
+    """
+    key = hashlib.sha256(tokenizer_fingerprint(tokenizer).encode('utf-8'))
+    for text in texts:
+        key.update(text.encode('utf-8'))
+        key.update(b'\0')
+    cache_file = os.path.join(token_cache_dir, f"{key.hexdigest()}.arrow")
+    used_cache_files.add(cache_file)
+
+    if os.path.exists(cache_file):
+        count('token_cache_hits')
+        return Windows(Dataset.from_file(cache_file))
+    count('token_cache_misses')
+
+    def tokenize_batch(batch, indices):
+        tokens = tokenizer(batch["text"], truncation=True, max_length=max_length, stride=stride,
+                           return_overflowing_tokens=True, return_offsets_mapping=True)
+        return {"input_ids": tokens["input_ids"],
+                "offset_mapping": tokens["offset_mapping"],
+                "sample": [indices[i] for i in tokens["overflow_to_sample_mapping"]]}
+
+    os.makedirs(token_cache_dir, exist_ok=True)
+    dataset = Dataset.from_dict({"text": texts}).map(tokenize_batch, batched=True, with_indices=True,
+                                                     remove_columns=["text"], cache_file_name=cache_file)
+    return Windows(dataset)
+
+def remove_unused_cache():
+    """
+    Removes the files of token_cache_dir that this run didn't use, i.e. the windows of emails or
+    tokenizers that changed since, and temporary files left by an interrupted tokenization
+    """
+    if not os.path.isdir(token_cache_dir): return
+    removed = 0
+    for entry in os.scandir(token_cache_dir):
+        if entry.is_file() and entry.path not in used_cache_files:
+            os.remove(entry.path)
+            removed += 1
+    if removed: print(f"Removed {removed} unused files from the token cache")
+
+def iter_batches(windows: Windows, window_ids: np.ndarray, pad_token_id: int, sort: bool=True) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Batches the given windows for the model, from longest to shortest if sort is set
+    Each batch is only padded to its longest window
+    Yields the positions of the batch tokens in the flat token arrays, the input ids and the attention mask
+    """
+    lengths = windows.lengths()
+    if sort:
+        window_ids = window_ids[np.argsort(lengths[window_ids], kind="stable")[::-1]]
+
+    for batch_start in range(0, len(window_ids), batch_size):
+        batch = window_ids[batch_start:batch_start + batch_size]
+        batch_lengths = lengths[batch]
+        mask = np.arange(batch_lengths.max()) < batch_lengths[:, None]
+        token_ids = np.concatenate([np.arange(windows.offsets[w], windows.offsets[w + 1]) for w in batch])
+
+        input_ids = np.full(mask.shape, pad_token_id, dtype=np.int64)
+        input_ids[mask] = windows.input_ids[token_ids]
+        yield token_ids, input_ids, mask.astype(np.int64)
+
+def predict(model, windows: Windows, window_ids: np.ndarray, pad_token_id: int, sort: bool=True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Runs the token classifier over the given windows
+    Returns the predicted label and its probability for every token of the flat token arrays,
+    with label -1 for tokens of windows that were not predicted
+    """
+    labels = np.full(len(windows.input_ids), -1, dtype=np.int64)
+    scores = np.zeros(len(windows.input_ids), dtype=np.float32)
+
+    for token_ids, input_ids, attention_mask in iter_batches(windows, window_ids, pad_token_id, sort):
+        logits = model(input_ids, attention_mask)
+        mask = attention_mask.astype(bool)
+
+        # Softmax over the labels, as in the transformers pipeline
+        shifted_exp = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        probs = shifted_exp / shifted_exp.sum(axis=-1, keepdims=True)
+        labels[token_ids] = probs.argmax(axis=-1)[mask]
+        scores[token_ids] = probs.max(axis=-1)[mask]
+
+    return labels, scores
+
+def aggregate_spans(windows: Windows, labels: np.ndarray, scores: np.ndarray, id2label: Dict[int, str], n_texts: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the character span of each text that covers all of its extracted entities
+
+    Follows the "simple" aggregation of the transformers ner pipeline: consecutive tokens with the same
+    entity label form a group, scored by the mean probability of its tokens, and groups scoring at least
+    min_score are kept. Where two windows of a text overlap, each token is taken from the window
+    it is furthest from the edge of.
+    Returns arrays of the start and end of each span, with start -1 for texts without a span
+    """
+    token_window = windows.token_window()
+    sample = windows.sample
+    content = ~((windows.starts == 0) & (windows.ends == 0)) # skip special tokens
+
+    # Position of each token among the content tokens of its window
+    content_count = np.concatenate([[0], np.cumsum(content)])
+    window_base = content_count[windows.offsets[:-1]]
+    window_content = content_count[windows.offsets[1:]] - window_base
+    position = content_count[1:] - 1 - window_base[token_window]
+
+    # Drop the half of each overlap that is closer to the edge of the window
+    has_prev = np.concatenate([[False], sample[1:] == sample[:-1]])
+    has_next = np.concatenate([sample[:-1] == sample[1:], [False]])
+    overlap_start = has_prev[token_window] & (position < stride // 2)
+    overlap_end = has_next[token_window] & (position >= window_content[token_window] - (stride - stride // 2))
+    keep = np.flatnonzero(content & (labels >= 0) & ~overlap_start & ~overlap_end)
+
+    span_start = np.full(n_texts, -1, dtype=np.int64)
+    span_end = np.full(n_texts, -1, dtype=np.int64)
+    if len(keep) == 0: return span_start, span_end
+
+    # Entity type of each label, with B- and I- prefixes removed
+    label_names = [id2label[i] for i in range(len(id2label))]
+    entity_types = sorted({name.split('-', 1)[-1] for name in label_names})
+    label_type = np.array([entity_types.index(name.split('-', 1)[-1]) for name in label_names])
+    label_is_entity = np.array([name != 'O' for name in label_names])
+    label_is_begin = np.array([name.startswith('B-') for name in label_names])
+
+    # Group consecutive tokens of the same entity type in the same text
+    kept_labels = labels[keep]
+    kept_type = label_type[kept_labels]
+    kept_sample = sample[token_window[keep]]
+    new_group = np.ones(len(keep), dtype=bool)
+    new_group[1:] = (kept_type[1:] != kept_type[:-1]) | (kept_sample[1:] != kept_sample[:-1]) | label_is_begin[kept_labels[1:]]
+    group = np.cumsum(new_group) - 1
+    first = np.flatnonzero(new_group)
+    last = np.concatenate([first[1:] - 1, [len(keep) - 1]])
+
+    group_score = np.bincount(group, weights=scores[keep]) / np.bincount(group)
+    selected = label_is_entity[kept_labels[first]] & (group_score >= min_score)
+
+    group_sample = kept_sample[first][selected]
+    group_start = windows.starts[keep[first]][selected]
+    group_end = windows.ends[keep[last]][selected]
+
+    span_start[:] = np.iinfo(np.int64).max
+    np.minimum.at(span_start, group_sample, group_start)
+    np.maximum.at(span_end, group_sample, group_end)
+    span_start[span_end < 0] = -1
+    return span_start, span_end
+
+class Extractor:
+    """
+    Extraction model for one role of sender, with the tokenizer it was trained with
+    """
+    def __init__(self, checkpoint: str, role: int, backend: str=BACKEND, model_device: str=device) -> None:
+        self.checkpoint = checkpoint
+        self.role = role
+        self.tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+        self.fingerprint = tokenizer_fingerprint(self.tokenizer)
+        self.model = load_backend(checkpoint, 'token-classification', backend, model_device)
+
+    def extract(self, texts: List[str], windows: Windows, rows: np.ndarray, sort: bool=True) -> List[str]:
+        """
+        Extract the relevant content of the texts at the given rows
+        """
+        window_ids = np.flatnonzero(np.isin(windows.sample, rows))
+        with timer('forward_passes', items=len(window_ids)):
+            labels, scores = predict(self.model, windows, window_ids, self.tokenizer.pad_token_id, sort=sort)
+        with timer('aggregate_spans', items=len(rows)):
+            span_start, span_end = aggregate_spans(windows, labels, scores, self.model.id2label, len(texts))
+        return [texts[i][span_start[i]:span_end[i]] if span_start[i] >= 0 else '' for i in rows]
+
+def chunk_texts(df: pd.DataFrame, extractors: List[Extractor]) -> List[str]:
+    """
+    Bodies of the chunk to tokenize, empty for emails that no extractor applies to
+    """
+    roles = [extractor.role for extractor in extractors]
+    return [s if type(s) == str and role in roles else '' for s, role in zip(df['body'], df['from'])]
+
+def extract_chunk(df: pd.DataFrame, extractors: List[Extractor], sort: bool=True) -> pd.DataFrame:
+    """
+    Replace the body of each question and answer email in the chunk with its extracted content
+    Texts are tokenized once for all extractors sharing a tokenizer
+    """
+    texts = chunk_texts(df, extractors)
+    windows = {}
+
+    for extractor in extractors:
+        rows = np.flatnonzero(df['from'].values == extractor.role)
+        if len(rows) == 0: continue
+        if extractor.fingerprint not in windows:
+            with timer('tokenize', items=len(texts)):
+                windows[extractor.fingerprint] = tokenize(texts, extractor.tokenizer)
+        with timer(f'extract_{EmailAddress(extractor.role).name.lower()}', items=len(rows)):
+            df.loc[df['from'] == extractor.role,'body'] = extractor.extract(texts, windows[extractor.fingerprint], rows, sort=sort)
+
+    return df
+
+def part_path(parts_dir: str, i: int, suffix: str='') -> str:
+    # Named like the files in the config, the extension is replaced by the one of the file format
+    return os.path.join(parts_dir, f'{i:06d}{suffix}.csv')
+
+def completed_parts(parts_dir: str) -> int:
+    """
+    Number of chunks saved by a previous run
+    """
+    i = 0
+    while table_exists(part_path(parts_dir, i)): i += 1
+    return i
+
+def extract_parts(chunks: Iterable[pd.DataFrame], parts_dir: str) -> int:
+    """
+    Extracts each chunk of emails and saves it to a part file in parts_dir
+    Chunks saved by a previous run are skipped. Returns the number of chunks.
+    Once every chunk is saved, the token cache only keeps the windows of this run.
+    """
+    os.makedirs(parts_dir, exist_ok=True)
+    done = completed_parts(parts_dir)
+    if done > 0:
+        print(f"Continuing from chunk {done}")
+
+    with timer('load_models'):
+        extractors = [Extractor(a_checkpoint, 2), Extractor(q_checkpoint, 1)]
+
+    n_chunks = 0
+    for i, df in enumerate(tqdm(chunks)):
+        n_chunks += 1
+        if i < done: continue # already extracted
+
+        with timer('extract_chunk', items=df.shape[0]):
+            df = extract_chunk(df, extractors)
+
+        # Write to a temporary file first, so an interruption can't leave a partial chunk
+        temp_path = write_table(df, part_path(parts_dir, i, '.tmp'), export_csv=False)
+        os.replace(temp_path, stage_path(part_path(parts_dir, i)))
+
+    remove_unused_cache()
+    return n_chunks
+
+@run('extract_contents')
+def from_csv(in_path: str, out_path: str):
+    """
+    Extract questions and answer from emails
+    The input is read in chunks, and the results of each chunk are saved to a part file in a folder
+    next to the output, so memory use doesn't depend on the size of the dataset. If the run is
+    interrupted, running it again continues after the last completed chunk. Once every chunk is
+    extracted, the parts are joined into the output file.
+    """
+    parts_dir = stage_path(out_path) + '.parts'
+    n_chunks = extract_parts(iter_table(in_path, chunk_size), parts_dir)
+
+    # Done, join the parts and a new run will start over
+    with TableWriter(out_path) as writer:
+        for i in range(n_chunks):
+            writer.write(read_table(part_path(parts_dir, i)))
+    shutil.rmtree(parts_dir)
+    print(f"Saved {writer.rows} emails to {writer.path}")
+
+@run('extract_contents')
+def from_dataframe(df: pd.DataFrame, out_path: str, input_id: str) -> pd.DataFrame:
+    """
+    Extract questions and answers from emails already in memory, returning the extracted emails
+    Chunks are saved next to out_path as in from_csv, so an interrupted run can continue.
+    input_id identifies the input, parts saved for a different input are discarded.
+    """
+    parts_dir = stage_path(out_path) + '.parts'
+    id_path = os.path.join(parts_dir, 'input_id')
+    if os.path.exists(id_path):
+        with open(id_path) as file:
+            if file.read() != input_id: shutil.rmtree(parts_dir)
+    os.makedirs(parts_dir, exist_ok=True)
+    with open(id_path, 'w') as file:
+        file.write(input_id)
+
+    chunks = (df.iloc[start:start + chunk_size].copy() for start in range(0, df.shape[0], chunk_size))
+    n_chunks = extract_parts(chunks, parts_dir)
+
+    extracted = pd.concat([read_table(part_path(parts_dir, i)) for i in range(n_chunks)]) if n_chunks else df.iloc[:0]
+    shutil.rmtree(parts_dir)
+    return extracted
+
+def benchmark(in_path: str, n_samples: int=1000):
+    """
+    Prints the emails/sec of the extractors with and without sorting windows by length,
+    with PyTorch on the CPU and GPU, and with ONNX Runtime if it is installed
+    """
+    df = next(iter_table(in_path, n_samples))
+    setups = [('torch', 'cpu')] + ([('torch', 'cuda')] if torch.cuda.is_available() else [])
+    try:
+        import onnxruntime
+        setups.append(('onnx', 'cpu'))
+    except ImportError:
+        pass
+
+    for backend, bench_device in setups:
+        extractors = [Extractor(a_checkpoint, 2, backend, bench_device), Extractor(q_checkpoint, 1, backend, bench_device)]
+        tokenize(chunk_texts(df, extractors), extractors[0].tokenizer) # only time the cached tokenization
+        for sort in [False, True]:
+            start = time.perf_counter()
+            extract_chunk(df.copy(), extractors, sort=sort)
+            elapsed = time.perf_counter() - start
+            print(f"{backend} {bench_device.upper()}, {'sorted by length' if sort else 'file order'}: {df.shape[0] / elapsed:.1f} emails/sec")
+        del extractors
+
+def check_parity(valid_size: float=.15, seed: int=42):
+    """
+    Compares the ONNX backend against PyTorch on a validation split of the annotated training data
+    Prints the largest difference in logits, the fraction of tokens with the same label, and the
+    fraction of emails with the same extracted text, for each extractor
+    """
+    df = pd.read_csv(annotation_path, encoding=ENCODING, dtype=str, keep_default_na=False)
+    df = df.sample(frac=valid_size, random_state=seed)
+    df = pd.DataFrame({'body': df.iloc[:, annotation_cols['body']], 'from': pd.to_numeric(df.iloc[:, annotation_cols['from']], errors='coerce')})
+
+    for checkpoint, role in [(a_checkpoint, 2), (q_checkpoint, 1)]:
+        reference = Extractor(checkpoint, role, 'torch', 'cpu')
+        candidate = Extractor(checkpoint, role, 'onnx')
+        texts = chunk_texts(df, [reference])
+        rows = np.flatnonzero(df['from'].values == role)
+        if len(rows) == 0: continue
+        windows = tokenize(texts, reference.tokenizer)
+
+        window_ids = np.flatnonzero(np.isin(windows.sample, rows))
+        batches = [(input_ids, mask) for _, input_ids, mask in iter_batches(windows, window_ids, reference.tokenizer.pad_token_id)]
+        results = compare_backends(reference.model, candidate.model, batches)
+        same_text = np.mean([a == b for a, b in zip(reference.extract(texts, windows, rows), candidate.extract(texts, windows, rows))])
+
+        print(f"{checkpoint} on {len(rows)} emails: max logit difference {results['max_logit_diff']:.4f}, "
+              f"token label agreement {results['label_agreement']:.2%}, same extracted text {same_text:.2%}")
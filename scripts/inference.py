@@ -0,0 +1,132 @@
+"""
+Inference backends for the transformers models of the extraction and
+classification steps. Models run with PyTorch, or are exported to ONNX and
+run with ONNX Runtime on the CPU, optionally with dynamic int8 quantization.
+
+The backend is chosen with the [inference] section of config.ini.
+
+Main method to use: load_backend
+"""
+import os
+import configparser
+import numpy as np
+import torch
+from transformers import AutoConfig, AutoTokenizer, AutoModelForTokenClassification, AutoModelForSequenceClassification
+from typing import Dict, List, Tuple
+from shared_defns import get_filepath
+
+# Constants
+config = configparser.ConfigParser()
+config.read('config.ini')
+BACKEND = config['inference']['BACKEND']
+ONNX_DIR = get_filepath(config, 'inference', 'ONNX_DIR')
+QUANTIZE = eval(config['inference']['QUANTIZE'])
+INTRA_OP_THREADS = int(config['inference']['INTRA_OP_THREADS'])
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+model_classes = {
+    'token-classification': AutoModelForTokenClassification,
+    'text-classification': AutoModelForSequenceClassification,
+}
+
+class TorchBackend:
+    """
+    Runs a model with PyTorch, on the GPU if there is one
+    """
+    id2label: Dict[int, str]
+
+    def __init__(self, checkpoint: str, task: str, model_device: str=device) -> None:
+        self.model = model_classes[task].from_pretrained(checkpoint).to(model_device).eval()
+        self.device = model_device
+        self.id2label = self.model.config.id2label
+
+    def __call__(self, input_ids: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        """
+        Runs a forward pass, returning the logits
+        """
+        with torch.no_grad():
+            logits = self.model(input_ids=torch.from_numpy(input_ids).to(self.device),
+                                attention_mask=torch.from_numpy(attention_mask).to(self.device)).logits
+        return logits.float().cpu().numpy()
+
+class OnnxBackend:
+    """
+    Runs a model exported to ONNX with ONNX Runtime on the CPU
+    """
+    id2label: Dict[int, str]
+
+    def __init__(self, checkpoint: str, task: str, quantize: bool=QUANTIZE, threads: int=INTRA_OP_THREADS) -> None:
+        import onnxruntime as ort # only needed for this backend
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(export_onnx(checkpoint, task, quantize), options, providers=['CPUExecutionProvider'])
+        self.id2label = AutoConfig.from_pretrained(checkpoint).id2label
+
+    def __call__(self, input_ids: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+        """
+        Runs a forward pass, returning the logits
+        """
+        return self.session.run(['logits'], {'input_ids': input_ids, 'attention_mask': attention_mask})[0]
+
+def export_onnx(checkpoint: str, task: str, quantize: bool) -> str:
+    """
+    Exports a model to ONNX in ONNX_DIR, with dynamic int8 quantization if quantize is set
+    Models that were already exported are reused. Returns the path of the model file.
+    """
+    out_dir = os.path.join(ONNX_DIR, checkpoint.replace('/', '__'))
+    model_path = os.path.join(out_dir, 'model.onnx')
+    quantized_path = os.path.join(out_dir, 'model_int8.onnx')
+
+    if not os.path.exists(model_path):
+        print(f"Exporting {checkpoint} to ONNX")
+        os.makedirs(out_dir, exist_ok=True)
+        model = model_classes[task].from_pretrained(checkpoint).eval()
+        dummy = AutoTokenizer.from_pretrained(checkpoint)(["Exporting the model"], return_tensors='pt')
+        logits_axes = {0: 'batch', 1: 'sequence'} if task == 'token-classification' else {0: 'batch'}
+        torch.onnx.export(model, (dummy['input_ids'], dummy['attention_mask']), model_path,
+                          input_names=['input_ids', 'attention_mask'], output_names=['logits'],
+                          dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                                        'attention_mask': {0: 'batch', 1: 'sequence'},
+                                        'logits': logits_axes},
+                          opset_version=14)
+
+    if not quantize: return model_path
+
+    if not os.path.exists(quantized_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        print(f"Quantizing {checkpoint} to int8")
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+
+    return quantized_path
+
+def load_backend(checkpoint: str, task: str, backend: str=BACKEND, model_device: str=device):
+    """
+    Loads a model with the backend chosen in the config, either 'torch' or 'onnx'
+    """
+    if backend == 'onnx':
+        return OnnxBackend(checkpoint, task)
+    elif backend == 'torch':
+        return TorchBackend(checkpoint, task, model_device)
+    raise ValueError(f"Unknown inference backend {backend}")
+
+def compare_backends(reference, candidate, batches: List[Tuple[np.ndarray, np.ndarray]]) -> Dict[str, float]:
+    """
+    Runs both backends over the same batches, and compares their outputs
+    Returns the largest absolute difference in logits and the fraction of matching predicted labels,
+    ignoring padding
+    """
+    max_diff = 0
+    matching = total = 0
+
+    for input_ids, attention_mask in batches:
+        ref_logits = reference(input_ids, attention_mask)
+        cand_logits = candidate(input_ids, attention_mask)
+        mask = attention_mask.astype(bool) if ref_logits.ndim == 3 else np.ones(ref_logits.shape[0], dtype=bool)
+
+        max_diff = max(max_diff, float(np.abs(ref_logits - cand_logits)[mask].max()))
+        matching += int((ref_logits.argmax(axis=-1) == cand_logits.argmax(axis=-1))[mask].sum())
+        total += int(mask.sum())
+
+    return {'max_logit_diff': max_diff, 'label_agreement': matching / total if total else 1}
@@ -0,0 +1,262 @@
+"""
+Timers, counters and memory sampling for the steps, saved as a report of each run.
+
+Sub-steps are timed with `with timer('tokenize', items=len(texts)):`, and timers opened inside
+another one are named after it, e.g. "extract_contents/tokenize". Events like cache hits are
+counted with count('token_cache_hits'). While a run is open (see run), a thread samples the
+resident memory of the process, and each timer keeps the peak reached while it was open.
+When the run ends, the wall time, calls, items/sec and peak memory of every timer, and the
+counters, are saved as JSON and csv files in REPORT_DIR.
+
+With PROFILER = cprofile, the run is also profiled with cProfile, and the stats are saved next
+to the report (open them with pstats or snakeviz). With PROFILER = py-spy, py-spy records the
+process while the run is open, if it is installed, and saves a speedscope profile.
+
+Timers cost a few microseconds, so they can be used once per email. Outside a run, timers
+and counters still add up, and write_report saves them, e.g. at the end of a notebook.
+
+Main methods to use: run, timer, count, add_counts, write_report
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import cProfile
+import threading
+import subprocess
+import configparser
+import pandas as pd
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Optional
+from shared_defns import get_filepath
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+# Constants
+config = configparser.ConfigParser()
+config.read('config.ini')
+REPORT_DIR = get_filepath(config, 'instrumentation', 'REPORT_DIR')
+MEMORY_INTERVAL = float(config['instrumentation']['MEMORY_INTERVAL'])
+PROFILER = config['instrumentation']['PROFILER']
+
+def resident_memory() -> int:
+    """
+    Resident memory of the process in bytes, 0 if it can't be read
+    Uses psutil if installed, otherwise /proc, or the maximum resident memory so far on other systems
+    """
+    if psutil:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        if resource is None: return 0
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+class TimerStats:
+    """
+    Totals of a named timer
+    """
+    calls: int
+    seconds: float
+    items: int
+    peak_memory: int
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.seconds = 0.
+        self.items = 0
+        self.peak_memory = 0
+
+class Timer:
+    """
+    Times one use of a named timer, set items to the number of items processed if not known beforehand
+    """
+    def __init__(self, metrics: 'Metrics', name: str, items: int) -> None:
+        self.metrics = metrics
+        self.name = name
+        self.items = items
+        self.peak_memory = metrics.memory
+
+    def __enter__(self):
+        stack = self.metrics.stack
+        if stack: self.name = f'{stack[-1].name}/{self.name}'
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.start
+        self.metrics.stack.remove(self)
+        stats = self.metrics.timers.get(self.name)
+        if stats is None:
+            stats = self.metrics.timers[self.name] = TimerStats()
+        stats.calls += 1
+        stats.seconds += elapsed
+        stats.items += self.items
+        stats.peak_memory = max(stats.peak_memory, self.peak_memory, self.metrics.memory)
+
+class Metrics:
+    """
+    Timers and counters of a run, with the resident memory sampled in a thread while it runs
+    """
+    name: str
+    started: datetime
+    timers: Dict[str, TimerStats]
+    counters: Counter
+    stack: List[Timer]
+    memory: int        # last sampled resident memory
+    peak_memory: int
+    running: bool      # whether this is the metrics of an open run
+
+    def __init__(self, name: str='metrics') -> None:
+        self.name = name
+        self.started = datetime.now()
+        self.start = time.perf_counter()
+        self.timers = {}
+        self.counters = Counter()
+        self.stack = []
+        self.memory = self.peak_memory = 0
+        self.sampling = None
+        self.running = False
+
+    def sample_memory(self, interval: float):
+        while not self.sampling.wait(interval):
+            self.update_memory()
+
+    def update_memory(self):
+        self.memory = resident_memory()
+        self.peak_memory = max(self.peak_memory, self.memory)
+        for timer in list(self.stack):
+            timer.peak_memory = max(timer.peak_memory, self.memory)
+
+    def start_sampling(self, interval: float=MEMORY_INTERVAL):
+        self.update_memory()
+        if interval <= 0: return
+        self.sampling = threading.Event()
+        threading.Thread(target=self.sample_memory, args=(interval,), daemon=True).start()
+
+    def stop_sampling(self):
+        if self.sampling: self.sampling.set()
+        self.update_memory()
+
+    def report(self) -> Dict:
+        """
+        The timers and counters, with the wall time and peak memory of the run
+        """
+        timers = [{'name': name, 'calls': stats.calls, 'seconds': round(stats.seconds, 6), 'items': stats.items,
+                   'items_per_second': round(stats.items / stats.seconds, 3) if stats.items and stats.seconds else None,
+                   'peak_memory_mb': round(stats.peak_memory / 2**20, 1) if stats.peak_memory else None}
+                  for name, stats in self.timers.items()]
+        return {'run': self.name, 'started': self.started.isoformat(timespec='seconds'), 'pid': os.getpid(),
+                'wall_seconds': round(time.perf_counter() - self.start, 3),
+                'peak_memory_mb': round(self.peak_memory / 2**20, 1) if self.peak_memory else None,
+                'timers': timers, 'counters': dict(self.counters)}
+
+metrics = Metrics()
+
+def timer(name: str, items: int=0) -> Timer:
+    return Timer(metrics, name, items)
+
+def count(name: str, n: int=1):
+    metrics.counters[name] += n
+
+def add_counts(counts: Dict[str, int], prefix: str=''):
+    """
+    Adds counts kept by other code, e.g. the paths of ReplyHeaderParser, with prefix added to their names
+    """
+    for name, n in counts.items():
+        metrics.counters[prefix + name] += n
+
+def report_path(name: str, extension: str, started: datetime, report_dir: str=REPORT_DIR) -> str:
+    return os.path.join(report_dir, f"{name}_{started.strftime('%Y%m%d-%H%M%S')}.{extension}")
+
+def write_report(name: Optional[str]=None, report_dir: str=REPORT_DIR) -> str:
+    """
+    Saves the timers and counters so far as JSON and csv, returns the path of the JSON file
+    The csv file has a row for each timer, followed by a row for each counter
+    """
+    if name: metrics.name = name
+    report = metrics.report()
+    os.makedirs(report_dir, exist_ok=True)
+    path = report_path(metrics.name, 'json', metrics.started, report_dir)
+    with open(path, 'w') as file:
+        json.dump(report, file, indent=1)
+
+    rows = [{'kind': 'timer', **row} for row in report['timers']]
+    rows += [{'kind': 'counter', 'name': name, 'count': n} for name, n in report['counters'].items()]
+    df = pd.DataFrame(rows, columns=['kind', 'name', 'calls', 'seconds', 'items', 'items_per_second', 'peak_memory_mb', 'count'])
+    df.astype({'calls': 'Int64', 'items': 'Int64', 'count': 'Int64'}).to_csv(report_path(metrics.name, 'csv', metrics.started, report_dir), index=False)
+    return path
+
+def start_profiler(name: str, started: datetime, profiler: str=PROFILER, report_dir: str=REPORT_DIR):
+    """
+    Starts the profiler set in the config, returns a function that stops it and saves its output
+    """
+    os.makedirs(report_dir, exist_ok=True)
+    if profiler == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+
+        def stop():
+            profile.disable()
+            profile.dump_stats(report_path(name, 'prof', started, report_dir))
+        return stop
+
+    if profiler == 'py-spy':
+        if shutil.which('py-spy') is None:
+            print("PROFILER is py-spy, but py-spy is not installed (pip install py-spy)")
+            return None
+        if os.name == 'nt':
+            # py-spy can't be stopped with SIGINT on Windows, attach it by hand instead
+            print(f"Run py-spy record --pid {os.getpid()} --format speedscope in another terminal to profile this run")
+            return None
+        recorder = subprocess.Popen(['py-spy', 'record', '--pid', str(os.getpid()), '--format', 'speedscope',
+                                     '--output', report_path(name, 'speedscope.json', started, report_dir)])
+
+        def stop():
+            recorder.send_signal(signal.SIGINT) # py-spy saves the profile when interrupted
+            recorder.wait()
+        return stop
+
+    return None
+
+@contextmanager
+def run(name: str, report_dir: str=REPORT_DIR, memory_interval: float=MEMORY_INTERVAL):
+    """
+    Opens a run: resets the timers and counters, samples the memory every memory_interval seconds and starts the profiler set in the config
+    The report is saved when the run ends, even on errors. Can also decorate the entry point of a step.
+    Inside another run, e.g. a step run by run_pipeline.py, it only times its contents under name.
+    """
+    global metrics
+    if metrics.running:
+        if metrics.stack and metrics.stack[-1].name.split('/')[-1] == name:
+            yield metrics # already timed under this name by the caller
+        else:
+            with timer(name):
+                yield metrics
+        return
+
+    metrics = Metrics(name)
+    metrics.running = True
+    metrics.start_sampling(memory_interval)
+    stop_profiler = start_profiler(name, metrics.started, report_dir=report_dir)
+    try:
+        yield metrics
+    finally:
+        if stop_profiler: stop_profiler()
+        metrics.stop_sampling()
+        metrics.running = False
+        print(f"Saved the run report to {write_report(report_dir=report_dir)}")
@@ -0,0 +1,84 @@
+"""
+Local snapshot of the raw Outlook mail items, stored in a SQLite file.
+Lets the emails be parsed and scrubbed again without access to Outlook.
+
+Main class to use: MailSnapshot
+"""
+import sqlite3
+from datetime import datetime
+from typing import NamedTuple, Iterator, Tuple, Optional
+
+# Raw fields of a sent mail item, before any parsing or scrubbing
+class RawMessage(NamedTuple):
+    entry_id: str
+    sent_on: datetime
+    subject: str
+    body: str
+    recipient_address: str
+
+class MailSnapshot:
+    """
+    Append-only store of raw mail items, keyed by their Outlook EntryID
+    """
+    connection: sqlite3.Connection
+
+    def __init__(self, filepath: str) -> None:
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                entry_id TEXT PRIMARY KEY,
+                sent_on TEXT,
+                subject TEXT,
+                body TEXT,
+                recipient_address TEXT
+            )""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS messages_sent_on ON messages (sent_on)")
+
+    def __contains__(self, entry_id: str) -> bool:
+        return self.connection.execute("SELECT 1 FROM messages WHERE entry_id = ?", (entry_id,)).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def add(self, message: RawMessage):
+        """
+        Add a message to the snapshot, ignoring messages that were already saved
+        Call commit to write the added messages to disk
+        """
+        sent_on = message.sent_on.isoformat() if message.sent_on else None
+        self.connection.execute("INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?)",
+                                (message.entry_id, sent_on, message.subject, message.body, message.recipient_address))
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def count(self, after: Optional[datetime]=None) -> int:
+        """
+        Number of saved messages, or of messages sent after the given (naive) date
+        """
+        if after is None: return len(self)
+        return self.connection.execute("SELECT COUNT(*) FROM messages WHERE sent_on > ?", (after.isoformat(),)).fetchone()[0]
+
+    def messages(self, exclude_dates: Optional[Tuple[datetime,datetime]]=None, after: Optional[datetime]=None) -> Iterator[RawMessage]:
+        """
+        Iterate over the saved messages, most recently sent first
+        If exclude_dates is given, skips messages sent within that (naive) date range
+        If after is given, only messages sent after that (naive) date are read
+        """
+        if after is None:
+            cursor = self.connection.execute("SELECT * FROM messages ORDER BY sent_on DESC")
+        else:
+            # Dates are saved in ISO format, so they compare as strings. A date with a time zone
+            # compares as later than the same naive date, so it is also filtered after reading.
+            cursor = self.connection.execute("SELECT * FROM messages WHERE sent_on > ? ORDER BY sent_on DESC", (after.isoformat(),))
+        for entry_id, sent_on, subject, body, recipient_address in cursor:
+            sent_on = datetime.fromisoformat(sent_on) if sent_on else None
+            if exclude_dates and sent_on and exclude_dates[0] <= sent_on.replace(tzinfo=None) <= exclude_dates[1]:
+                continue
+            if after and sent_on and sent_on.replace(tzinfo=None) <= after:
+                continue
+            yield RawMessage(entry_id, sent_on, subject, body, recipient_address)
@@ -0,0 +1,149 @@
+"""
+Parser of the headers of quoted replies, e.g. "On Mon, Jan 8, 2024 at 3:45 PM Name <address> wrote:"
+or the From/Sent/To/Subject block of Outlook.
+
+The common Outlook and Gmail formats are matched with precompiled patterns and parsed with strict
+strptime formats. Only headers that match none of them are parsed with dateparser, which is much
+slower, and its results are memoized by header text. The number of headers parsed by each path is
+counted, see ReplyHeaderParser.report.
+
+Main class to use: ReplyHeaderParser
+"""
+import re as re
+import dateparser
+import dateparser.search
+from collections import Counter, OrderedDict
+from datetime import datetime
+from typing import List, NamedTuple, Optional, Tuple
+
+DATEPARSER_SETTINGS = {'RETURN_AS_TIMEZONE_AWARE': True}
+
+# "On <date>, <name> wrote:" headers, with the strptime formats of the date
+WROTE_PATTERNS = [
+    # Gmail: On Mon, Jan 8, 2024 at 3:45 PM John Smith <john@example.com> wrote:
+    (re.compile(r'On (?P<date>[A-Z][a-z]{2}, [A-Z][a-z]{2} \d{1,2}, \d{4} at \d{1,2}:\d{2}\s*[AaPp][Mm])(?P<from>.*?)wrote:', re.DOTALL),
+     ['%a, %b %d, %Y at %I:%M %p']),
+    # Apple Mail and Outlook mobile: On Jan 8, 2024, at 3:45 PM, John Smith <john@example.com> wrote:
+    (re.compile(r'On (?P<date>[A-Z][a-z]{2,8} \d{1,2}, \d{4},? at \d{1,2}:\d{2}\s*[AaPp][Mm])(?P<from>.*?)wrote:', re.DOTALL),
+     ['%b %d, %Y, at %I:%M %p', '%b %d, %Y at %I:%M %p', '%B %d, %Y, at %I:%M %p', '%B %d, %Y at %I:%M %p']),
+    # Thunderbird: On 2024-01-08 15:45, John Smith wrote:
+    (re.compile(r'On (?P<date>\d{4}-\d{2}-\d{2},? \d{1,2}:\d{2}(?::\d{2})?)(?P<from>.*?)wrote:', re.DOTALL),
+     ['%Y-%m-%d %H:%M', '%Y-%m-%d, %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d, %H:%M:%S']),
+]
+
+# Dates of the Sent: or Date: line of Outlook headers
+SENT_FORMATS = [
+    '%A, %B %d, %Y %I:%M %p',       # Monday, January 8, 2024 3:45 PM
+    '%A, %B %d, %Y at %I:%M %p',    # Monday, January 8, 2024 at 3:45 PM
+    '%A, %B %d, %Y %I:%M:%S %p',    # Monday, January 8, 2024 3:45:12 PM
+    '%B %d, %Y %I:%M %p',           # January 8, 2024 3:45 PM
+    '%A, %d %B %Y %H:%M',           # Monday, 8 January 2024 15:45
+    '%d %B %Y %H:%M',               # 08 January 2024 15:45
+    '%a, %d %b %Y %H:%M:%S %z',     # Mon, 8 Jan 2024 15:45:12 -0800
+    '%a, %d %b %Y %H:%M %z',        # Mon, 8 Jan 2024 15:45 -0800
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M',
+]
+
+from_regex = re.compile('From:?.*')
+to_regex = re.compile('(To|Cc):?.*')
+sent_regex = re.compile('((?<=Sent: )|(?<=Sent )|(?<=Date: )|(?<=Date )).*')
+subject_regex = re.compile('((?<=Subject: )|(?<=Subject ))(.|\n)*')
+meridiem_regex = re.compile(r'(?<=\d)(?=[AaPp][Mm]\b)')
+
+class ReplyHeader(NamedTuple):
+    date: Optional[datetime]
+    from_text: Optional[str]
+    to_text: Optional[str]
+    subject: Optional[str]
+
+def strict_date(text: str, formats: List[str]) -> Optional[datetime]:
+    """
+    Parses the date with the first strptime format that matches all of it
+    Dates without a timezone are in the local timezone, as dateparser returns them
+    """
+    text = meridiem_regex.sub(' ', ' '.join(text.split()))
+    for date_format in formats:
+        try:
+            date = datetime.strptime(text, date_format)
+        except ValueError:
+            continue
+        return date if date.tzinfo else date.astimezone()
+    return None
+
+class ReplyHeaderParser:
+    """
+    Parses reply headers, trying the fast patterns before dateparser
+    counts has the number of headers parsed by each path
+    """
+    cache: OrderedDict
+    cache_size: int
+    counts: Counter
+
+    def __init__(self, cache_size: int=100000) -> None:
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.counts = Counter()
+
+    def memoized(self, kind: str, text: str, parse):
+        """
+        Result of a dateparser call for the text, parsed once for each text
+        """
+        key = (kind, text)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.counts[f'{kind}_memoized'] += 1
+            return self.cache[key]
+        self.counts[f'{kind}_dateparser'] += 1
+        result = self.cache[key] = parse(text)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return result
+
+    def search_date(self, headers: str) -> Optional[Tuple[str, datetime]]:
+        dates = self.memoized('search', headers, lambda text: dateparser.search.search_dates(text, settings=DATEPARSER_SETTINGS))
+        return dates[0] if dates else None
+
+    def parse_wrote(self, headers: str) -> ReplyHeader:
+        """
+        Parses a header like "On <date>, <name> wrote:"
+        Raises TypeError if no date is found, as the dateparser search does
+        """
+        for pattern, formats in WROTE_PATTERNS:
+            if (match := pattern.search(headers)) and (date := strict_date(match.group('date'), formats)):
+                self.counts['wrote_fast'] += 1
+                return ReplyHeader(date, match.group('from'), None, '')
+
+        (date_text, date) = self.search_date(headers)
+        from_text = re.search(f'(?<={re.escape(date_text)})(.|\n)*(?=wrote:)', headers).group()
+        return ReplyHeader(date, from_text, None, '')
+
+    def parse_block(self, headers: str) -> ReplyHeader:
+        """
+        Parses a block of From/To/Sent/Subject lines
+        """
+        from_line = to_line = date = subject = None
+        if match := from_regex.search(headers): from_line = match.group()
+        if match := to_regex.search(headers): to_line = match.group()
+        if match := sent_regex.search(headers):
+            date_text = match.group().strip()
+            if date := strict_date(date_text, SENT_FORMATS):
+                self.counts['sent_fast'] += 1
+            else:
+                date = self.memoized('sent', date_text, lambda text: dateparser.parse(text, settings=DATEPARSER_SETTINGS))
+        elif found := self.search_date(headers):
+            (_, date) = found
+        if match := subject_regex.search(headers): subject = match.group()
+        return ReplyHeader(date, from_line, to_line, subject)
+
+    def parse(self, headers: str) -> ReplyHeader:
+        return self.parse_wrote(headers) if 'wrote:' in headers else self.parse_block(headers)
+
+    def report(self) -> str:
+        """
+        Share of the headers parsed by each path
+        """
+        total = sum(self.counts.values())
+        if total == 0: return "No reply headers parsed"
+        paths = ', '.join(f"{path} {count / total:.1%}" for path, count in sorted(self.counts.items()))
+        return f"Parsed {total} reply headers: {paths}"
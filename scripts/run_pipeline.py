@@ -0,0 +1,305 @@
+"""
+Runs the steps after the email download in a single process: keyword filter,
+content extraction, pairing, classification, clustering, topic merges and the
+index of similar pairs.
+
+Each step passes its output to the next one in memory, and also saves it to
+its output file. A step is skipped when its input, its config sections, the
+files it uses and its code are unchanged since the last run, and its saved
+output is used instead. Steps whose input is unchanged don't need to load it,
+so re-running after editing the topic merges only runs the merges.
+The fingerprints of the last run are kept in STATE_FILE. The time, throughput and
+peak memory of each step and its sub-steps are saved in a run report, see instrumentation.py.
+
+With INCREMENTAL, a step whose input only changed by new emails (see INCREMENTAL in
+1_download_emails.py) runs on the new conversations only, and adds them to its previous
+output. Conversations that were replaced by a longer copy are removed from the outputs.
+New pairs are assigned to the topics of the saved models instead of clustering again.
+
+Main method to use: run_pipeline
+"""
+import os
+import json
+import time
+import hashlib
+import importlib
+import configparser
+import numpy as np
+import pandas as pd
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from shared_defns import *
+from storage import read_table, write_table, table_exists, stage_path
+from instrumentation import run, timer, count
+
+# Constants
+config = configparser.ConfigParser()
+config.read('config.ini')
+STATE_FILE = get_filepath(config, 'run_pipeline', 'STATE_FILE')
+INCREMENTAL = eval(config['run_pipeline']['INCREMENTAL'])
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def run_keyword_filter(df: pd.DataFrame, fingerprint: str) -> pd.DataFrame:
+    keyword_filter = importlib.import_module('2_keyword_filter')
+    predicates = keyword_filter.make_predicates(
+        keyword_filter.read_keywords(get_filepath(config, 'keyword_filter', 'HEADER_KW_FILE')),
+        keyword_filter.read_keywords(get_filepath(config, 'keyword_filter', 'BODY_KW_FILE')))
+    return keyword_filter.simple_filter(df, predicates)
+
+def run_extraction(df: pd.DataFrame, fingerprint: str) -> pd.DataFrame:
+    import extraction
+    return extraction.from_dataframe(df, get_filepath(config, 'extract_contents', 'OUT_FILE'), fingerprint)
+
+def run_make_pairs(df: pd.DataFrame, fingerprint: str) -> pd.DataFrame:
+    return importlib.import_module('4_make_pairs').make_pairs(df)
+
+def run_classification(df: pd.DataFrame, fingerprint: str) -> pd.DataFrame:
+    import classification
+    return classification.classify_pairs(df)
+
+def embedding_device() -> str:
+    import torch
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+def run_clustering(df: pd.DataFrame, fingerprint: str) -> pd.DataFrame:
+    import clustering
+    texts = clustering.pair_texts(df)
+    embeddings = clustering.create_embeddings(texts, embedding_device(), get_filepath(config, 'cluster_emails', 'OUT_PATH_EMBEDDINGS'))
+    clusters, _ = clustering.cluster_pairs(texts, embeddings, get_filepath(config, 'cluster_emails', 'OUT_PATH_MODEL'),
+                                           os.path.join(get_filepath(config, 'cluster_emails', 'OUT_PATH_EMBEDDINGS'), 'reduced'))
+    return clusters
+
+def update_clustering(df: pd.DataFrame, keep: np.ndarray) -> pd.DataFrame:
+    import clustering
+    model_dir = get_filepath(config, 'cluster_emails', 'OUT_PATH_MODEL')
+    texts = clustering.pair_texts(df)
+    embeddings = clustering.create_embeddings(texts, embedding_device(), get_filepath(config, 'cluster_emails', 'OUT_PATH_EMBEDDINGS'))
+    models = clustering.load_models('base', model_dir)
+    labels = clustering.add_pairs(models, texts, embeddings, keep)
+    clustering.save_models(models, 'base', model_dir)
+    return pd.DataFrame({'text_q': texts['questions'], 'label_q': labels['label_q'], 'text_a': texts['answers'],
+                         'label_a': labels['label_a'], 'label_c': labels['label_c']})
+
+def run_topic_merges(df: pd.DataFrame, fingerprint: str) -> pd.DataFrame:
+    import clustering
+    model_dir = get_filepath(config, 'cluster_emails', 'OUT_PATH_MODEL')
+    texts = clustering.pair_texts(df.rename(columns={'text_q': 'question', 'text_a': 'answer'}))
+    models = clustering.load_base_models(model_dir)
+    merges = clustering.read_topic_merges(get_filepath(config, 'merge_topics', 'TOPIC_MERGES_FILE'))
+    labels = clustering.apply_topic_merges(models, texts, merges)
+
+    clustering.save_models(models, 'merged', model_dir)
+    return pd.concat([df[['text_q', 'text_a']].reset_index(drop=True), labels], axis=1)
+
+def update_topic_merges(df: pd.DataFrame, keep: np.ndarray) -> pd.DataFrame:
+    import clustering
+    model_dir = get_filepath(config, 'cluster_emails', 'OUT_PATH_MODEL')
+    texts = clustering.pair_texts(df.rename(columns={'text_q': 'question', 'text_a': 'answer'}))
+    embeddings = clustering.load_embeddings(texts, get_filepath(config, 'cluster_emails', 'OUT_PATH_EMBEDDINGS'))
+
+    models = clustering.load_models('merged', model_dir)
+    labels = clustering.add_pairs(models, texts, embeddings, keep)
+    clustering.save_models(models, 'merged', model_dir)
+    return pd.concat([df[['text_q', 'text_a']].reset_index(drop=True), labels], axis=1)
+
+def index_paths() -> dict:
+    return {'directory': get_filepath(config, 'index_pairs', 'INDEX_DIR'), 'table_path': get_filepath(config, 'index_pairs', 'OUT_FILE'),
+            'embeddings_dir': get_filepath(config, 'cluster_emails', 'OUT_PATH_EMBEDDINGS')}
+
+def run_pair_index(df: pd.DataFrame, fingerprint: str) -> pd.DataFrame:
+    import similar_pairs
+    return similar_pairs.build_index(df, device=embedding_device(), **index_paths()).pairs
+
+def update_pair_index(df: pd.DataFrame, keep: np.ndarray) -> pd.DataFrame:
+    import similar_pairs
+    index = similar_pairs.update_index(df, keep, device=embedding_device(), **index_paths())
+    return index.pairs.iloc[len(index) - df.shape[0]:]
+
+class Stage(NamedTuple):
+    name: str                                         # Config section of the step
+    input: str                                        # Step whose output is the input of this step
+    run: Callable[[pd.DataFrame, str], pd.DataFrame]  # Runs the step on its input, given the fingerprint of the step
+    output: str                                       # Config option of the output file
+    sections: List[str]                               # Config sections that change the output
+    files: List[str]                                  # Config options of this step with files that change the output
+    code: List[str]                                   # Modules of the scripts folder that the step runs
+    enabled: bool = True
+    # Runs the step on new input rows, given which rows of the previous output are kept.
+    # If not set, the step runs on the new rows with run, which is only correct for steps
+    # that handle each conversation separately.
+    update: Optional[Callable[[pd.DataFrame, np.ndarray], pd.DataFrame]] = None
+
+stages = [
+    Stage('keyword_filter', 'download_emails', run_keyword_filter, 'OUT_FILE', ['keyword_filter'],
+          ['HEADER_KW_FILE', 'BODY_KW_FILE'], ['2_keyword_filter.py'], eval(config['keyword_filter']['ENABLED'])),
+    Stage('extract_contents', 'keyword_filter', run_extraction, 'OUT_FILE', ['extract_contents', 'inference'],
+          [], ['extraction.py', 'inference.py']),
+    Stage('make_pairs', 'extract_contents', run_make_pairs, 'OUT_FILE', ['make_pairs'], [], ['4_make_pairs.py']),
+    Stage('classify_emails', 'make_pairs', run_classification, 'OUT_FILE', ['classify_emails', 'inference'],
+          [], ['classification.py', 'inference.py'], eval(config['classify_emails']['ENABLED'])),
+    Stage('cluster_emails', 'make_pairs', run_clustering, 'OUT_FILE_EMAILS', ['cluster_emails'], [], ['clustering.py'],
+          update=update_clustering),
+    Stage('merge_topics', 'cluster_emails', run_topic_merges, 'OUT_FILE', ['merge_topics'], ['TOPIC_MERGES_FILE'], ['clustering.py', 'topic_curation.py'],
+          update=update_topic_merges),
+    Stage('index_pairs', 'make_pairs', run_pair_index, 'OUT_FILE', ['index_pairs', 'cluster_emails'], [],
+          ['similar_pairs.py', 'embedding_store.py'], update=update_pair_index),
+]
+
+class Output:
+    """
+    Output of a step, loaded from its file only when a later step needs it
+    If the step only added rows to its previous output, new has the added rows, and keep tells
+    which rows of the previous output are kept
+    """
+    path: str
+    content_hash: str
+    previous_hash: Optional[str]
+    df: Optional[pd.DataFrame]
+    new: Optional[pd.DataFrame]
+    keep: Optional[np.ndarray]
+
+    def __init__(self, path: str, content_hash: str, previous_hash: Optional[str]=None, df: Optional[pd.DataFrame]=None,
+                 new: Optional[pd.DataFrame]=None, keep: Optional[np.ndarray]=None) -> None:
+        self.path = path
+        self.content_hash = content_hash
+        self.previous_hash = previous_hash
+        self.df = df
+        self.new = new
+        self.keep = keep
+
+    def load(self) -> pd.DataFrame:
+        if self.df is None:
+            print(f"Loading {stage_path(self.path)}")
+            self.df = read_table(self.path)
+        return self.df
+
+def file_hash(filepath: str) -> str:
+    sha = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def table_hash(df: pd.DataFrame) -> str:
+    """
+    Hash of the contents of a dataframe, including its index and column names
+    """
+    sha = hashlib.sha256(json.dumps([str(column) for column in df.columns]).encode('utf-8'))
+    sha.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return sha.hexdigest()
+
+def stage_fingerprint(stage: Stage, input_hash: str) -> str:
+    """
+    Identifies everything that changes the output of a step
+    """
+    settings = {
+        'input': input_hash,
+        'config': {section: dict(config[section]) for section in stage.sections},
+        'files': {option: file_hash(get_filepath(config, stage.name, option)) for option in stage.files},
+        'code': {module: file_hash(os.path.join(SCRIPTS_DIR, module)) for module in stage.code},
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode('utf-8')).hexdigest()
+
+def read_state(filepath: str) -> Dict:
+    if not os.path.exists(filepath): return {}
+    with open(filepath) as file:
+        return json.load(file)
+
+def write_state(filepath: str, state: Dict):
+    # Write to a temporary file first, so an interruption can't leave a partial state file
+    with open(filepath + '.tmp', 'w') as file:
+        json.dump(state, file, indent=1)
+    os.replace(filepath + '.tmp', filepath)
+
+def can_update(stage: Stage, source: Output, previous: Dict, out_path: str) -> bool:
+    """
+    Whether the step can add the new rows of its input to its previous output: the previous output
+    was made from the previous version of the input, and nothing else the step depends on changed
+    """
+    return (source.new is not None and table_exists(out_path) and source.previous_hash is not None
+            and previous.get('input_hash') == source.previous_hash
+            and previous.get('fingerprint') == stage_fingerprint(stage, source.previous_hash))
+
+def update_stage(stage: Stage, source: Output, out_path: str, conversations: np.ndarray) -> Tuple[pd.DataFrame, pd.DataFrame, np.ndarray]:
+    """
+    Runs a step on the new rows of its input, and adds them to its previous output
+    Rows of the previous output are dropped if their conversation is not in conversations anymore,
+    or for outputs without a conversation column, if their input row was dropped.
+    Returns the whole output, the new rows and the previous rows that were kept
+    """
+    previous = read_table(out_path)
+    keep = previous['conversation'].isin(conversations).values if 'conversation' in previous else source.keep
+
+    if stage.update:
+        new = stage.update(source.new, keep)
+    elif source.new.shape[0] == 0:
+        new = previous.iloc[:0]
+    else:
+        # Identifies the new rows, so an interrupted extraction continues with the same rows
+        new = stage.run(source.new, stage_fingerprint(stage, table_hash(source.new)))
+
+    df = previous[keep].reset_index(drop=True) if new.shape[0] == 0 else pd.concat([previous[keep], new], ignore_index=True)
+    return df, new, keep
+
+@run('run_pipeline')
+def run_pipeline(state_path: str=STATE_FILE, incremental: bool=INCREMENTAL):
+    """
+    Runs every enabled step whose fingerprint changed since the last run
+    With incremental, steps whose input only has new conversations only run on those
+    """
+    state = read_state(state_path)
+    download_path = get_filepath(config, 'download_emails', 'OUT_FILE')
+    previous_download = state.get('download_emails', {})
+    download = Output(download_path, file_hash(stage_path(download_path)), previous_download.get('output_hash'))
+    outputs = {'download_emails': download}
+
+    # Conversations are numbered in the order they were added, so new ones come after the last one of the previous run
+    conversations = None
+    if incremental and 'last_conversation' in previous_download and download.content_hash != download.previous_hash:
+        emails = download.load()
+        conversations = emails['conversation'].unique()
+        download.new = emails[emails['conversation'] > previous_download['last_conversation']]
+        print(f"{download.new['conversation'].nunique()} new conversations since the last run")
+
+    for stage in stages:
+        source = outputs[stage.input]
+        if not stage.enabled:
+            print(f"{stage.name}: disabled")
+            outputs[stage.name] = source # the next step uses the input of this one
+            continue
+
+        out_path = get_filepath(config, stage.name, stage.output)
+        fingerprint = stage_fingerprint(stage, source.content_hash)
+        previous = state.get(stage.name, {})
+        if previous.get('fingerprint') == fingerprint and table_exists(out_path):
+            print(f"{stage.name}: unchanged, using {stage_path(out_path)}")
+            count('unchanged_steps')
+            outputs[stage.name] = Output(out_path, previous['output_hash'], previous['output_hash'])
+            continue
+
+        start = time.perf_counter()
+        new = keep = None
+        with timer(stage.name) as stage_timer:
+            if can_update(stage, source, previous, out_path):
+                print(f"{stage.name}: adding {source.new.shape[0]} new rows")
+                stage_timer.items = source.new.shape[0]
+                df, new, keep = update_stage(stage, source, out_path, conversations)
+            else:
+                print(f"{stage.name}: running")
+                stage_timer.items = source.load().shape[0]
+                df = stage.run(source.df, fingerprint)
+            write_table(df, out_path)
+        outputs[stage.name] = Output(out_path, table_hash(df), previous.get('output_hash'), df, new, keep)
+
+        state[stage.name] = {'fingerprint': fingerprint, 'input_hash': source.content_hash, 'output_hash': outputs[stage.name].content_hash}
+        write_state(state_path, state)
+        print(f"{stage.name}: saved {df.shape[0]} rows to {stage_path(out_path)} in {time.perf_counter() - start:.1f}s")
+
+    if download.df is not None and download.df.shape[0]:
+        state['download_emails'] = {'output_hash': download.content_hash, 'last_conversation': int(download.df['conversation'].max())}
+        write_state(state_path, state)
+
+def main():
+    run_pipeline()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""
+Scrubadub cleaner used to strip personal information from emails, a pool
+of worker processes that applies it in batches, and a persistent cache of
+the results.
+
+Main classes to use: ScrubPool, ScrubCache
+"""
+import re as re
+import hashlib
+import inspect
+import importlib.metadata
+import sqlite3
+import spacy
+import scrubadub, scrubadub_spacy
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Tuple, Any, Optional
+from instrumentation import count
+
+# Spacy model used by the name detector, a RoBERTa model
+SPACY_MODEL = 'en_core_web_trf'
+
+# Initialize the data scrubber
+class StudentInfoFilth(scrubadub.filth.Filth):
+    type = 'student-info'
+
+@scrubadub.detectors.register_detector
+class StudentIDDetector(scrubadub.detectors.RegexDetector):
+    """
+    Filth detector for scrubadub, finds student ids
+    Likely to cause some false positives
+    """
+    autoload = True
+    name = 'student-id'
+    regex = re.compile("(\D|\A)(\d{8}|\d{4}-\d{4}|\d{4}\s\d{4})(\D|\Z)")
+    filth_cls = StudentInfoFilth
+
+def make_scrubber() -> scrubadub.Scrubber:
+    """
+    Creates the scrubber with all detectors used for the emails
+    Loads the spacy model, so only call this once per process
+    """
+    scrubber = scrubadub.Scrubber() # Includes all default detectors: email, phone, etc.
+    scrubber.remove_detector('url') # Don't scrub urls, they may be useful
+    scrubber._detectors["email"].at_matcher = "@" # Make the email scrubber more strict, otherwise we get false positives
+    scrubber.add_detector(scrubadub.detectors.DateOfBirthDetector)
+    person_name_detector = scrubadub_spacy.detectors.spacy.SpacyEntityDetector(named_entities=['PERSON'], model=SPACY_MODEL)
+    scrubber.add_detector(person_name_detector)
+    return scrubber
+
+# Scrubber owned by a worker process, created by the pool initializer
+worker_scrubber = None
+
+def init_worker():
+    global worker_scrubber
+    worker_scrubber = make_scrubber()
+
+def clean_batch(texts: List[str]) -> List[str]:
+    """
+    Cleans a batch of texts with the scrubber of this process
+    All documents go through the spacy detector together, so the model runs with nlp.pipe batching
+    """
+    return list(worker_scrubber.clean_documents(texts))
+
+def scrubber_fingerprint() -> str:
+    """
+    Identifies the scrubber configuration, so cached results are not reused once it changes
+    The version of the spacy model is read from its meta.json, so the model isn't loaded here
+    """
+    model_meta = spacy.util.get_model_meta(spacy.util.get_package_path(SPACY_MODEL))
+    settings = [
+        inspect.getsource(make_scrubber),
+        StudentIDDetector.regex.pattern,
+        importlib.metadata.version('scrubadub'),
+        importlib.metadata.version('scrubadub-spacy'),
+        spacy.__version__,
+        SPACY_MODEL,
+        model_meta['version'],
+    ]
+    return hashlib.sha256('\0'.join(settings).encode('utf-8')).hexdigest()
+
+class ScrubCache:
+    """
+    Persistent cache of scrubbed texts, keyed by a hash of the scrubber configuration and the input text
+    Recently used entries are also kept in memory, up to max_items
+    """
+    connection: sqlite3.Connection
+    fingerprint: str
+    max_items: int
+    recent: OrderedDict
+    hits: int
+    misses: int
+
+    def __init__(self, filepath: str, max_items: int) -> None:
+        self.connection = sqlite3.connect(filepath)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS scrubbed (key BLOB PRIMARY KEY, text TEXT)")
+        self.fingerprint = scrubber_fingerprint()
+        self.max_items = max_items
+        self.recent = OrderedDict()
+        self.hits = self.misses = 0
+
+    def key(self, text: str) -> bytes:
+        return hashlib.sha256(f'{self.fingerprint}\0{text}'.encode('utf-8')).digest()
+
+    def remember(self, key: bytes, cleaned: str):
+        self.recent[key] = cleaned
+        self.recent.move_to_end(key)
+        if len(self.recent) > self.max_items:
+            self.recent.popitem(last=False)
+
+    def get(self, text: str) -> Optional[str]:
+        """
+        Returns the scrubbed text if it was cached, otherwise None
+        """
+        key = self.key(text)
+        if key in self.recent:
+            self.recent.move_to_end(key)
+            self.hits += 1
+            return self.recent[key]
+
+        if row := self.connection.execute("SELECT text FROM scrubbed WHERE key = ?", (key,)).fetchone():
+            self.remember(key, row[0])
+            self.hits += 1
+            return row[0]
+
+        self.misses += 1
+        return None
+
+    def put(self, text: str, cleaned: str):
+        key = self.key(text)
+        self.remember(key, cleaned)
+        self.connection.execute("INSERT OR REPLACE INTO scrubbed VALUES (?, ?)", (key, cleaned))
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+class ScrubPool:
+    """
+    Scrubs the body and header of messages in a pool of worker processes
+
+    Messages are submitted as dicts, and cleaned in place once their batch returns.
+    Texts found in the cache, or already waiting to be scrubbed, are not sent to the workers again.
+    With 0 workers, batches are cleaned in the current process instead.
+    """
+    workers: int
+    batch_size: int
+    cache: Optional[ScrubCache]
+    executor: ProcessPoolExecutor
+    pending: Dict[str, List[Tuple[Dict, str]]]
+    buffer: List[str]
+    in_flight: List[Tuple[Any, List[str]]]
+    duplicates: int
+
+    def __init__(self, workers: int, batch_size: int, cache: Optional[ScrubCache]=None) -> None:
+        self.workers = workers
+        self.batch_size = batch_size
+        self.cache = cache
+        self.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_worker) if workers > 0 else None
+        self.pending = {}
+        self.buffer = []
+        self.in_flight = []
+        self.duplicates = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, messages: List[Dict]):
+        """
+        Queue the body and header of each message to be scrubbed
+        """
+        for message in messages:
+            for key in ('body', 'header'):
+                text = message[key]
+                if not text: continue
+
+                if text in self.pending:
+                    # Same text is already waiting to be scrubbed
+                    self.pending[text].append((message, key))
+                    self.duplicates += 1
+                elif self.cache and (cleaned := self.cache.get(text)) is not None:
+                    message[key] = cleaned
+                else:
+                    self.pending[text] = [(message, key)]
+                    self.buffer.append(text)
+
+        while len(self.buffer) >= self.batch_size:
+            self.dispatch(self.buffer[:self.batch_size])
+            self.buffer = self.buffer[self.batch_size:]
+
+        self.collect()
+
+    def dispatch(self, texts: List[str]):
+        """
+        Send a batch of texts to be scrubbed
+        """
+        if self.executor is None:
+            if worker_scrubber is None: init_worker()
+            self.apply(texts, clean_batch(texts))
+            return
+
+        self.in_flight.append((self.executor.submit(clean_batch, texts), texts))
+
+        # Don't let the reader get too far ahead of the workers
+        while len(self.in_flight) > 2 * self.workers:
+            self.collect(wait_for_oldest=True)
+
+    def apply(self, texts: List[str], cleaned: List[str]):
+        for text, cleaned_text in zip(texts, cleaned):
+            for message, key in self.pending.pop(text):
+                message[key] = cleaned_text
+            if self.cache: self.cache.put(text, cleaned_text)
+
+    def collect(self, wait_for_oldest: bool=False):
+        """
+        Write back the results of all finished batches
+        """
+        remaining = []
+        for i, (future, texts) in enumerate(self.in_flight):
+            if future.done() or (wait_for_oldest and i == 0):
+                self.apply(texts, future.result())
+            else:
+                remaining.append((future, texts))
+        self.in_flight = remaining
+
+    def wait_for(self, messages: List[Dict]):
+        """
+        Wait until the given messages are scrubbed, other batches keep running
+        """
+        texts = {message[key] for message in messages for key in ('body', 'header') if message[key] in self.pending}
+        if not texts: return
+        if any(text in texts for text in self.buffer):
+            self.dispatch(self.buffer)
+            self.buffer = []
+
+        remaining = []
+        for future, batch in self.in_flight:
+            if future.done() or not texts.isdisjoint(batch):
+                self.apply(batch, future.result())
+            else:
+                remaining.append((future, batch))
+        self.in_flight = remaining
+        if self.cache: self.cache.commit()
+
+    def flush(self):
+        """
+        Scrub everything that has been submitted, and wait for all results
+        """
+        if self.buffer:
+            self.dispatch(self.buffer)
+            self.buffer = []
+
+        for future, texts in self.in_flight:
+            self.apply(texts, future.result())
+        self.in_flight = []
+
+        if self.cache: self.cache.commit()
+
+    def report(self):
+        if self.cache:
+            print(f"Scrub cache: {self.cache.hits} hits, {self.cache.misses} misses ({self.cache.hit_rate():.1%} hit rate)")
+            count('scrub_cache_hits', self.cache.hits)
+            count('scrub_cache_misses', self.cache.misses)
+        print(f"Skipped {self.duplicates} repeated texts waiting to be scrubbed")
+        count('scrub_repeated_texts', self.duplicates)
+
+    def close(self):
+        self.flush()
+        self.report()
+        if self.cache: self.cache.close()
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -0,0 +1,244 @@
+"""
+Finds the past question-answer pairs most similar to a new email, by the embedding of their question.
+Used by run_pipeline.py, which keeps the index up to date, and from the command line:
+    python scripts/similar_pairs.py build
+    python scripts/similar_pairs.py query "Can I take a course outside of my degree?" -k 5
+
+The question embeddings are indexed in an HNSW graph if hnswlib is installed (pip install hnswlib),
+saved in INDEX_DIR. Otherwise the search compares the email with every question, using the
+embeddings of the embedding store. The indexed pairs are saved to OUT_FILE, in the order of the pairs
+file, with the label of each pair in the index. New pairs can be added without building the index again.
+
+Main methods to use: build_index, open_index, PairIndex.query
+"""
+import os
+import sys
+import json
+import argparse
+import configparser
+import numpy as np
+import pandas as pd
+from typing import Callable, List, Optional, Tuple
+from shared_defns import get_filepath
+from storage import read_table, write_table, table_exists
+from embedding_store import EmbeddingStore
+from instrumentation import run, timer
+
+try:
+    import hnswlib # optional, pip install hnswlib
+except ImportError:
+    hnswlib = None
+
+# Constants
+config = configparser.ConfigParser()
+config.read('config.ini')
+model_name = config['cluster_emails']['EMBEDDING_MODEL']
+embedding_dtype = config['cluster_emails']['EMBEDDING_DTYPE']
+out_path_embeddings = get_filepath(config, 'cluster_emails', 'OUT_PATH_EMBEDDINGS')
+index_dir = get_filepath(config, 'index_pairs', 'INDEX_DIR')
+out_path_pairs = get_filepath(config, 'index_pairs', 'OUT_FILE')
+HNSW_M = int(config['index_pairs']['HNSW_M'])
+HNSW_EF_CONSTRUCTION = int(config['index_pairs']['HNSW_EF_CONSTRUCTION'])
+HNSW_EF_SEARCH = int(config['index_pairs']['HNSW_EF_SEARCH'])
+TOP_K = int(config['index_pairs']['TOP_K'])
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+def brute_force_search(matrix: np.ndarray, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Rows of matrix with the highest cosine similarity to each query, and their similarities
+    Both are expected to be normalized
+    """
+    k = min(k, len(matrix))
+    similarities = queries @ matrix.T
+    top = np.argpartition(-similarities, k - 1, axis=1)[:, :k] if k < len(matrix) else np.tile(np.arange(k), (len(queries), 1))
+    top_similarities = np.take_along_axis(similarities, top, axis=1)
+    order = np.argsort(-top_similarities, axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_similarities, order, axis=1)
+
+def hnsw_index(dims: int, max_elements: int, m: int=HNSW_M, ef_construction: int=HNSW_EF_CONSTRUCTION):
+    index = hnswlib.Index(space='cosine', dim=dims)
+    index.init_index(max_elements=max(max_elements, 1), ef_construction=ef_construction, M=m)
+    index.set_ef(HNSW_EF_SEARCH)
+    return index
+
+def hnsw_add(index, vectors: np.ndarray, labels: np.ndarray):
+    """
+    Adds vectors to an HNSW index, growing it if needed
+    """
+    if len(labels) == 0: return
+    needed = index.get_current_count() + len(labels)
+    if needed > index.get_max_elements():
+        index.resize_index(max(needed, 2 * index.get_max_elements()))
+    index.add_items(vectors, labels)
+
+class PairIndex:
+    """
+    Nearest-neighbour index of the questions of the pairs
+    pairs has the indexed pairs in the order of the pairs file, with their label in the index.
+    Labels are never reused, so pairs removed from the index keep their label.
+    """
+    directory: str
+    table_path: str
+    store: EmbeddingStore
+    pairs: pd.DataFrame
+    index: Optional[object]
+    next_label: int
+    matrix: Optional[np.ndarray]
+
+    def __init__(self, directory: str, table_path: str, store: EmbeddingStore) -> None:
+        self.directory = directory
+        self.table_path = table_path
+        self.store = store
+        self.pairs = read_table(table_path) if table_exists(table_path) else pd.DataFrame({'question': [], 'answer': [], 'label': []})
+        self.index = None
+        self.next_label = 0
+        self.matrix = None # question embeddings of the pairs, for the search without hnswlib
+
+        meta_path = os.path.join(directory, 'index.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as file:
+                meta = json.load(file)
+            self.next_label = max(meta['next_label'], int(self.pairs['label'].max()) + 1 if len(self) else 0)
+            if hnswlib and meta['hnsw']:
+                self.index = hnswlib.Index(space='cosine', dim=meta['dims'])
+                self.index.load_index(os.path.join(directory, 'hnsw.bin'))
+                self.index.set_ef(HNSW_EF_SEARCH)
+
+    def __len__(self) -> int:
+        return self.pairs.shape[0]
+
+    def add(self, pairs: pd.DataFrame, vectors: np.ndarray):
+        """
+        Adds pairs after the indexed ones, given the embeddings of their questions
+        """
+        labels = np.arange(self.next_label, self.next_label + pairs.shape[0])
+        self.next_label += pairs.shape[0]
+        new = pairs.reset_index(drop=True).assign(label=labels)
+        self.pairs = new if len(self) == 0 else pd.concat([self.pairs, new], ignore_index=True)
+        self.matrix = None
+
+        if hnswlib and len(labels):
+            if self.index is None:
+                self.index = hnsw_index(vectors.shape[1], len(labels))
+            hnsw_add(self.index, normalize(vectors), labels)
+
+    def remove(self, keep: np.ndarray):
+        """
+        Removes the indexed pairs that are not in keep
+        """
+        if self.index is not None:
+            for label in self.pairs['label'].values[~keep]:
+                self.index.mark_deleted(int(label))
+        self.pairs = self.pairs[keep].reset_index(drop=True)
+        self.matrix = None
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        write_table(self.pairs, self.table_path)
+        if self.index is not None:
+            self.index.save_index(os.path.join(self.directory, 'hnsw.bin'))
+        with open(os.path.join(self.directory, 'index.json'), 'w') as file:
+            json.dump({'next_label': self.next_label, 'hnsw': self.index is not None,
+                       'dims': self.index.dim if self.index is not None else None}, file)
+
+    def search(self, vectors: np.ndarray, k: int=TOP_K) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Rows of pairs whose question is most similar to each vector, and their cosine similarities
+        """
+        k = min(k, len(self))
+        queries = normalize(vectors)
+        if k == 0:
+            return np.zeros((len(queries), 0), dtype=int), np.zeros((len(queries), 0), dtype=np.float32)
+
+        if self.index is not None:
+            self.index.set_ef(max(HNSW_EF_SEARCH, k))
+            labels, distances = self.index.knn_query(queries, k=k)
+            rows = pd.Series(np.arange(len(self)), index=self.pairs['label'].values)
+            return rows.loc[labels.ravel()].values.reshape(labels.shape), 1 - distances
+
+        if self.matrix is None:
+            self.matrix = normalize(self.store.get(self.pairs['question'].tolist()))
+        return brute_force_search(self.matrix, queries, k)
+
+    def query(self, texts: List[str], encode: Callable[[List[str]], np.ndarray], k: int=TOP_K) -> List[pd.DataFrame]:
+        """
+        For each text, the k pairs with the most similar question, with their similarity
+        """
+        rows, similarities = self.search(encode(texts), k)
+        return [self.pairs.iloc[r].assign(similarity=s) for r, s in zip(rows, similarities)]
+
+def open_index(directory: str=index_dir, table_path: str=out_path_pairs, embeddings_dir: str=out_path_embeddings) -> PairIndex:
+    return PairIndex(directory, table_path, EmbeddingStore(embeddings_dir, model_name, embedding_dtype))
+
+def sentence_encoder(device: str='cpu') -> Callable[[List[str]], np.ndarray]:
+    """
+    Encodes texts with EMBEDDING_MODEL, loading the model on first use
+    """
+    embedding_model = None
+
+    def encode(texts: List[str]) -> np.ndarray:
+        nonlocal embedding_model
+        if embedding_model is None:
+            from sentence_transformers import SentenceTransformer
+            embedding_model = SentenceTransformer(model_name, device=device)
+        return embedding_model.encode(list(texts))
+
+    return encode
+
+@run('index_pairs')
+def build_index(pairs: pd.DataFrame, directory: str=index_dir, table_path: str=out_path_pairs,
+                embeddings_dir: str=out_path_embeddings, device: str='cpu') -> PairIndex:
+    """
+    Indexes the questions of the pairs in a new index, replacing any previous one
+    Questions that are not in the embedding store yet are encoded
+    """
+    for filename in ['hnsw.bin', 'index.json']:
+        if os.path.exists(os.path.join(directory, filename)): os.remove(os.path.join(directory, filename))
+    index = open_index(directory, table_path, embeddings_dir)
+    index.pairs = index.pairs.iloc[:0]
+
+    with timer('embed', items=pairs.shape[0]):
+        vectors = index.store.embed(pairs['question'].tolist(), sentence_encoder(device))
+    with timer('add', items=pairs.shape[0]):
+        index.add(pairs, vectors)
+    index.save()
+    print(f"Indexed {len(index)} pairs {'with hnswlib' if index.index is not None else 'for exact search, hnswlib is not installed'}")
+    return index
+
+@run('index_pairs')
+def update_index(pairs: pd.DataFrame, keep: np.ndarray, directory: str=index_dir, table_path: str=out_path_pairs,
+                 embeddings_dir: str=out_path_embeddings, device: str='cpu') -> PairIndex:
+    """
+    Removes the indexed pairs not in keep, and adds new pairs
+    """
+    index = open_index(directory, table_path, embeddings_dir)
+    index.remove(keep)
+    with timer('embed', items=pairs.shape[0]):
+        vectors = index.store.embed(pairs['question'].tolist(), sentence_encoder(device))
+    with timer('add', items=pairs.shape[0]):
+        index.add(pairs, vectors)
+    index.save()
+    print(f"Added {pairs.shape[0]} pairs and removed {int((~keep).sum())} from the index")
+    return index
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['build', 'query'])
+    parser.add_argument('text', nargs='?', help="Email to find similar pairs for, read from stdin if not given")
+    parser.add_argument('-k', type=int, default=TOP_K)
+    args = parser.parse_args()
+
+    # Run from the repository root, as the other scripts
+    if args.command == 'build':
+        build_index(read_table(get_filepath(config, 'make_pairs', 'OUT_FILE')))
+        return
+
+    text = args.text if args.text is not None else sys.stdin.read()
+    for _, pair in open_index().query([text], sentence_encoder(), args.k)[0].iterrows():
+        print(f"--- similarity {pair['similarity']:.3f}\nQuestion: {pair['question']}\n\nAnswer: {pair['answer']}\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+Reads and writes the files passed between the steps of the pipeline.
+Files are saved as csv, Parquet or Arrow IPC depending on FORMAT in config.ini.
+Parquet and Arrow files keep the column types, so conversation ids and senders
+are stored as integers and dates as timestamps, and steps can read only the
+columns they need.
+
+The file names in config.ini keep their .csv extension, and the extension is
+replaced by the one of the chosen format. With EXPORT_CSV, a csv copy is also
+written next to Parquet and Arrow files, e.g. to import the emails into Label Studio.
+
+Main methods to use: read_table, write_table, iter_table, TableWriter
+"""
+import os
+import configparser
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import List, Optional, Iterator
+from shared_defns import DATE_FORMAT
+from instrumentation import timer
+
+# Constants
+config = configparser.ConfigParser()
+config.read('config.ini')
+ENCODING = config['global']['ENCODING']
+FORMAT = config['global']['FORMAT']
+EXPORT_CSV = eval(config['global']['EXPORT_CSV'])
+
+extensions = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Types of the columns shared by the steps, dates are converted separately
+column_types = {'conversation': 'int64', 'turn': 'int64', 'from': 'int8', 'to': 'int8'}
+
+def stage_path(filepath: str, file_format: str=FORMAT) -> str:
+    """
+    Path of a file from the config, with the extension of the file format
+    """
+    if file_format not in extensions:
+        raise ValueError(f"Unknown file format {file_format}, expected one of {list(extensions)}")
+    return os.path.splitext(filepath)[0] + extensions[file_format]
+
+def table_exists(filepath: str, file_format: str=FORMAT) -> bool:
+    return os.path.exists(stage_path(filepath, file_format))
+
+def typed(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts the known columns to their types
+    Dates are parsed from DATE_FORMAT strings, as written in csv files
+    """
+    for column, dtype in column_types.items():
+        if column in df and df[column].dtype != dtype and df[column].notna().all():
+            df[column] = df[column].astype(dtype)
+    if 'date' in df and not pd.api.types.is_datetime64_any_dtype(df['date']):
+        df['date'] = pd.to_datetime(df['date'], format=DATE_FORMAT)
+    return df
+
+def csv_ready(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Formats timestamps as DATE_FORMAT strings, as the csv files always had them
+    """
+    if 'date' in df and pd.api.types.is_datetime64_any_dtype(df['date']):
+        df = df.assign(date=df['date'].dt.strftime(DATE_FORMAT))
+    return df
+
+def index_columns(schema: pa.Schema) -> List[str]:
+    """
+    Names of the columns that hold the pandas index
+    """
+    metadata = schema.pandas_metadata or {}
+    return [column for column in metadata.get('index_columns', []) if isinstance(column, str)]
+
+def projection(schema: pa.Schema, columns: Optional[List[str]]) -> Optional[List[str]]:
+    """
+    Columns to read, including the index so it is restored
+    """
+    if columns is None: return None
+    return list(columns) + [column for column in index_columns(schema) if column not in columns]
+
+def write_table(df: pd.DataFrame, filepath: str, file_format: str=FORMAT, export_csv: bool=EXPORT_CSV) -> str:
+    """
+    Writes a dataframe with its index, returns the path of the file
+    """
+    path = stage_path(filepath, file_format)
+    with timer('write_table', items=df.shape[0]):
+        df = typed(df.copy())
+        if file_format == 'csv':
+            csv_ready(df).to_csv(path, encoding=ENCODING)
+            return path
+
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        if file_format == 'parquet':
+            pq.write_table(table, path)
+        else:
+            with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+        if export_csv: csv_ready(df).to_csv(stage_path(filepath, 'csv'), encoding=ENCODING)
+    return path
+
+def read_table(filepath: str, columns: Optional[List[str]]=None, file_format: str=FORMAT) -> pd.DataFrame:
+    """
+    Reads a file written by write_table, optionally only some of its columns
+    """
+    with timer('read_table') as read_timer:
+        df = read_file(stage_path(filepath, file_format), columns, file_format)
+        read_timer.items = df.shape[0]
+    return df
+
+def read_file(path: str, columns: Optional[List[str]], file_format: str) -> pd.DataFrame:
+    if file_format == 'csv':
+        df = typed(pd.read_csv(path, index_col=0, encoding=ENCODING))
+        return df if columns is None else df[columns]
+
+    if file_format == 'parquet':
+        schema = pq.read_schema(path)
+        return pq.read_table(path, columns=projection(schema, columns)).to_pandas()
+
+    table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    return (table if columns is None else table.select(projection(table.schema, columns))).to_pandas()
+
+def iter_table(filepath: str, chunk_size: int, columns: Optional[List[str]]=None, file_format: str=FORMAT) -> Iterator[pd.DataFrame]:
+    """
+    Reads a file written by write_table in chunks of chunk_size rows
+    """
+    path = stage_path(filepath, file_format)
+    if file_format == 'csv':
+        for df in pd.read_csv(path, index_col=0, encoding=ENCODING, chunksize=chunk_size):
+            df = typed(df)
+            yield df if columns is None else df[columns]
+        return
+
+    if file_format == 'parquet':
+        file = pq.ParquetFile(path)
+        batches = file.iter_batches(batch_size=chunk_size, columns=projection(file.schema_arrow, columns))
+    else:
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        batches = (table if columns is None else table.select(projection(table.schema, columns))).to_batches(max_chunksize=chunk_size)
+
+    for batch in batches:
+        yield batch.to_pandas()
+
+class TableWriter:
+    """
+    Writes a file one chunk of rows at a time, so the whole table never needs to be in memory
+    All chunks must have the same columns
+    """
+    path: str
+    csv_path: Optional[str]
+    file_format: str
+    writer: Optional[object]
+    schema: Optional[pa.Schema]
+    sink: Optional[pa.OSFile]
+    chunks: int
+    rows: int
+
+    def __init__(self, filepath: str, file_format: str=FORMAT, export_csv: bool=EXPORT_CSV) -> None:
+        self.path = stage_path(filepath, file_format)
+        self.csv_path = stage_path(filepath, 'csv') if export_csv or file_format == 'csv' else None
+        self.file_format = file_format
+        self.writer = self.schema = self.sink = None
+        self.chunks = self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, df: pd.DataFrame):
+        with timer('write_table', items=df.shape[0]):
+            self.write_chunk(typed(df.copy()))
+
+    def write_chunk(self, df: pd.DataFrame):
+        if self.csv_path:
+            csv_ready(df).to_csv(self.csv_path, mode='w' if self.chunks == 0 else 'a', header=(self.chunks == 0), encoding=ENCODING)
+
+        if self.file_format != 'csv':
+            table = pa.Table.from_pandas(df, preserve_index=True)
+            if self.writer is None:
+                # Columns that are empty in the first chunk are stored as strings
+                self.schema = pa.schema([field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in table.schema],
+                                        metadata=table.schema.metadata)
+                if self.file_format == 'parquet':
+                    self.writer = pq.ParquetWriter(self.path, self.schema)
+                else:
+                    self.sink = pa.OSFile(self.path, 'wb')
+                    self.writer = pa.ipc.new_file(self.sink, self.schema)
+            self.writer.write_table(table.cast(self.schema))
+
+        self.chunks += 1
+        self.rows += df.shape[0]
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
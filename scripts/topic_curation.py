@@ -0,0 +1,218 @@
+"""
+Merging and labelling the topics of a BERTopic model by hand, without recomputing every topic.
+Used by 6_cluster_emails.ipynb and clustering.py
+
+BERTopic's merge_topics and update_topics vectorize all documents and compute the c-TF-IDF
+representation of every topic again. TopicCuration keeps the topic of each document as an integer
+array, so a merge only remaps the array. The term counts of each document are computed once, and
+after a merge only the representations of the merged topics are computed again. As in BERTopic,
+topics are numbered again by size after each merge, so the merge steps of TOPIC_MERGES_FILE find
+the same topics either way.
+
+The representations of the topics that didn't change are kept from before the merge, so they
+can differ slightly from BERTopic's, whose weights depend on the number of topics. Call commit once
+the merges are done, to write the topics, representations and labels to the model, e.g. before
+plotting or saving it. The c-TF-IDF rows of the topics that didn't change are moved to their new
+ids, and only the rows of merged topics are computed, without BERTopic's update_topics.
+
+Main class to use: TopicCuration
+"""
+import numpy as np
+import pandas as pd
+from collections import Counter
+import scipy.sparse as sp
+from typing import Dict, List, Optional, Tuple, Union
+from sklearn.base import clone
+from sklearn.preprocessing import normalize
+
+class TopicCuration:
+    """
+    Topics of the documents of a BERTopic model, merged and labelled by hand
+    Arrays indexed by slot have one row for each topic id from -1, the slot of a topic is its id + 1
+    """
+    model: object
+    docs: List[str]
+    topics: np.ndarray                  # topic of each document
+    labels: Dict[int, str]              # custom labels of the topics
+    representations: Dict[int, List[Tuple[str, float]]]
+    topic_vectors: Optional[np.ndarray] # embedding of each topic slot
+    term_counts: Optional[sp.csr_matrix] # term counts of each topic slot, computed on the first merge
+    words: Optional[np.ndarray]
+    model_words: Optional[sp.csr_matrix] # maps the words to the vocabulary of the model
+    origins: Dict[int, List[int]]       # topics of the model merged into each topic
+    merged: bool
+
+    def __init__(self, model, docs) -> None:
+        self.model = model
+        self.docs = list(docs)
+        self.topics = np.asarray(model.topics_, dtype=np.int64)
+        if len(self.topics) != len(self.docs):
+            raise ValueError(f"The model has {len(self.topics)} documents, but {len(self.docs)} were given")
+
+        unique_topics = sorted(set(self.topics.tolist()))
+        self.labels = dict(zip(unique_topics, model.custom_labels_)) if model.custom_labels_ is not None else {}
+        self.representations = dict(model.topic_representations_)
+        self.term_counts = self.words = self.model_words = None
+        self.origins = {topic: [topic] for topic in unique_topics}
+        self.merged = False
+
+        # Topic embeddings of BERTopic start with the outlier topic if the model has one
+        self.topic_vectors = None
+        if model.topic_embeddings_ is not None:
+            embeddings = np.asarray(model.topic_embeddings_)
+            slots = np.arange(len(embeddings)) - model._outliers + 1
+            self.topic_vectors = np.zeros((self.n_slots, embeddings.shape[1]))
+            valid = (slots >= 0) & (slots < self.n_slots)
+            self.topic_vectors[slots[valid]] = embeddings[valid]
+
+    @property
+    def n_slots(self) -> int:
+        return int(self.topics.max()) + 2 if len(self.topics) else 1
+
+    def sizes(self) -> np.ndarray:
+        return np.bincount(self.topics + 1, minlength=self.n_slots)
+
+    def count_terms(self):
+        """
+        Counts the terms of each topic, with the vectorizer settings of the model
+        Every word of the documents is kept, since BERTopic's min_df counts topics rather than documents
+        """
+        vectorizer = clone(self.model.vectorizer_model).set_params(min_df=1, max_df=1.0)
+        doc_terms = vectorizer.fit_transform(self.docs).tocsr()
+        self.words = vectorizer.get_feature_names_out()
+        columns = {word: i for i, word in enumerate(self.model.vectorizer_model.get_feature_names_out())}
+        known = [(i, columns[word]) for i, word in enumerate(self.words) if word in columns]
+        self.model_words = sp.csr_matrix((np.ones(len(known)), tuple(np.array(known, dtype=np.int64).reshape(-1, 2).T)),
+                                         shape=(len(self.words), len(columns)))
+        membership = sp.csr_matrix((np.ones(len(self.topics)), (self.topics + 1, np.arange(len(self.topics)))),
+                                   shape=(self.n_slots, len(self.topics)))
+        self.term_counts = (membership @ doc_terms).tocsr()
+
+    def ctfidf(self, topics: List[int]) -> sp.csr_matrix:
+        """
+        c-TF-IDF rows of the given topics, as computed by BERTopic's ClassTfidfTransformer
+        """
+        counts = self.term_counts
+        word_totals = np.asarray(counts.sum(axis=0)).ravel()
+        topic_totals = np.asarray(counts.sum(axis=1)).ravel()
+        avg_nr_samples = int(topic_totals[topic_totals > 0].mean())
+        idf = np.log(avg_nr_samples / np.maximum(word_totals, 1) + 1)
+
+        rows = normalize(counts[np.asarray(topics) + 1], axis=1, norm='l1')
+        if getattr(self.model.ctfidf_model, 'reduce_frequent_words', False):
+            rows.data = np.sqrt(rows.data)
+        return rows.multiply(idf).tocsr()
+
+    def topic_representation(self, topics: List[int]) -> Dict[int, List[Tuple[str, float]]]:
+        """
+        Top words of the given topics, by their c-TF-IDF
+        """
+        representations = {}
+        for topic, row in zip(topics, self.ctfidf(topics)):
+            top = np.argsort(-row.data, kind='stable')[:self.model.top_n_words]
+            representations[topic] = [(str(self.words[row.indices[i]]), float(row.data[i])) for i in top]
+        return representations
+
+    def merge(self, topics_to_merge: Union[List[int], List[List[int]]]):
+        """
+        Merges each group of topics into the first topic of the group, as BERTopic's merge_topics
+        Topics are then numbered by size, the largest topic is 0 and outliers stay -1
+        """
+        if not topics_to_merge: return
+        if not isinstance(topics_to_merge[0], (list, tuple)): topics_to_merge = [topics_to_merge]
+        if self.term_counts is None: self.count_terms()
+
+        n_slots, old_sizes = self.n_slots, self.sizes()
+        target = np.arange(-1, n_slots - 1)
+        for group in topics_to_merge:
+            target[np.asarray(group) + 1] = group[0]
+        merged = target[self.topics + 1]
+
+        # Number by size as BERTopic, in order of first appearance for topics of the same size
+        first_seen = pd.unique(merged)
+        df = pd.DataFrame({'Old_Topic': first_seen, 'Size': np.bincount(merged + 1)[first_seen + 1]}).sort_values('Size', ascending=False)
+        df = df[df.Old_Topic != -1]
+        renumber = np.full(n_slots, -2) # -2 for topics without documents
+        renumber[0] = -1
+        renumber[df.Old_Topic.values + 1] = np.arange(len(df))
+
+        new_topic = renumber[target + 1] # new topic of each old slot
+        self.topics = renumber[merged + 1]
+        kept = (new_topic >= -1) & (old_sizes > 0)
+        slots = np.flatnonzero(kept)
+        aggregate = sp.csr_matrix((np.ones(len(slots)), (new_topic[slots] + 1, slots)), shape=(self.n_slots, n_slots))
+
+        self.term_counts = (aggregate @ self.term_counts).tocsr()
+        if self.topic_vectors is not None:
+            weights = normalize(aggregate.multiply(old_sizes).tocsr(), axis=1, norm='l1')
+            self.topic_vectors = weights @ self.topic_vectors
+
+        # Only the topics made of several topics have new representations
+        sources = np.bincount(new_topic[slots] + 1, minlength=self.n_slots)
+        changed = [int(topic) for topic in np.flatnonzero(sources > 1) - 1]
+        single = {int(new_topic[slot]): int(slot - 1) for slot in slots if sources[new_topic[slot] + 1] == 1}
+        origins = {}
+        for slot in slots:
+            origins.setdefault(int(new_topic[slot]), []).extend(self.origins.get(int(slot - 1), []))
+        self.origins = origins
+        self.representations = {**{new: self.representations.get(old, []) for new, old in single.items()},
+                                **(self.topic_representation(changed) if changed else {})}
+
+        # Labels stay with the topic id, as the custom labels of BERTopic
+        self.labels = {topic: label for topic, label in self.labels.items() if topic in self.representations}
+        self.merged = True
+
+    def set_labels(self, labels: Dict[int, str]):
+        self.labels.update({int(topic): label for topic, label in labels.items()})
+
+    def topic_info(self) -> pd.DataFrame:
+        """
+        Size, name and custom label of each topic, like BERTopic's get_topic_info
+        """
+        sizes = self.sizes()
+        topics = sorted(self.representations)
+        names = [f"{topic}_" + "_".join(word for word, _ in self.representations[topic][:4]) for topic in topics]
+        return pd.DataFrame({'Topic': topics, 'Count': [int(sizes[topic + 1]) for topic in topics], 'Name': names,
+                             'CustomName': [self.labels.get(topic, name) for topic, name in zip(topics, names)],
+                             'Representation': [[word for word, _ in self.representations[topic]] for topic in topics]})
+
+    def ctfidf_matrix(self, topics: List[int]) -> sp.csr_matrix:
+        """
+        c-TF-IDF of the given topics in the vocabulary of the model, one row for each topic
+        Topics made of one topic of the model keep its row, only the rows of merged topics are computed
+        """
+        # The rows of the model follow its topic ids, from -1 if it has outliers
+        old = self.model.c_tf_idf_.tocsr()
+        rows = {topic: row for row, topic in enumerate(sorted(self.model.topic_representations_))}
+        merged = [topic for topic in topics if len(self.origins[topic]) > 1]
+        computed = dict(zip(merged, self.ctfidf(merged) @ self.model_words)) if merged else {}
+        return sp.vstack([computed[topic] if topic in computed else old[rows[self.origins[topic][0]]]
+                          for topic in topics]).tocsr()
+
+    def commit(self):
+        """
+        Writes the topics, their representations and labels to the model
+        """
+        model = self.model
+        if self.merged:
+            topics = sorted(self.representations)
+            model.c_tf_idf_ = self.ctfidf_matrix(topics)
+            if model.representative_docs_:
+                model.representative_docs_ = {topic: [doc for origin in self.origins[topic] for doc in model.representative_docs_.get(origin, [])][:3]
+                                              for topic in topics}
+
+            model.topics_ = self.topics.tolist()
+            model.topic_sizes_ = Counter(model.topics_)
+            model.topic_representations_ = {topic: self.representations[topic] for topic in topics}
+            model.topic_labels_ = {topic: f"{topic}_" + "_".join(word for word, _ in words[:4])
+                                   for topic, words in model.topic_representations_.items()}
+            model._outliers = int((self.topics == -1).any())
+            if self.topic_vectors is not None:
+                model.topic_embeddings_ = self.topic_vectors[1 - model._outliers:]
+            model.custom_labels_ = None
+
+            # Further merges start from the topics of the model
+            self.origins = {topic: [topic] for topic in topics}
+            self.merged = False
+        if self.labels:
+            model.set_topic_labels(self.labels)